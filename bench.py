@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# bench.py
+"""Офлайн-замеры производительности компонентов бота.
+
+Использование:
+    python bench.py translation [файл_с_фразами] [--to-russian]
+    python bench.py payload [число_итераций]
+    python bench.py transcription [число_сообщений] [длительность_сек] [--batch=1,2,4,8]
+"""
+import asyncio
+import io
+import json
+import math
+import random
+import statistics
+import sys
+import time
+import timeit
+import wave
+from utils import manage_config, PROXY
+from translation import TranslationService
+from transcription import TranscriptionService, SAMPLE_RATE
+from payload import get_template, dumps, orjson
+from log_setup import setup_logging
+
+# Фразы по умолчанию для замера перевода
+SAMPLE_PHRASES_RU = [
+    "Привет!",
+    "Продолжай историю.",
+    "Что было дальше?",
+    "Герой открыл дверь и вошёл в тёмную комнату.",
+    "Расскажи мне сказку про дракона, который боялся темноты.",
+]
+
+
+async def bench_translation(args):
+    config = manage_config()
+    to_english = "--to-russian" not in args
+    paths = [arg for arg in args if not arg.startswith("--")]
+    if paths:
+        with open(paths[0], "r", encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()]
+    else:
+        texts = SAMPLE_PHRASES_RU
+    service = TranslationService(proxy=PROXY)
+    service.configure(config)
+    print(f"Бэкенды: {service.backend_names}, фраз: {len(texts)}")
+    results = await service.benchmark(texts, to_english=to_english)
+    for name, stats in results.items():
+        if stats["ok"]:
+            print(f"{name:>12}: ok={stats['ok']} ошибок={stats['errors']} "
+                  f"среднее={stats['mean'] * 1000:.1f} мс медиана={stats['median'] * 1000:.1f} мс "
+                  f"максимум={stats['max'] * 1000:.1f} мс")
+        else:
+            print(f"{name:>12}: все {stats['errors']} запросов завершились ошибкой")
+    service.close()
+
+
+async def bench_payload(args):
+    config = manage_config()
+    iterations = int(args[0]) if args else 10000
+    template = get_template(config)
+    # Промпт типичного размера: системный промпт и пара десятков реплик
+    prompt = config["system_prompt"] + "\nUser: Tell me a story about a dragon.\nRoleplay character Vrok's answer: " * 60
+    memory = "You are a cheerful AI named Vrok, always responding with a bit of humor."
+    stop = ["\nUser:", "\n***"]
+    payload = template.build(prompt, memory, 200, stop)
+
+    stages = [
+        ("сборка из шаблона", lambda: template.build(prompt, memory, 200, stop)),
+        (f"кодирование ({'orjson' if orjson else 'json'})", lambda: dumps(payload)),
+        ("кодирование json.dumps", lambda: json.dumps(payload)),
+        ("дамп json.dumps(indent=2)", lambda: json.dumps(payload, ensure_ascii=False, indent=2)),
+        ("сборка + кодирование", lambda: dumps(template.build(prompt, memory, 200, stop))),
+    ]
+    print(f"Пресет: {template.preset}, ключей: {len(payload)}, промпт: {len(prompt)} символов, итераций: {iterations}")
+    for name, func in stages:
+        elapsed = timeit.timeit(func, number=iterations)
+        print(f"{name:>28}: {elapsed / iterations * 1e6:.1f} мкс на запрос")
+
+
+def synthetic_clip(seconds, seed):
+    """WAV 16 кГц: «слоги» из тонов с плавающей частотой, разделённые паузами, плюс шум."""
+    rng = random.Random(seed)
+    samples = bytearray()
+    t = 0
+    while t < seconds * SAMPLE_RATE:
+        length = int(rng.uniform(0.15, 0.4) * SAMPLE_RATE)
+        base = rng.uniform(120, 300)
+        for i in range(length):
+            envelope = math.sin(math.pi * i / length)
+            value = envelope * (0.5 * math.sin(2 * math.pi * base * i / SAMPLE_RATE)
+                                + 0.25 * math.sin(2 * math.pi * base * 2.5 * i / SAMPLE_RATE))
+            samples += int(max(-1.0, min(1.0, value + rng.gauss(0, 0.02))) * 32767).to_bytes(2, "little", signed=True)
+        pause = int(rng.uniform(0.05, 0.2) * SAMPLE_RATE)
+        samples += b"\x00\x00" * pause
+        t += length + pause
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(bytes(samples))
+    return buffer.getvalue()
+
+
+async def bench_transcription(args):
+    config = manage_config()
+    options = [arg for arg in args if arg.startswith("--")]
+    args = [arg for arg in args if not arg.startswith("--")]
+    count = int(args[0]) if args else 16
+    seconds = float(args[1]) if len(args) > 1 else 5.0
+    batch_sizes = [1, 2, 4, 8]
+    for option in options:
+        if option.startswith("--batch="):
+            batch_sizes = [int(size) for size in option.split("=", 1)[1].split(",")]
+    clips = [synthetic_clip(seconds, seed) for seed in range(count)]
+    print(f"Модель: {config.get('whisper_model', 'small')}, процессов: {config.get('transcription_concurrency', 1)}, "
+          f"сообщений: {count} по {seconds:.1f} сек")
+    for batch_size in batch_sizes:
+        service = TranscriptionService()
+        service.configure(dict(config, transcription_backend="whisper", transcription_batch_size=batch_size))
+        if service.backend.name != "whisper":
+            print("faster-whisper не установлен: замер пакетного распознавания невозможен")
+            service.close()
+            return
+        await service.warm_up()
+
+        async def timed(clip):
+            started = time.perf_counter()
+            await service.transcribe(clip)
+            return time.perf_counter() - started
+
+        # Все сообщения приходят одновременно, как при всплеске голосовых из нескольких чатов
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(timed(clip) for clip in clips))
+        elapsed = time.perf_counter() - started
+        service.close()
+        print(f"пакет {batch_size:>2}: {count / elapsed:.2f} сообщ/сек, {count * seconds / elapsed:.1f} сек аудио/сек, "
+              f"задержка: медиана {statistics.median(latencies):.2f} сек, максимум {max(latencies):.2f} сек")
+
+
+BENCHMARKS = {
+    "translation": bench_translation,
+    "payload": bench_payload,
+    "transcription": bench_transcription,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__)
+        sys.exit(1)
+    setup_logging()
+    asyncio.run(BENCHMARKS[sys.argv[1]](sys.argv[2:]))
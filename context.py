@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# context.py
+import asyncio
+import logging
+from storage import get_storage, LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Разделители для системного промпта
+SYSTEM_PROMPT_START = "###SYSTEM_PROMPT_START###"
+SYSTEM_PROMPT_END = "###SYSTEM_PROMPT_END###"
+
+# Среднее число символов на токен для английского текста (грубая оценка без токенизатора)
+DEFAULT_CHARS_PER_TOKEN = 3.5
+
+# Запас токенов на служебные строки промпта и погрешность оценки
+BUDGET_SAFETY_MARGIN = 64
+
+
+def estimate_tokens(text, chars_per_token=DEFAULT_CHARS_PER_TOKEN):
+    """Приблизительно оценивает число токенов в тексте."""
+    if not text:
+        return 0
+    return int(len(text) / chars_per_token) + 1
+
+
+def split_system_prompt(context):
+    """Делит контекст на блок системного промпта (с разделителями) и историю."""
+    start_idx = context.find(SYSTEM_PROMPT_START)
+    if start_idx != -1:
+        end_idx = context.find(SYSTEM_PROMPT_END, start_idx + len(SYSTEM_PROMPT_START))
+        if end_idx != -1:
+            end_idx += len(SYSTEM_PROMPT_END)
+            return context[start_idx:end_idx], context[:start_idx] + context[end_idx:]
+    return "", context
+
+
+def context_budget(config, max_length, memory="", new_text=""):
+    """Возвращает бюджет токенов для контекста с учётом памяти, нового сообщения и длины ответа."""
+    chars_per_token = config.get("chars_per_token", DEFAULT_CHARS_PER_TOKEN)
+    budget = config.get("context_token_budget")
+    if budget is None:
+        budget = config.get("max_context_length", 8192) - max_length
+    budget -= estimate_tokens(memory, chars_per_token) + estimate_tokens(new_text, chars_per_token)
+    return max(budget - BUDGET_SAFETY_MARGIN, 0)
+
+
+class Turn:
+    """Одна реплика разговора из таблицы context_turns."""
+
+    __slots__ = ("seq", "role", "text", "token_count")
+
+    def __init__(self, seq, role, text, token_count):
+        self.seq = seq
+        self.role = role
+        self.text = text
+        self.token_count = token_count
+
+
+CREATE_TURNS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS context_turns (
+        chat_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        text TEXT NOT NULL,
+        token_count INTEGER NOT NULL,
+        PRIMARY KEY (chat_id, seq)
+    )
+'''
+
+# Новая реплика получает следующий номер в рамках чата (поиск MAX идёт по первичному ключу)
+APPEND_TURN_SQL = '''
+    INSERT INTO context_turns (chat_id, seq, role, text, token_count)
+    SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ? FROM context_turns WHERE chat_id = ?
+'''
+
+SELECT_SYSTEM_TURN_SQL = '''
+    SELECT seq, role, text, token_count FROM context_turns
+    WHERE chat_id = ? AND role = 'system' ORDER BY seq LIMIT 1
+'''
+
+SELECT_HISTORY_SQL = '''
+    SELECT seq, role, text, token_count FROM context_turns
+    WHERE chat_id = ? AND role != 'system' ORDER BY seq
+'''
+
+# Самые свежие реплики, суммарно укладывающиеся в бюджет токенов
+SELECT_HISTORY_IN_BUDGET_SQL = '''
+    SELECT seq, role, text, token_count FROM (
+        SELECT seq, role, text, token_count,
+               SUM(token_count) OVER (ORDER BY seq DESC) AS running_tokens
+        FROM context_turns
+        WHERE chat_id = ? AND role != 'system'
+    )
+    WHERE running_tokens <= ?
+    ORDER BY seq
+'''
+
+# История начиная с заданной реплики (для стабильного префикса промпта)
+SELECT_HISTORY_FROM_SQL = '''
+    SELECT seq, role, text, token_count FROM context_turns
+    WHERE chat_id = ? AND role != 'system' AND seq >= ?
+    ORDER BY seq
+'''
+
+# Доля бюджета, которую занимает история сразу после обрезки в режиме стабильного префикса
+DEFAULT_TRIM_RATIO = 0.5
+
+# Первая реплика истории, с которой начинается промпт чата в режиме стабильного префикса
+_anchors = LRUCache(4096)
+
+# Чаты, для которых уже проверен перенос старого контекста из user_context
+_legacy_checked = set()
+# Блокировки переноса: параллельные первые обращения чата не переносят контекст дважды
+_legacy_locks = {}
+
+
+async def _migrate_legacy_context(chat_id, db_file):
+    """Переносит контекст из старой таблицы user_context в context_turns."""
+    storage = get_storage(db_file)
+    row = await storage.fetchone('SELECT context FROM user_context WHERE chat_id = ?', (chat_id,))
+    if not row or not row[0]:
+        return False
+    system_block, history = split_system_prompt(row[0])
+    statements = []
+    if system_block:
+        system_text = system_block[len(SYSTEM_PROMPT_START):-len(SYSTEM_PROMPT_END)]
+        statements.append((APPEND_TURN_SQL, (chat_id, "system", system_text, estimate_tokens(system_text), chat_id)))
+    # Старую историю делим по строкам, чтобы её можно было обрезать по бюджету
+    lines = history.split("\n")
+    pieces = [lines[0]] + ["\n" + line for line in lines[1:]]
+    for piece in pieces:
+        if piece:
+            statements.append((APPEND_TURN_SQL, (chat_id, "legacy", piece, estimate_tokens(piece), chat_id)))
+    statements.append(('DELETE FROM user_context WHERE chat_id = ?', (chat_id,)))
+    await storage.transaction(statements)
+    logger.info("Контекст chat_id %s перенесён из user_context в context_turns", chat_id)
+    return True
+
+
+async def _ensure_migrated(chat_id, db_file):
+    """Переносит старый контекст чата один раз; параллельные вызовы ждут первый перенос."""
+    if chat_id in _legacy_checked:
+        return
+    lock = _legacy_locks.setdefault(chat_id, asyncio.Lock())
+    async with lock:
+        if chat_id not in _legacy_checked:
+            await _migrate_legacy_context(chat_id, db_file)
+            _legacy_checked.add(chat_id)
+    # Ожидающие уже держат ссылку на блокировку; после ошибки она остаётся для повтора
+    if chat_id in _legacy_checked:
+        _legacy_locks.pop(chat_id, None)
+
+
+async def load_turns(chat_id, budget_tokens=None, db_file="context.db"):
+    """Возвращает (системная реплика или None, список реплик истории).
+
+    Если задан budget_tokens, читаются только самые свежие реплики, которые
+    вместе с системным промптом укладываются в бюджет.
+    """
+    storage = get_storage(db_file)
+    await _ensure_migrated(chat_id, db_file)
+    row = await storage.fetchone(SELECT_SYSTEM_TURN_SQL, (chat_id,))
+    system_turn = Turn(*row) if row else None
+    if budget_tokens is None:
+        rows = await storage.fetchall(SELECT_HISTORY_SQL, (chat_id,))
+    else:
+        available = budget_tokens - (system_turn.token_count if system_turn else 0)
+        rows = await storage.fetchall(SELECT_HISTORY_IN_BUDGET_SQL, (chat_id, available))
+    return system_turn, [Turn(*r) for r in rows]
+
+
+async def load_turns_stable(chat_id, budget_tokens, trim_ratio=DEFAULT_TRIM_RATIO, db_file="context.db"):
+    """Как load_turns, но начало истории сдвигается редко и крупными шагами.
+
+    Промпт начинается с одной и той же реплики, пока история умещается в
+    бюджет, поэтому каждый новый промпт продолжает предыдущий и бэкенд может
+    повторно использовать свой кэш. При переполнении отбрасываются старые
+    реплики так, чтобы история заняла не больше trim_ratio бюджета.
+    """
+    storage = get_storage(db_file)
+    await _ensure_migrated(chat_id, db_file)
+    row = await storage.fetchone(SELECT_SYSTEM_TURN_SQL, (chat_id,))
+    system_turn = Turn(*row) if row else None
+    available = budget_tokens - (system_turn.token_count if system_turn else 0)
+    anchor = _anchors.get(chat_id, 0)
+    turns = [Turn(*r) for r in await storage.fetchall(SELECT_HISTORY_FROM_SQL, (chat_id, anchor))]
+    total = sum(turn.token_count for turn in turns)
+    if turns and total > available:
+        target = available * trim_ratio
+        start = 0
+        while start < len(turns) and total > target:
+            total -= turns[start].token_count
+            start += 1
+        anchor = turns[start - 1].seq + 1
+        turns = turns[start:]
+        _anchors.set(chat_id, anchor)
+        logger.info("Начало истории chat_id %s сдвинуто: отброшено %s реплик, осталось %s", chat_id, start, len(turns))
+    return system_turn, turns
+
+
+async def append_turns(chat_id, turns, chars_per_token=DEFAULT_CHARS_PER_TOKEN, db_file="context.db"):
+    """Добавляет реплики (role, text) в конец истории одной транзакцией."""
+    statements = [
+        (APPEND_TURN_SQL, (chat_id, role, text, estimate_tokens(text, chars_per_token), chat_id))
+        for role, text in turns if text
+    ]
+    if statements:
+        await get_storage(db_file).transaction(statements)
+
+
+async def has_turns(chat_id, db_file="context.db"):
+    """Проверяет, есть ли у чата сохранённый контекст."""
+    await _ensure_migrated(chat_id, db_file)
+    row = await get_storage(db_file).fetchone('SELECT 1 FROM context_turns WHERE chat_id = ? LIMIT 1', (chat_id,))
+    return row is not None
+
+
+async def clear_turns(chat_id, db_file="context.db"):
+    """Удаляет весь контекст чата."""
+    _anchors.pop(chat_id)
+    await get_storage(db_file).transaction([
+        ('DELETE FROM context_turns WHERE chat_id = ?', (chat_id,)),
+        ('DELETE FROM user_context WHERE chat_id = ?', (chat_id,)),
+    ])
+
+
+def render_turns(turns):
+    """Склеивает реплики в текст в том виде, в каком они идут в промпт."""
+    return "".join(turn.text for turn in turns)
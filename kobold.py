@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+# kobold.py
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import time
+import aiohttp
+from storage import LRUCache
+from metrics import KOBOLD_HEALTH_CHECK_SECONDS, KOBOLD_BACKEND_UP
+
+logger = logging.getLogger(__name__)
+
+
+class KoboldBackend:
+    """Kobold-совместимый сервер с постоянной HTTP-сессией.
+
+    Сессия создаётся один раз и держит пул keep-alive соединений, поэтому
+    запросы генерации используют уже установленные TCP-соединения.
+    """
+
+    def __init__(self, api_url, connection_limit=10, dns_cache_ttl=300, keepalive_timeout=60,
+                 health_interval=30, health_retry_interval=5, health_timeout=5, weight=1, capacity=1):
+        self.api_url = api_url
+        # Доля нагрузки при балансировке и число одновременных генераций на сервере
+        self.weight = weight
+        self.capacity = capacity
+        self.outstanding = 0  # запросы, ожидающие места или выполняющиеся на этом бэкенде
+        # Бэкенд убран из конфигурации: закрывается после завершения последнего запроса
+        self.retired = False
+        self.base_url = api_url.replace("/api/v1/generate", "")
+        # SSE-эндпоинт KoboldCpp для потоковой генерации
+        self.stream_url = f"{self.base_url}/api/extra/generate/stream"
+        self.supports_stream = True
+        # Статистика последней генерации KoboldCpp (время обработки промпта и т. п.)
+        self.perf_url = f"{self.base_url}/api/extra/perf"
+        self.supports_perf = True
+        # Последний успешно обработанный промпт: сервер держит его в кэше, общий префикс обрабатывается повторно бесплатно
+        self.last_prompt = None
+        self.connection_limit = connection_limit
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.session = None
+
+        # Состояние доступности, которое поддерживает фоновый монитор
+        self.health_interval = health_interval
+        self.health_retry_interval = health_retry_interval
+        self.health_timeout = health_timeout
+        self.healthy = None  # None — проверок ещё не было
+        self.last_check = None
+        self.last_ok = None
+        self.last_error = None
+        self._healthy_event = asyncio.Event()
+        self._probe_now = asyncio.Event()
+        self._monitor_task = None
+
+    async def start(self):
+        """Создаёт HTTP-сессию с пулом соединений."""
+        if self.session is not None and not self.session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.connection_limit,
+            ttl_dns_cache=self.dns_cache_ttl,
+            use_dns_cache=True,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        self.session = aiohttp.ClientSession(connector=connector)
+        logger.info("Открыта сессия Kobold API: %s (лимит соединений: %s)", self.base_url, self.connection_limit)
+
+    @contextlib.contextmanager
+    def reserve(self):
+        """Учитывает запрос в числе незавершённых на время его ожидания и выполнения."""
+        self.outstanding += 1
+        try:
+            yield self
+        finally:
+            self.outstanding -= 1
+            if self.retired and not self.outstanding:
+                _close_retired(self)
+
+    def is_available(self):
+        """Можно ли отправлять запросы: бэкенд доступен или ещё не проверялся."""
+        return self.healthy is not False
+
+    def _set_health(self, healthy, error=None):
+        now = time.time()
+        self.last_check = now
+        previous = self.healthy
+        self.healthy = healthy
+        if healthy:
+            self.last_ok = now
+            self.last_error = None
+            self._healthy_event.set()
+            if previous is False:
+                logger.info("Kobold API снова доступен: %s", self.base_url)
+        else:
+            self.last_error = error
+            self._healthy_event.clear()
+            if previous is not False:
+                logger.error("Kobold API недоступен: %s (%s)", self.base_url, error)
+
+    def report_success(self):
+        """Отмечает успешный запрос к бэкенду."""
+        if self.healthy is not True:
+            self._set_health(True)
+        else:
+            self.last_ok = time.time()
+
+    def report_failure(self, error):
+        """Отмечает ошибку соединения и просит монитор немедленно перепроверить бэкенд."""
+        self._set_health(False, str(error))
+        self._probe_now.set()
+
+    def prefix_reuse(self, prompt):
+        """Оценка доли нового промпта, совпадающей с началом предыдущего на этом бэкенде (0..1).
+
+        Оценка клиентская: сервер не сообщает, сколько токенов взято из кэша.
+        """
+        previous = self.last_prompt
+        if not previous or not prompt:
+            return 0.0
+        return len(os.path.commonprefix([previous, prompt])) / len(prompt)
+
+    def remember_prompt(self, prompt):
+        """Запоминает prompt как последний обработанный (вызывается после успешной генерации)."""
+        self.last_prompt = prompt
+
+    async def fetch_perf(self):
+        """Возвращает статистику последней генерации из /api/extra/perf или None."""
+        if not self.supports_perf:
+            return None
+        try:
+            async with self.session.get(self.perf_url, timeout=aiohttp.ClientTimeout(total=self.health_timeout)) as response:
+                if response.status == 404:
+                    self.supports_perf = False
+                    logger.info("Бэкенд %s не отдаёт статистику генерации", self.base_url)
+                    return None
+                if response.status != 200:
+                    return None
+                return await response.json(content_type=None)
+        except Exception as e:
+            logger.warning("Не удалось получить статистику генерации %s: %s", self.base_url, e)
+            return None
+
+    async def probe(self):
+        """Выполняет одну проверку доступности бэкенда."""
+        try:
+            with KOBOLD_HEALTH_CHECK_SECONDS.time(backend=self.base_url):
+                async with self.session.get(self.base_url, timeout=aiohttp.ClientTimeout(total=self.health_timeout)) as response:
+                    if response.status == 200:
+                        self._set_health(True)
+                    else:
+                        self._set_health(False, f"статус {response.status}")
+        except Exception as e:
+            self._set_health(False, str(e) or type(e).__name__)
+        KOBOLD_BACKEND_UP.set(1 if self.healthy else 0, backend=self.base_url)
+        return self.healthy
+
+    async def wait_until_healthy(self, timeout):
+        """Ждёт восстановления бэкенда не дольше timeout секунд. Возвращает его доступность."""
+        if self.healthy is not False:
+            return True
+        self._probe_now.set()
+        try:
+            await asyncio.wait_for(self._healthy_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.healthy is not False
+
+    async def _monitor(self):
+        logger.info("Запущен мониторинг Kobold API: %s с интервалом %s сек", self.base_url, self.health_interval)
+        while True:
+            await self.probe()
+            # Пока бэкенд недоступен, проверяем его чаще, чтобы быстрее заметить восстановление
+            interval = self.health_interval if self.healthy else self.health_retry_interval
+            self._probe_now.clear()
+            try:
+                await asyncio.wait_for(self._probe_now.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start_monitor(self):
+        """Запускает фоновую проверку доступности бэкенда."""
+        if self._monitor_task is None or self._monitor_task.done():
+            self._monitor_task = asyncio.create_task(self._monitor())
+
+    async def close(self):
+        """Закрывает HTTP-сессию и все соединения пула."""
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+            try:
+                await self._monitor_task
+            except asyncio.CancelledError:
+                pass
+            self._monitor_task = None
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            logger.info("Сессия Kobold API закрыта: %s", self.base_url)
+        self.session = None
+
+
+async def read_token_stream(response, on_partial=None):
+    """Читает SSE-поток KoboldCpp и возвращает полный сгенерированный текст.
+
+    После каждого полученного токена вызывает on_partial(накопленный_текст).
+    """
+    text = ""
+    async for raw_line in response.content:
+        line = raw_line.decode("utf-8", errors="replace").strip()
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if not data:
+            continue
+        try:
+            event = json.loads(data)
+        except json.JSONDecodeError:
+            logger.warning("Не удалось разобрать событие потока Kobold API: %s", data[:100])
+            continue
+        token = event.get("token", "")
+        if token:
+            text += token
+            if on_partial is not None:
+                on_partial(text)
+    return text
+
+
+class KoboldBalancer:
+    """Распределяет генерации между несколькими Kobold-совместимыми бэкендами.
+
+    Режимы:
+      least_outstanding — бэкенд с наименьшим числом незавершённых запросов
+                          на единицу веса;
+      sticky            — чат закрепляется за бэкендом, чтобы повторно
+                          использовать кэш промпта на сервере; при
+                          недоступности бэкенда чат переезжает на другой.
+    Недоступные бэкенды (по данным монитора или после ошибки соединения)
+    исключаются из выбора, пока проверка не покажет их восстановление.
+    """
+
+    def __init__(self, backends, mode="least_outstanding", sticky_size=4096):
+        self.backends = backends
+        self.mode = mode
+        self.specs = None
+        self._sticky = LRUCache(sticky_size)
+
+    def describe(self):
+        return ", ".join(backend.base_url for backend in self.backends)
+
+    def available(self, exclude=()):
+        """Доступные бэкенды, кроме перечисленных в exclude."""
+        return [backend for backend in self.backends if backend.is_available() and backend not in exclude]
+
+    def choose(self, chat_id, exclude=()):
+        """Выбирает бэкенд для генерации или возвращает None, если подходящих нет."""
+        candidates = self.available(exclude)
+        if not candidates:
+            return None
+        if self.mode == "sticky":
+            url = self._sticky.get(chat_id)
+            for backend in candidates:
+                if backend.base_url == url:
+                    return backend
+        backend = min(candidates, key=lambda b: (b.outstanding / max(b.weight, 0.01), -b.weight))
+        if self.mode == "sticky":
+            self._sticky.set(chat_id, backend.base_url)
+            logger.info("Чат %s закреплён за бэкендом %s", chat_id, backend.base_url)
+        return backend
+
+    async def wait_until_healthy(self, timeout):
+        """Ждёт восстановления хотя бы одного бэкенда не дольше timeout секунд."""
+        if self.available():
+            return True
+        tasks = [asyncio.create_task(backend.wait_until_healthy(timeout)) for backend in self.backends]
+        try:
+            for future in asyncio.as_completed(tasks):
+                if await future:
+                    return True
+            return False
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+# Бэкенды по URL генерации
+_backends = {}
+_balancer = None
+# Убранные из конфигурации бэкенды, на которых ещё выполняются запросы, и задачи их закрытия
+_retired = set()
+_closing = set()
+
+
+def _close_retired(backend):
+    """Закрывает убранный бэкенд в фоне после завершения его последнего запроса."""
+    if backend not in _retired:
+        return
+    _retired.discard(backend)
+    task = asyncio.get_running_loop().create_task(backend.close())
+    _closing.add(task)
+    task.add_done_callback(_closing.discard)
+
+
+def _backend_options(config):
+    return {
+        "connection_limit": config.get("kobold_connection_limit", 10),
+        "dns_cache_ttl": config.get("kobold_dns_cache_ttl", 300),
+        "keepalive_timeout": config.get("kobold_keepalive_timeout", 60),
+        "health_interval": config.get("kobold_health_interval", 30),
+        "health_retry_interval": config.get("kobold_health_retry_interval", 5),
+        "health_timeout": config.get("kobold_health_timeout", 5),
+    }
+
+
+def backend_specs(config):
+    """Список (url, вес, ёмкость) из kobold_backends или из единственного kobold_api_url."""
+    default_capacity = config.get("kobold_max_in_flight", 1)
+    specs = config.get("kobold_backends") or [config["kobold_api_url"]]
+    result = []
+    for spec in specs:
+        if isinstance(spec, str):
+            spec = {"url": spec}
+        result.append((spec["url"], spec.get("weight", 1), spec.get("capacity", default_capacity)))
+    return result
+
+
+async def start_backends(config):
+    """Создаёт сессии для бэкендов из конфигурации и запускает их мониторинг (вызывается из main)."""
+    await get_balancer(config)
+
+
+async def get_balancer(config):
+    """Возвращает балансировщик для текущего списка бэкендов, пересоздавая его при изменении конфигурации."""
+    global _balancer
+    specs = backend_specs(config)
+    if _balancer is None or _balancer.specs != specs:
+        backends = []
+        for url, weight, capacity in specs:
+            backend = _backends.get(url)
+            if backend is None:
+                backend = KoboldBackend(url, **_backend_options(config))
+                _backends[url] = backend
+            backend.weight = weight
+            backend.capacity = capacity
+            await backend.start()
+            backend.start_monitor()
+            backends.append(backend)
+        # Убранные из конфигурации бэкенды закрываем сразу или после завершения их последнего запроса
+        for url, backend in list(_backends.items()):
+            if backend not in backends:
+                del _backends[url]
+                if backend.outstanding:
+                    backend.retired = True
+                    _retired.add(backend)
+                else:
+                    await backend.close()
+        _balancer = KoboldBalancer(backends)
+        _balancer.specs = specs
+        logger.info("Бэкенды Kobold: %s", _balancer.describe())
+    # Стабильный префикс промпта имеет смысл, только если чат всегда попадает на тот же сервер
+    if config.get("stable_prompt_prefix", False):
+        _balancer.mode = "sticky"
+    else:
+        _balancer.mode = config.get("kobold_balancer_mode", "least_outstanding")
+    return _balancer
+
+
+async def close_backends():
+    """Закрывает сессии всех бэкендов (вызывается при остановке бота)."""
+    global _balancer
+    _balancer = None
+    while _backends:
+        _, backend = _backends.popitem()
+        await backend.close()
+    while _retired:
+        await _retired.pop().close()
+    if _closing:
+        await asyncio.gather(*_closing, return_exceptions=True)
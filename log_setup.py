@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# log_setup.py
+import atexit
+import logging
+import logging.handlers
+import queue
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+AI_DETAILS_FORMAT = '%(asctime)s - %(levelname)s - \n%(message)s\n' + '-' * 50
+
+# Логгер детальных запросов и ответов ИИ пишет в отдельный файл
+AI_DETAILS_LOGGER = "ai_details"
+
+_listener = None
+# Логгеры, которым уровень задан из log_levels
+_configured_levels = set()
+
+
+def _is_ai_details(record):
+    return record.name == AI_DETAILS_LOGGER
+
+
+def _is_not_ai_details(record):
+    return record.name != AI_DETAILS_LOGGER
+
+
+def setup_logging(log_file="bot.log", ai_details_file="ai_details.log", level=logging.INFO):
+    """Настраивает логирование через очередь.
+
+    Логгеры только кладут записи в очередь, а запись в файлы и консоль
+    выполняет отдельный поток QueueListener, поэтому ввод-вывод не
+    блокирует цикл событий. Повторный вызов ничего не меняет.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    file_handler = logging.FileHandler(log_file, encoding="utf-8")
+    file_handler.setFormatter(formatter)
+    file_handler.addFilter(_is_not_ai_details)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    stream_handler.addFilter(_is_not_ai_details)
+    ai_details_handler = logging.FileHandler(ai_details_file, encoding="utf-8")
+    ai_details_handler.setFormatter(logging.Formatter(AI_DETAILS_FORMAT))
+    ai_details_handler.addFilter(_is_ai_details)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    ai_details_logger = logging.getLogger(AI_DETAILS_LOGGER)
+    ai_details_logger.setLevel(logging.INFO)
+    ai_details_logger.addHandler(queue_handler)
+    ai_details_logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, ai_details_handler)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def configure_log_levels(config):
+    """Применяет уровни из конфигурации: log_level для всех и log_levels {"модуль": "УРОВЕНЬ"}.
+
+    Имена логгеров совпадают с именами модулей (utils, kobold, translation, ...);
+    главный модуль бота — "__main__".
+    """
+    try:
+        logging.getLogger().setLevel(str(config.get("log_level", "INFO")).upper())
+    except ValueError as e:
+        logging.getLogger(__name__).warning(f"Неверный log_level: {e}")
+    levels = config.get("log_levels", {})
+    # Модули, убранные из log_levels, снова наследуют общий уровень
+    for name in _configured_levels - set(levels):
+        logging.getLogger(name).setLevel(logging.NOTSET)
+    _configured_levels.clear()
+    for name, level in levels.items():
+        try:
+            logging.getLogger(name).setLevel(str(level).upper())
+            _configured_levels.add(name)
+        except ValueError as e:
+            logging.getLogger(__name__).warning(f"Неверный уровень логирования для {name}: {e}")
+
+
+def stop_logging():
+    """Дописывает оставшиеся записи и останавливает поток логирования."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
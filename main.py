@@ -4,78 +4,147 @@ import asyncio
 import json
 import logging
 import os
-import re
-import tempfile
+import time
 import locale
 from telebot.async_telebot import AsyncTeleBot
-from utils import (manage_config, init_db, load_context, save_context, clear_context,
+from storage import close_storages
+from kobold import start_backends, close_backends
+from scheduler import priority_for, scheduler_stats
+from webhook import WebhookServer
+from outbound import OutboundDispatcher
+from transcription import TranscriptionError, telegram_file_chunks
+from tracing import ReplyTrace, trace_stage, save_trace, recent_traces, format_stages
+from payload import configure_payload
+from log_setup import setup_logging, configure_log_levels, stop_logging
+from metrics import (instrument_telegram, start_metrics_server, stop_metrics_server, ERRORS_TOTAL,
+                     REQUEST_QUEUE_DEPTH, REQUEST_QUEUE_CHATS, SCHEDULER_QUEUE_DEPTH, GENERATIONS_ACTIVE)
+from request_queue import RequestQueue, OrderedStage, WorkItem, COALESCED, REJECTED_BUSY, REJECTED_FULL
+from utils import (manage_config, init_db, ensure_context, clear_context,
                   get_user_translate_enabled, set_user_translate_enabled,
                   get_ai_translate_enabled, set_ai_translate_enabled,
                   get_memory, set_memory, generate_response_async, split_message,
                   get_character_name, set_character_name, translate_text, is_english,
-                  get_user_character_name, set_user_character_name, get_avg_response_time, temp_message_livetime,
-                  save_context_to_file, add_system_prompt, remove_system_prompt, get_selected_extension, set_selected_extension,
-                  get_show_english, set_show_english)
+                  get_user_character_name, set_user_character_name, temp_message_livetime, requested_max_length,
+                  save_context_to_file, get_selected_extension, set_selected_extension,
+                  get_show_english, set_show_english, translation_service, transcription_service, response_stats)
 
 # При ошибке SSL: CERTIFICATE_VERIFY_FAILED certificate verify failed: unable to get local issuer certificate (_ssl.c:1129)')
 # pip install pip-system-certs
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("bot.log", encoding="utf-8"),
-        logging.StreamHandler()
-    ]
-)
+# Настройка логирования: запись в файлы выполняет отдельный поток
+setup_logging()
 logger = logging.getLogger(__name__)
 
-# Создаём словарь для хранения блокировок по chat_id
-generation_locks = {}
-
-async def check_and_lock_generation(chat_id, message):
-    """Проверяет, идёт ли генерация для chat_id, и устанавливает блокировку. Возвращает True, если можно продолжать."""
-    if chat_id not in generation_locks:
-        generation_locks[chat_id] = asyncio.Lock()
-    
-    if generation_locks[chat_id].locked():
-        await bot.reply_to(message, "Генерация ответа уже идёт, подождите немного!")
-        logger.info(f"Генерация для chat_id: {chat_id} заблокирована, уже выполняется")
-        return False
-    
-    # Если генерация не идёт, возвращаем True и оставляем блокировку для использования в вызывающем коде
-    return True
+# Очередь запросов на генерацию по chat_id (создаётся в main)
+request_queue = None
+
+# Отправка сообщений с учётом лимитов Telegram (создаётся в main)
+outbound = None
+
+# Фоновые задачи, на которые нужно держать ссылку до их завершения
+background_tasks = set()
+
+class StatusEditor:
+    """Постепенно показывает частичный ответ в сообщении о статусе.
+
+    Правки отправляются не чаще одного раза в interval секунд: промежуточные
+    обновления склеиваются, и в Telegram уходит только последний текст.
+    """
+
+    def __init__(self, chat_id, message_id, header, interval=1.5):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.header = header
+        self.interval = interval
+        self._latest = None
+        self._shown = None
+        self._last_edit = 0.0
+        self._editing = False
+        self._task = None
+
+    def update(self, text):
+        """Запоминает новый частичный текст и планирует правку сообщения."""
+        self._latest = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+
+    def _render(self, text):
+        body = text.strip()
+        # Лимит Telegram — 4096 символов, показываем хвост текста
+        limit = 4000 - len(self.header)
+        if len(body) > limit:
+            body = "…" + body[-limit:]
+        return f"{self.header}\n\n{body} ▌"
+
+    async def _flush(self):
+        delay = self.interval - (time.monotonic() - self._last_edit)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        text = self._render(self._latest)
+        if text == self._shown:
+            return
+        self._editing = True
+        try:
+            await outbound.edit_message_text(text=text, chat_id=self.chat_id, message_id=self.message_id)
+            self._shown = text
+        except Exception as e:
+            logger.warning("Не удалось обновить частичный ответ в chat_id: %s: %s", self.chat_id, e)
+        finally:
+            self._editing = False
+            self._last_edit = time.monotonic()
+
+    async def finish(self):
+        """Останавливает правки: ожидающая отменяется, уже отправленная дожидается."""
+        if self._task is None or self._task.done():
+            return
+        if self._editing:
+            await asyncio.wait([self._task])
+        else:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
 
 async def monitor_config(config_path, interval=10):
     """Периодически проверяет изменения в файле конфигурации и обновляет глобальный config."""
     global config
     last_mtime = os.path.getmtime(config_path)
-    logger.info(f"Запущено сканирование файла конфигурации: {config_path} с интервалом {interval} сек")
+    logger.info("Запущено сканирование файла конфигурации: %s с интервалом %s сек", config_path, interval)
 
     while True:
         try:
             current_mtime = os.path.getmtime(config_path)
             if current_mtime != last_mtime:
-                logger.info(f"Обнаружено изменение файла конфигурации: {config_path}")
+                logger.info("Обнаружено изменение файла конфигурации: %s", config_path)
                 with open(config_path, 'r', encoding='utf-8') as f:
                     new_config = json.load(f)
                 config.update(new_config)  # Обновляем существующий config
+                if request_queue is not None:
+                    request_queue.configure(config)
+                if outbound is not None:
+                    outbound.configure(config)
+                configure_payload(config)
+                configure_log_levels(config)
+                translation_service.configure(config)
+                transcription_service.configure(config)
+                response_stats.configure(config)
                 last_mtime = current_mtime
                 logger.info("Конфигурация успешно обновлена")
             await asyncio.sleep(interval)
         except FileNotFoundError:
-            logger.error(f"Файл конфигурации {config_path} не найден. Ожидание восстановления...")
+            logger.error("Файл конфигурации %s не найден. Ожидание восстановления...", config_path)
             await asyncio.sleep(interval)
         except json.JSONDecodeError as e:
-            logger.error(f"Ошибка декодирования JSON в файле {config_path}: {str(e)}. Используется предыдущая конфигурация.")
+            logger.error("Ошибка декодирования JSON в файле %s: %s. Используется предыдущая конфигурация.",
+                         config_path, e)
             await asyncio.sleep(interval)
         except Exception as e:
-            logger.error(f"Ошибка при сканировании конфига: {str(e)}")
+            logger.error("Ошибка при сканировании конфига: %s", e)
             await asyncio.sleep(interval)
             
 async def main():
-    global bot, config  # Делаем bot и config глобальными для использования в check_and_lock_generation
+    global bot, config, request_queue, outbound  # Делаем bot, config, очередь и отправку глобальными для использования вне main
     config = {}
     try:
         logger.info("Запуск инициализации бота")
@@ -89,10 +158,30 @@ async def main():
         try:
             init_db()  # Проверяет структуру или создаёт базу
         except SystemExit as e:
-            logger.error(f"Программа завершена из-за ошибки в базе данных: {e}")
+            logger.error("Программа завершена из-за ошибки в базе данных: %s", e)
             return  # Завершает main(), бот не запускается
+        # Статистика времени ответа восстанавливается из базы и дальше пишется пакетами
+        await response_stats.start()
+        # Модель распознавания речи загружается в фоне, не задерживая запуск бота
+        warm_up = asyncio.create_task(transcription_service.warm_up())
+        background_tasks.add(warm_up)
+        warm_up.add_done_callback(background_tasks.discard)
+        # Открываем постоянные HTTP-сессии к Kobold API
+        await start_backends(config)
+        # Метрики: задержки вызовов Telegram Bot API и HTTP-эндпоинт /metrics
+        instrument_telegram()
+        try:
+            await start_metrics_server(config)
+        except OSError as e:
+            logger.error("Не удалось запустить сервер метрик: %s", e)
+        SCHEDULER_QUEUE_DEPTH.set_function(lambda: {(s["backend"],): s["queue_depth"] for s in scheduler_stats()})
+        GENERATIONS_ACTIVE.set_function(lambda: {(s["backend"],): s["in_flight"] for s in scheduler_stats()})
+
         bot = AsyncTeleBot(config["telegram_token"])
         logger.info("Бот инициализирован с токеном")
+        # Все сообщения и правки отправляются через диспетчер с лимитами чатов и бота
+        outbound = OutboundDispatcher(bot)
+        outbound.configure(config)
 
         # Добавляем обработчик исключений для polling с перезапуском при TimeoutError
         async def polling_with_logging():
@@ -101,10 +190,10 @@ async def main():
                     logger.info("Начинаем polling")
                     await bot.polling(none_stop=True, timeout=60)  # Уменьшаем timeout до 60 секунд
                 except asyncio.TimeoutError as te:
-                    logger.error(f"TimeoutError в polling: {te}. Перезапуск через 5 секунд...")
+                    logger.error("TimeoutError в polling: %s. Перезапуск через 5 секунд...", te)
                     await asyncio.sleep(5)  # Задержка перед перезапуском
                 except Exception as e:
-                    logger.error(f"Неизвестная ошибка в polling: {e}", exc_info=True)
+                    logger.error("Неизвестная ошибка в polling: %s", e, exc_info=True)
                     await asyncio.sleep(5)  # Задержка перед перезапуском при других ошибках
                     raise  # Повторно выбрасываем исключение для обработки выше
 
@@ -112,20 +201,17 @@ async def main():
         async def handle_start(message):
             chat_id = message.chat.id
             username = message.from_user.username or "Unknown"
-            logger.info(f"Получена команда /start от chat_id: {chat_id}, username: {username}")
-            context = load_context(chat_id)
-            if not context:
-                context = add_system_prompt(config["system_prompt"])
-                save_context(chat_id, context)
-            await bot.reply_to(message, "Привет! Я Врок, весёлый ИИ. Напиши что-нибудь, и я отвечу с юмором!\n"
+            logger.info("Получена команда /start от chat_id: %s, username: %s", chat_id, username)
+            await ensure_context(chat_id, config)
+            await outbound.reply_to(message, "Привет! Я Врок, весёлый ИИ. Напиши что-нибудь, и я отвечу с юмором!\n"
                                        "Для списка команд используй /help.")
-            logger.info(f"Отправлено приветственное сообщение в chat_id: {chat_id}")
+            logger.info("Отправлено приветственное сообщение в chat_id: %s", chat_id)
 
         @bot.message_handler(commands=['help'])
         async def handle_help(message):
             chat_id = message.chat.id
             username = message.from_user.username or "Unknown"
-            logger.info(f"Получена команда /help от chat_id: {chat_id}, username: {username}")
+            logger.info("Получена команда /help от chat_id: %s, username: %s", chat_id, username)
             help_text = """
         Список команд бота:
         /help Показывает это сообщение со списком всех доступных команд.
@@ -139,159 +225,164 @@ async def main():
         /usertranslate Включает или выключает перевод ваших текстовых сообщений на английский перед отправкой ИИ. По умолчанию включён.
         /aitranslate Включает или выключает перевод ответов ИИ на русский. По умолчанию включён.
         /showenglish Включает/выключает отображение английского текста (переведённого текста и ответа ИИ до перевода).
+        /traces [N] [chat_id] Только для администраторов: время этапов последних N ответов (по умолчанию 5) этого или указанного чата.
         /start Запускает бота и отправляет приветственное сообщение. Инициализирует контекст разговора с системным промптом.
         - Голосовые сообщения Отправьте голосовое сообщение, и бот преобразует его в текст с помощью утилиты, покажет распознанный текст, а затем сгенерирует ответ ИИ с учётом текущего дополнения.
         - Текстовые сообщения Отправьте текст, и бот ответит с учётом контекста, настроек перевода и выбранного дополнения. Используйте "..." для продолжения без ввода.
             """
-            await bot.reply_to(message, help_text)
-            logger.info(f"Отправлен текст помощи в chat_id: {chat_id}")
+            await outbound.reply_to(message, help_text)
+            logger.info("Отправлен текст помощи в chat_id: %s", chat_id)
 
         @bot.message_handler(commands=['clear'])
         async def handle_clear(message):
             chat_id = message.chat.id
-            logger.info(f"Получена команда /clear от chat_id: {chat_id}")
-            status_message = await bot.reply_to(message, "Очищаю контекст...")
-            clear_context(chat_id)
-            await bot.edit_message_text(
+            logger.info("Получена команда /clear от chat_id: %s", chat_id)
+            status_message = await outbound.reply_to(message, "Очищаю контекст...")
+            await clear_context(chat_id)
+            await outbound.edit_message_text(
                 text="Контекст успешно очищен! Можете начать новый разговор.",
                 chat_id=message.chat.id,
                 message_id=status_message.message_id
             )
-            logger.info(f"Контекст очищен и сообщение обновлено для chat_id: {chat_id}")
+            logger.info("Контекст очищен и сообщение обновлено для chat_id: %s", chat_id)
 
         @bot.message_handler(commands=['usertranslate'])
         async def handle_user_translate(message):
             chat_id = message.chat.id
             username = message.from_user.username or "Unknown"
-            logger.info(f"Получена команда /usertranslate от chat_id: {chat_id}, username: {username}")
-            current_state = get_user_translate_enabled(chat_id)
+            logger.info("Получена команда /usertranslate от chat_id: %s, username: %s", chat_id, username)
+            current_state = await get_user_translate_enabled(chat_id)
             new_state = not current_state
-            set_user_translate_enabled(chat_id, new_state)
+            await set_user_translate_enabled(chat_id, new_state)
             state_text = "включён" if new_state else "выключен"
-            await bot.reply_to(message, f"Перевод сообщений пользователя на английский теперь {state_text}.")
-            logger.info(f"Перевод сообщений пользователя {state_text} для chat_id: {chat_id}")
+            await outbound.reply_to(message, f"Перевод сообщений пользователя на английский теперь {state_text}.")
+            logger.info("Перевод сообщений пользователя %s для chat_id: %s", state_text, chat_id)
 
         @bot.message_handler(commands=['aitranslate'])
         async def handle_ai_translate(message):
             chat_id = message.chat.id
             username = message.from_user.username or "Unknown"
-            logger.info(f"Получена команда /aitranslate от chat_id: {chat_id}, username: {username}")
-            current_state = get_ai_translate_enabled(chat_id)
+            logger.info("Получена команда /aitranslate от chat_id: %s, username: %s", chat_id, username)
+            current_state = await get_ai_translate_enabled(chat_id)
             new_state = not current_state
-            set_ai_translate_enabled(chat_id, new_state)
+            await set_ai_translate_enabled(chat_id, new_state)
             state_text = "включён" if new_state else "выключен"
-            await bot.reply_to(message, f"Перевод ответов ИИ на русский теперь {state_text}.")
-            logger.info(f"Перевод ответов ИИ {state_text} для chat_id: {chat_id}")
+            await outbound.reply_to(message, f"Перевод ответов ИИ на русский теперь {state_text}.")
+            logger.info("Перевод ответов ИИ %s для chat_id: %s", state_text, chat_id)
 
         @bot.message_handler(commands=['memory'])
         async def handle_memory(message):
             chat_id = message.chat.id
             username = message.from_user.username or "Unknown"
-            logger.info(f"Получена команда /memory от chat_id: {chat_id}, username: {username}")
+            logger.info("Получена команда /memory от chat_id: %s, username: %s", chat_id, username)
             command_text = message.text.strip()
 
             memory_input = command_text[len("/memory"):].strip()
             if memory_input:
-                user_translate_enabled = get_user_translate_enabled(chat_id)
+                user_translate_enabled = await get_user_translate_enabled(chat_id)
                 if user_translate_enabled and not is_english(memory_input):
-                    memory_en = translate_text(memory_input, to_english=True)
+                    memory_en = await translate_text(memory_input, to_english=True)
                 else:
                     memory_en = memory_input
-                set_memory(chat_id, memory_en)
-                await bot.reply_to(message, f"Установлено новое memory: {memory_en}")
-                logger.info(f"Установлено новое memory: {memory_en[:50]}... для chat_id: {chat_id}")
+                await set_memory(chat_id, memory_en)
+                await outbound.reply_to(message, f"Установлено новое memory: {memory_en}")
+                logger.info("Установлено новое memory: %s... для chat_id: %s", memory_en[:50], chat_id)
             else:
-                current_memory = get_memory(chat_id)
+                current_memory = await get_memory(chat_id)
                 if not current_memory:
                     current_memory = "You are a cheerful AI named Grok, always responding with a bit of humor."
-                await bot.reply_to(message, f"Текущее memory: {current_memory}")
-                logger.info(f"Отправлено текущее memory: {current_memory[:50]}... для chat_id: {chat_id}")
+                await outbound.reply_to(message, f"Текущее memory: {current_memory}")
+                logger.info("Отправлено текущее memory: %s... для chat_id: %s", current_memory[:50], chat_id)
 
         @bot.message_handler(commands=['character'])
         async def handle_character(message):
             chat_id = message.chat.id
             username = message.from_user.username or "Unknown"
-            logger.info(f"Получена команда /character от chat_id: {chat_id}, username: {username}")
+            logger.info("Получена команда /character от chat_id: %s, username: %s", chat_id, username)
             command_text = message.text.strip()
 
             character_input = command_text[len("/character"):].strip()
             if character_input:
                 # Проверяем, включён ли перевод запросов
-                user_translate_enabled = get_user_translate_enabled(chat_id)
+                user_translate_enabled = await get_user_translate_enabled(chat_id)
                 if user_translate_enabled and not is_english(character_input):
                     # Переводим имя персонажа на английский, если оно не на английском
-                    character_name_en = translate_text(character_input, to_english=True)
-                    logger.info(f"Имя персонажа переведено на английский: {character_name_en}")
+                    character_name_en = await translate_text(character_input, to_english=True)
+                    logger.info("Имя персонажа переведено на английский: %s", character_name_en)
                 else:
                     character_name_en = character_input
-                set_character_name(chat_id, character_name_en)
-                await bot.reply_to(message, f"Установлено новое имя персонажа: {character_name_en}")
-                logger.info(f"Установлено имя персонажа: {character_name_en} для chat_id: {chat_id}")
+                await set_character_name(chat_id, character_name_en)
+                await outbound.reply_to(message, f"Установлено новое имя персонажа: {character_name_en}")
+                logger.info("Установлено имя персонажа: %s для chat_id: %s", character_name_en, chat_id)
             else:
-                current_character = get_character_name(chat_id)
-                await bot.reply_to(message, f"Текущее имя персонажа: {current_character}")
-                logger.info(f"Отправлено текущее имя персонажа: {current_character} для chat_id: {chat_id}")
+                current_character = await get_character_name(chat_id)
+                await outbound.reply_to(message, f"Текущее имя персонажа: {current_character}")
+                logger.info("Отправлено текущее имя персонажа: %s для chat_id: %s", current_character, chat_id)
 
         @bot.message_handler(commands=['usercharacter'])
         async def handle_user_character(message):
             chat_id = message.chat.id
             username = message.from_user.username or "Unknown"
-            logger.info(f"Получена команда /usercharacter от chat_id: {chat_id}, username: {username}")
+            logger.info("Получена команда /usercharacter от chat_id: %s, username: %s", chat_id, username)
             command_text = message.text.strip()
 
             user_character_input = command_text[len("/usercharacter"):].strip()
             if user_character_input:
                 # Проверяем, включён ли перевод запросов
-                user_translate_enabled = get_user_translate_enabled(chat_id)
+                user_translate_enabled = await get_user_translate_enabled(chat_id)
                 if user_translate_enabled and not is_english(user_character_input):
                     # Переводим имя пользователя на английский, если оно не на английском
-                    user_character_name_en = translate_text(user_character_input, to_english=True)
-                    logger.info(f"Имя пользователя переведено на английский: {user_character_name_en}")
+                    user_character_name_en = await translate_text(user_character_input, to_english=True)
+                    logger.info("Имя пользователя переведено на английский: %s", user_character_name_en)
                 else:
                     user_character_name_en = user_character_input
-                set_user_character_name(chat_id, user_character_name_en)
-                await bot.reply_to(message, f"Установлено новое имя пользователя: {user_character_name_en}: ")
-                logger.info(f"Установлено имя пользователя: {user_character_name_en} для chat_id: {chat_id}")
+                await set_user_character_name(chat_id, user_character_name_en)
+                await outbound.reply_to(message, f"Установлено новое имя пользователя: {user_character_name_en}: ")
+                logger.info("Установлено имя пользователя: %s для chat_id: %s", user_character_name_en, chat_id)
             else:
-                current_user_character = get_user_character_name(chat_id)
-                await bot.reply_to(message, f"Текущее имя пользователя: {current_user_character}: ")
-                logger.info(f"Отправлено текущее имя пользователя: {current_user_character} для chat_id: {chat_id}")
+                current_user_character = await get_user_character_name(chat_id)
+                await outbound.reply_to(message, f"Текущее имя пользователя: {current_user_character}: ")
+                logger.info("Отправлено текущее имя пользователя: %s для chat_id: %s", current_user_character, chat_id)
 
         @bot.message_handler(commands=['getcontext'])
         async def handle_get_context(message):
             chat_id = message.chat.id
             username = message.from_user.username or "Unknown"
-            logger.info(f"Получена команда /getcontext от chat_id: {chat_id}, username: {username}")
+            logger.info("Получена команда /getcontext от chat_id: %s, username: %s", chat_id, username)
             
             # Передаём config как есть, он нужен для других целей в save_context_to_file
-            file_path = save_context_to_file(chat_id, config)
+            file_path = await save_context_to_file(chat_id, config)
             
             if file_path is None:
-                await bot.reply_to(message, "Контекст пуст или содержит только системный промпт. Начните разговор, чтобы создать контекст!")
-                logger.info(f"Контекст пуст для chat_id: {chat_id}")
+                await outbound.reply_to(message, "Контекст пуст или содержит только системный промпт. Начните разговор, чтобы создать контекст!")
+                logger.info("Контекст пуст для chat_id: %s", chat_id)
                 return
             
+            async def send_context_file():
+                # Файл открывается заново при каждой попытке отправки
+                with open(file_path, 'rb') as file:
+                    return await bot.send_document(chat_id=chat_id, document=file, caption="Ваш текущий контекст")
+
             try:
                 # Отправляем файл пользователю
-                with open(file_path, 'rb') as file:
-                    await bot.send_document(chat_id=chat_id, document=file, caption="Ваш текущий контекст")
-                logger.info(f"Файл контекста отправлен в chat_id: {chat_id}")
+                await outbound.call(chat_id, send_context_file)
+                logger.info("Файл контекста отправлен в chat_id: %s", chat_id)
             except Exception as e:
-                logger.error(f"Ошибка при отправке файла: {e}", exc_info=True)
-                await bot.reply_to(message, "Произошла ошибка при отправке файла контекста.")
+                logger.error("Ошибка при отправке файла: %s", e, exc_info=True)
+                await outbound.reply_to(message, "Произошла ошибка при отправке файла контекста.")
             finally:
                 # Удаляем временный файл
                 try:
                     os.remove(file_path)
-                    logger.info(f"Временный файл удалён: {file_path}")
+                    logger.info("Временный файл удалён: %s", file_path)
                 except Exception as e:
-                    logger.warning(f"Не удалось удалить временный файл {file_path}: {e}")
+                    logger.warning("Не удалось удалить временный файл %s: %s", file_path, e)
 
         @bot.message_handler(commands=['extension'])
         async def handle_extension(message):
             chat_id = message.chat.id
             username = message.from_user.username or "Unknown"
-            logger.info(f"Получена команда /extension от chat_id: {chat_id}, username: {username}")
+            logger.info("Получена команда /extension от chat_id: %s, username: %s", chat_id, username)
 
             # Извлекаем аргумент команды
             args = message.text.split(maxsplit=1)[1:]  # Пропускаем "/extension"
@@ -301,8 +392,8 @@ async def main():
                 # Если аргументов нет, показываем только несекретные расширения
                 visible_extensions = [ext for ext in extensions if not ext.get("hidden", False)]
                 if not visible_extensions:
-                    await bot.reply_to(message, "Нет видимых дополнений. Используйте /extension xxx для полного списка.")
-                    logger.info(f"Нет видимых дополнений для chat_id: {chat_id}")
+                    await outbound.reply_to(message, "Нет видимых дополнений. Используйте /extension xxx для полного списка.")
+                    logger.info("Нет видимых дополнений для chat_id: %s", chat_id)
                     return
                 
                 # Формируем список видимых дополнений
@@ -310,10 +401,10 @@ async def main():
                     [f"- {ext['name']}: {ext.get('short_description', '')}" if ext.get('short_description') 
                      else f"- {ext['name']}" for ext in visible_extensions]
                 )
-                current_extension = get_selected_extension(chat_id)
+                current_extension = await get_selected_extension(chat_id)
                 current_status = f"\n\nТекущее дополнение: {current_extension or 'не выбрано'}"
-                await bot.reply_to(message, f"Доступные дополнения:\n{extension_list}{current_status}\n\nИспользуйте /extension <имя> для выбора.")
-                logger.info(f"Показаны видимые дополнения для chat_id: {chat_id}")
+                await outbound.reply_to(message, f"Доступные дополнения:\n{extension_list}{current_status}\n\nИспользуйте /extension <имя> для выбора.")
+                logger.info("Показаны видимые дополнения для chat_id: %s", chat_id)
                 return
 
             # Проверяем, является ли аргумент "xxx" или "ххх" (независимо от регистра)
@@ -321,7 +412,7 @@ async def main():
             if arg in ["xxx", "ххх"]:
                 # Если аргумент "xxx" или "ххх", показываем все дополнения
                 if not extensions:
-                    await bot.reply_to(message, "Список дополнений пуст. Добавьте их в config.json.")
+                    await outbound.reply_to(message, "Список дополнений пуст. Добавьте их в config.json.")
                     return
                 
                 # Формируем полный список с указанием скрытых
@@ -330,10 +421,10 @@ async def main():
                      if ext.get('short_description') else f"- {ext['name']}{' (скрыто)' if ext.get('hidden', False) else ''}" 
                      for ext in extensions]
                 )
-                current_extension = get_selected_extension(chat_id)
+                current_extension = await get_selected_extension(chat_id)
                 current_status = f"\n\nТекущее дополнение: {current_extension or 'не выбрано'}"
-                await bot.reply_to(message, f"Все доступные дополнения:\n{extension_list}{current_status}\n\nИспользуйте /extension <имя> для выбора.")
-                logger.info(f"Показан полный список дополнений для chat_id: {chat_id}")
+                await outbound.reply_to(message, f"Все доступные дополнения:\n{extension_list}{current_status}\n\nИспользуйте /extension <имя> для выбора.")
+                logger.info("Показан полный список дополнений для chat_id: %s", chat_id)
                 return
             
             # Если аргумент не "xxx" и не "ххх", проверяем, указано ли существующее дополнение
@@ -341,310 +432,340 @@ async def main():
             selected_extension = next((ext for ext in extensions if ext["name"].lower() == extension_name.lower()), None)
 
             if not selected_extension:
-                await bot.reply_to(message, f"Дополнение '{extension_name}' не найдено. Используйте /extension xxx для полного списка.")
-                logger.info(f"Дополнение '{extension_name}' не найдено для chat_id: {chat_id}")
+                await outbound.reply_to(message, f"Дополнение '{extension_name}' не найдено. Используйте /extension xxx для полного списка.")
+                logger.info("Дополнение '%s' не найдено для chat_id: %s", extension_name, chat_id)
                 return
 
             # Сохраняем выбранное расширение в базу данных
-            current_extension = get_selected_extension(chat_id)
+            current_extension = await get_selected_extension(chat_id)
             if current_extension and current_extension.lower() == selected_extension["name"].lower():
-                await bot.reply_to(message, f"Дополнение '{selected_extension['name']}' уже активно.")
+                await outbound.reply_to(message, f"Дополнение '{selected_extension['name']}' уже активно.")
                 return
 
-            set_selected_extension(chat_id, selected_extension["name"])
-            logger.info(f"Выбрано дополнение '{selected_extension['name']}' для chat_id: {chat_id}")
-            await bot.reply_to(message, f"Дополнение '{selected_extension['name']}' активировано.")
+            await set_selected_extension(chat_id, selected_extension["name"])
+            logger.info("Выбрано дополнение '%s' для chat_id: %s", selected_extension['name'], chat_id)
+            await outbound.reply_to(message, f"Дополнение '{selected_extension['name']}' активировано.")
             
         @bot.message_handler(commands=['showenglish'])
         async def handle_show_english(message):
             chat_id = message.chat.id
             username = message.from_user.username or "Unknown"
-            logger.info(f"Получена команда /showenglish от chat_id: {chat_id}, username: {username}")
-            current_state = get_show_english(chat_id)
+            logger.info("Получена команда /showenglish от chat_id: %s, username: %s", chat_id, username)
+            current_state = await get_show_english(chat_id, config)
             new_state = not current_state
-            set_show_english(chat_id, new_state)
+            await set_show_english(chat_id, new_state)
             state_text = "включено" if new_state else "выключено"
-            await bot.reply_to(message, f"Отображение английского текста теперь {state_text}.")
-            logger.info(f"Show_english для chat_id: {chat_id} установлен в {new_state}")
+            await outbound.reply_to(message, f"Отображение английского текста теперь {state_text}.")
+            logger.info("Show_english для chat_id: %s установлен в %s", chat_id, new_state)
     
-        @bot.message_handler(commands=['continue'])
-        async def handle_continue(message):
+        @bot.message_handler(commands=['traces'])
+        async def handle_traces(message):
             chat_id = message.chat.id
-            logger.info(f"Получена команда /continue от chat_id: {chat_id}")
-            context = load_context(chat_id)
-            logger.info(f"Загружен контекст: {context[:100]}...")
-            if not context:
-                context = add_system_prompt(config["system_prompt"])
-                logger.info("Используется системный промпт как контекст с разделителями")
-
-            # Проверяем блокировку
-            if not await check_and_lock_generation(chat_id, message):
+            user_id = message.from_user.id
+            logger.info("Получена команда /traces от chat_id: %s, user_id: %s", chat_id, user_id)
+            if user_id not in config.get("admin_ids", []):
+                await outbound.reply_to(message, "Команда доступна только администраторам бота.")
                 return
+            # /traces [N] [chat_id]: последние N трассировок этого или указанного чата
+            args = message.text.split()[1:]
+            limit = 5
+            target_chat_id = chat_id
+            try:
+                if args:
+                    limit = max(1, min(int(args[0]), 20))
+                if len(args) > 1:
+                    target_chat_id = int(args[1])
+            except ValueError:
+                await outbound.reply_to(message, "Использование: /traces [N] [chat_id]")
+                return
+            traces = await recent_traces(target_chat_id, limit)
+            if not traces:
+                await outbound.reply_to(message, f"Для чата {target_chat_id} трассировок пока нет.")
+                return
+            lines = [f"Последние ответы чата {target_chat_id} (время этапов в секундах):"]
+            for timestamp, kind, total, stages in traces:
+                moment = time.strftime("%d.%m %H:%M:%S", time.localtime(timestamp))
+                lines.append(f"\n{moment} {kind}: всего {total:.2f} сек\n{format_stages(stages)}")
+            await outbound.reply_to(message, "\n".join(lines))
+            logger.info("Отправлены трассировки чата %s в chat_id: %s", target_chat_id, chat_id)
+
+        def eta_text(chat_id, text="", ahead=0):
+            """Строка с ожидаемым временем ответа или пустая строка, если статистики мало."""
+            max_length = requested_max_length(text, config)[0] if text else config["max_length"]
+            # Генерации других чатов, ожидающие места на бэкендах, в пересчёте на одно место
+            stats = scheduler_stats()
+            capacity = sum(s["max_in_flight"] for s in stats) or 1
+            backlog = sum(s["queue_depth"] for s in stats) / capacity
+            estimate = response_stats.estimate(chat_id, max_length, ahead, backlog)
+            if estimate is None:
+                return ""
+            if estimate.scope == "chat":
+                basis = f"на основе {estimate.count} предыдущих ответов"
+            else:
+                basis = f"по {estimate.count} последним ответам всех чатов"
+            return f"\nОжидаемое время ответа: {estimate.eta:.1f} сек ({basis})"
 
-            async with generation_locks[chat_id]:
-                # Получаем среднее время генерации
-                avg_time, count = get_avg_response_time(chat_id)
-                status_text = "Продолжаю историю, пожалуйста, подождите..."
-                if avg_time:
-                    status_text += f"\nСреднее время ответа: {avg_time:.2f} сек (на основе {count} предыдущих ответов)"
-
-                status_message = await bot.reply_to(message, status_text)
-                logger.info(f"Отправлено сообщение о статусе в chat_id: {chat_id}, message_id: {status_message.message_id}")
-                ai_response, text_en, response_en, character_name, character_prompt, response_time = await generate_response_async(
-                    "", config, chat_id, context, get_user_translate_enabled(chat_id), get_ai_translate_enabled(chat_id), continue_only=True
-                )
-                logger.info(f"Сгенерирован ответ: {ai_response[:100]}...")
+        def queue_status_text(item, position):
+            return (f"Запрос в очереди, позиция: {position}. Ответ начнётся после завершения предыдущих."
+                    + eta_text(item.chat_id, item.text, position))
 
-                # Контекст обновляется в generate_response_async, здесь только отправляем ответ
-                message_parts = split_message(ai_response)
-                logger.info(f"Сообщение разбито на {len(message_parts)} частей: {message_parts[0][:50]}...")
-                await bot.edit_message_text(
+        def generation_status_text(item):
+            """Текст сообщения о статусе с ожидаемым временем ответа."""
+            kind = item.kind
+            if kind == "continue":
+                status_text = "Продолжаю историю, пожалуйста, подождите..."
+            elif kind == "voice":
+                status_text = "Генерация ответа, подождите..."
+            else:
+                status_text = "Генерирую ответ, пожалуйста, подождите..."
+            return status_text + eta_text(item.chat_id, item.text)
+
+        async def show_status(item, text):
+            """Показывает статус запроса: правит сообщение о статусе из очереди или отправляет новое."""
+            if item.status_message_id is None:
+                status_message = await outbound.reply_to(item.message, text)
+                item.attach_status(status_message.message_id, text)
+                logger.debug("Отправлено сообщение о статусе в chat_id: %s, message_id: %s", item.chat_id, status_message.message_id)
+            elif item.status_text != text:
+                await outbound.edit_message_text(text=text, chat_id=item.chat_id, message_id=item.status_message_id)
+                item.status_text = text
+            return item.status_message_id
+
+        async def notify_queue_position(item, position):
+            """Обновляет позицию ожидающего запроса в его сообщении о статусе."""
+            if item.started or item.status_message_id is None:
+                return
+            text = queue_status_text(item, position)
+            if text != item.status_text:
+                await outbound.edit_message_text(text=text, chat_id=item.chat_id, message_id=item.status_message_id)
+                item.status_text = text
+
+        async def send_temp_message(chat_id, text):
+            """Отправляет сообщение и удаляет его через temp_message_livetime секунд."""
+            temp_message = await outbound.send_message(chat_id=chat_id, text=text)
+            logger.debug("Отправлено временное сообщение в chat_id: %s, message_id: %s", chat_id, temp_message.message_id)
+            await asyncio.sleep(temp_message_livetime(config))
+            try:
+                await outbound.delete_message(chat_id=chat_id, message_id=temp_message.message_id)
+                logger.debug("Временное сообщение удалено в chat_id: %s, message_id: %s", chat_id, temp_message.message_id)
+            except Exception as e:
+                logger.warning("Не удалось удалить временное сообщение: %s", e)
+
+        def schedule_temp_message(chat_id, text):
+            # Ожидание удаления не должно задерживать следующий запрос из очереди
+            task = asyncio.create_task(send_temp_message(chat_id, text))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+
+        async def generate_and_reply(item, text, status_text, trace=None):
+            """Генерирует ответ, показывая частичный текст в сообщении о статусе, и отправляет его."""
+            chat_id = item.chat_id
+            status_message_id = await show_status(item, status_text)
+            editor = StatusEditor(chat_id, status_message_id, status_text, config.get("stream_edit_interval", 1.5))
+            ai_translate_enabled = await get_ai_translate_enabled(chat_id)
+            # Частичный ответ — английский черновик до перевода: показываем его, только если включён show_english
+            show_partial = not ai_translate_enabled or await get_show_english(chat_id, config)
+            ai_response, text_en, response_en, character_name, character_prompt, response_time = await generate_response_async(
+                text, config, chat_id, await get_user_translate_enabled(chat_id), ai_translate_enabled,
+                continue_only=item.kind == "continue", on_partial=editor.update if show_partial else None,
+                priority=priority_for(item.kind, config), trace=trace
+            )
+            await editor.finish()
+            logger.debug("Сгенерирован ответ: %s...", ai_response[:100])
+
+            # Контекст обновляется в generate_response_async, здесь только отправляем ответ
+            message_parts = split_message(ai_response)
+            logger.debug("Сообщение разбито на %s частей: %s...", len(message_parts), message_parts[0][:50])
+            with trace_stage(trace, "telegram_send"):
+                await outbound.edit_message_text(
                     text=message_parts[0],
-                    chat_id=message.chat.id,
-                    message_id=status_message.message_id
+                    chat_id=chat_id,
+                    message_id=status_message_id
                 )
-                logger.info(f"Сообщение статуса отредактировано для chat_id: {chat_id}")
+                logger.debug("Сообщение статуса отредактировано для chat_id: %s", chat_id)
                 for part in message_parts[1:]:
-                    await bot.send_message(chat_id=message.chat.id, text=part)
-                    logger.info(f"Отправлена дополнительная часть в chat_id: {chat_id}")
+                    await outbound.send_message(chat_id=chat_id, text=part)
+                    logger.debug("Отправлена дополнительная часть в chat_id: %s", chat_id)
 
-            # Отправляем временное сообщение о завершении генерации
-            temp_message = await bot.send_message(
-                chat_id=message.chat.id,
-                text=f"Генерация завершена за {response_time:.2f} сек"
-            )
-            logger.info(f"Отправлено временное сообщение о завершении в chat_id: {chat_id}, message_id: {temp_message.message_id}")
-            
-            # Удаляем сообщение через temp_message_livetime секунд
-            await asyncio.sleep(temp_message_livetime(config))
+            # Временное сообщение о завершении генерации удаляется в фоне
+            schedule_temp_message(chat_id, f"Генерация завершена за {response_time:.2f} сек")
+
+        async def transcribe_voice(message, trace=None):
+            """Этап распознавания: скачивает голосовое сообщение и распознаёт его. Возвращает текст или None."""
+            chat_id = message.chat.id
+            status_message = await outbound.reply_to(message, "Преобразование речи в текст, подождите...")
+            logger.debug("Статус преобразования в chat_id: %s, message_id: %s", chat_id, status_message.message_id)
+
+            with trace_stage(trace, "transcription"):
+                file_info = await bot.get_file(message.voice.file_id)
+                try:
+                    # Файл скачивается частями прямо в бэкенд распознавания
+                    clean_text = await transcription_service.transcribe_stream(
+                        telegram_file_chunks(bot.token, file_info.file_path), file_info.file_size)
+                except TranscriptionError as e:
+                    clean_text = None
+                    error_text = str(e)
+                else:
+                    error_text = "Не удалось распознать речь в голосовом сообщении."
+            if not clean_text:
+                await outbound.edit_message_text(text=error_text, chat_id=chat_id, message_id=status_message.message_id)
+                return None
+            logger.debug("Текст после очистки: %s...", clean_text[:50])
+
+            # Удаляем сообщение о преобразовании; статус генерации будет отправлен при постановке в очередь
             try:
-                await bot.delete_message(chat_id=message.chat.id, message_id=temp_message.message_id)
-                logger.info(f"Временное сообщение удалено в chat_id: {chat_id}, message_id: {temp_message.message_id}")
+                await outbound.delete_message(chat_id=chat_id, message_id=status_message.message_id)
+                logger.debug("Удалено временное сообщение о преобразовании в chat_id: %s, message_id: %s", chat_id, status_message.message_id)
             except Exception as e:
-                logger.warning(f"Не удалось удалить временное сообщение: {e}")
+                logger.warning("Не удалось удалить временное сообщение о преобразовании: %s", e)
 
-        @bot.message_handler(content_types=['text'])
-        async def handle_message(message):
-            chat_id = message.chat.id
-            user_message = message.text
-            logger.info(f"Получено текстовое сообщение от chat_id: {chat_id}: {user_message[:50]}...")
-            if user_message.startswith('/'):
-                logger.info("Пропуск сообщения, похожего на команду")
+            # Отправляем распознанный текст пользователю
+            await outbound.reply_to(message, f"Распознанный текст:\n{clean_text}")
+            return clean_text
+
+        async def store_trace(trace):
+            """Сохраняет трассировку ответа; ошибка сохранения не влияет на ответ."""
+            if trace is None:
                 return
+            try:
+                await save_trace(trace, config.get("reply_traces_keep", 50))
+            except Exception as e:
+                logger.warning("Не удалось сохранить трассировку для chat_id: %s: %s", trace.chat_id, e)
+
+        async def process_request(item):
+            """Обрабатывает запрос из очереди чата (вызывается обработчиком очереди)."""
+            trace = item.trace
+            if trace is None and config.get("reply_traces", True):
+                # Полное время ответа считается с момента постановки в очередь
+                trace = ReplyTrace(item.chat_id, item.kind, item.enqueued_at)
+            if trace is not None:
+                trace.add("queue_wait", time.monotonic() - item.enqueued_at)
+            try:
+                await generate_and_reply(item, item.text, generation_status_text(item), trace)
+                await store_trace(trace)
+            except Exception as e:
+                logger.error("Ошибка при генерации ответа для chat_id: %s: %s", item.chat_id, e, exc_info=True)
+                ERRORS_TOTAL.inc(source="handler", type=type(e).__name__)
+                await outbound.reply_to(item.message, "Произошла ошибка при генерации ответа.")
 
-            context = load_context(chat_id)
-            if not context:
-                context = add_system_prompt(config["system_prompt"])
-                logger.info("Используется системный промпт как контекст с разделителями")
-            else:
-                logger.info(f"Загружен контекст: {context[:100]}...")
+        request_queue = RequestQueue(process_request, on_position=notify_queue_position)
+        request_queue.configure(config)
+        REQUEST_QUEUE_DEPTH.set_function(request_queue.total_depth)
+        REQUEST_QUEUE_CHATS.set_function(request_queue.busy_chats)
 
-            # Проверяем блокировку
-            if not await check_and_lock_generation(chat_id, message):
+        async def enqueue_request(message, kind, text="", trace=None):
+            """Ставит запрос в очередь чата и отправляет сообщение о статусе с позицией в очереди."""
+            chat_id = message.chat.id
+            item = WorkItem(chat_id, kind, message, text, trace)
+            result, position = request_queue.submit(item)
+            if result == REJECTED_BUSY:
+                await outbound.reply_to(message, "Генерация ответа уже идёт, подождите немного!")
+                logger.info("Генерация для chat_id: %s заблокирована, уже выполняется", chat_id)
                 return
+            if result == REJECTED_FULL:
+                await outbound.reply_to(message, "Слишком много запросов в очереди, подождите немного!")
+                logger.info("Очередь chat_id: %s заполнена (%s), запрос отклонён", chat_id, request_queue.max_depth)
+                return
+            if result == COALESCED:
+                await outbound.reply_to(message, f"Сообщение добавлено к ожидающему запросу (позиция в очереди: {position}).")
+                return
+            # Обработчик очереди ждёт item.ready, чтобы не отправить второй статус для того же запроса
+            try:
+                if position:
+                    status_text = queue_status_text(item, position)
+                else:
+                    status_text = generation_status_text(item)
+                status_message = await outbound.reply_to(message, status_text)
+                item.attach_status(status_message.message_id, status_text)
+                logger.info("Отправлено сообщение о статусе в chat_id: %s, message_id: %s", chat_id, status_message.message_id)
+            finally:
+                item.ready.set()
 
-            async with generation_locks[chat_id]:
-                # Получаем среднее время генерации
-                avg_time, count = get_avg_response_time(chat_id)
-                status_text = "Генерирую ответ, пожалуйста, подождите..."
-                if avg_time:
-                    status_text += f"\nСреднее время ответа: {avg_time:.2f} сек (на основе {count} предыдущих ответов)"
+        # Голосовые сообщения распознаются до постановки в очередь: распознавание следующего
+        # сообщения идёт параллельно с генерацией ответа на предыдущее
+        voice_stage = OrderedStage()
 
-                status_message = await bot.reply_to(message, status_text)
-                logger.info(f"Отправлено сообщение о статусе в chat_id: {chat_id}, message_id: {status_message.message_id}")
-                
-                ai_response, text_en, response_en, character_name, character_prompt, response_time = await generate_response_async(
-                    user_message, config, chat_id, context, get_user_translate_enabled(chat_id), get_ai_translate_enabled(chat_id)
-                )
-                logger.info(f"Сгенерирован ответ: {ai_response[:100]}...")
+        async def process_voice(message):
+            """Распознаёт голосовое сообщение и ставит распознанный текст в очередь чата."""
+            chat_id = message.chat.id
+            trace = ReplyTrace(chat_id, "voice") if config.get("reply_traces", True) else None
 
-                # Отправляем основной ответ
-                message_parts = split_message(ai_response)
-                logger.info(f"Сообщение разбито на {len(message_parts)} частей: {message_parts[0][:50]}...")
-                await bot.edit_message_text(
-                    text=message_parts[0],
-                    chat_id=message.chat.id,
-                    message_id=status_message.message_id
-                )
-                logger.info(f"Сообщение статуса отредактировано для chat_id: {chat_id}")
-                for part in message_parts[1:]:
-                    await bot.send_message(chat_id=message.chat.id, text=part)
-                    logger.info(f"Отправлена дополнительная часть в chat_id: {chat_id}")
+            async def deliver(clean_text):
+                if clean_text is not None:
+                    await enqueue_request(message, "voice", clean_text, trace)
 
-            # Отправляем временное сообщение о завершении генерации
-            temp_message = await bot.send_message(
-                chat_id=message.chat.id,
-                text=f"Генерация завершена за {response_time:.2f} сек"
-            )
-            logger.info(f"Отправлено временное сообщение о завершении в chat_id: {chat_id}, message_id: {temp_message.message_id}")
-            
-            # Удаляем сообщение через temp_message_livetime секунд
-            await asyncio.sleep(temp_message_livetime(config))
             try:
-                await bot.delete_message(chat_id=message.chat.id, message_id=temp_message.message_id)
-                logger.info(f"Временное сообщение удалено в chat_id: {chat_id}, message_id: {temp_message.message_id}")
+                await voice_stage.run(chat_id, lambda: transcribe_voice(message, trace), deliver)
             except Exception as e:
-                logger.warning(f"Не удалось удалить временное сообщение: {e}")
+                logger.error("Ошибка при обработке аудио-сообщения: %s", e)
+                ERRORS_TOTAL.inc(source="voice", type=type(e).__name__)
+                await outbound.reply_to(message, "Произошла ошибка при обработке аудио-сообщения.")
+
+        @bot.message_handler(commands=['continue'])
+        async def handle_continue(message):
+            chat_id = message.chat.id
+            logger.info("Получена команда /continue от chat_id: %s", chat_id)
+            await enqueue_request(message, "continue")
+
+        @bot.message_handler(content_types=['text'])
+        async def handle_message(message):
+            chat_id = message.chat.id
+            user_message = message.text
+            logger.info("Получено текстовое сообщение от chat_id: %s: %s...", chat_id, user_message[:50])
+            if user_message.startswith('/'):
+                logger.info("Пропуск сообщения, похожего на команду")
+                return
+            await enqueue_request(message, "text", user_message)
 
         @bot.message_handler(content_types=['voice'])
         async def handle_voice_message(message):
             chat_id = message.chat.id
             username = message.from_user.username or "Unknown"
-            logger.info(f"Получено аудио-сообщение от chat_id: {chat_id}, username: {username}")
-
-            # Проверяем блокировку
-            if not await check_and_lock_generation(chat_id, message):
+            logger.info("Получено аудио-сообщение от chat_id: %s, username: %s", chat_id, username)
+            pending = voice_stage.pending(chat_id)
+            if request_queue.policy == "reject" and (pending or request_queue.busy(chat_id)):
+                await outbound.reply_to(message, "Генерация ответа уже идёт, подождите немного!")
+                logger.info("Генерация для chat_id: %s заблокирована, уже выполняется", chat_id)
                 return
-
-            async with generation_locks[chat_id]:
-                # Скачиваем аудио-файл
-                file_info = await bot.get_file(message.voice.file_id)
-                downloaded_file = await bot.download_file(file_info.file_path)
-
-                # Создаём временный файл для аудио
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".ogg") as temp_audio:
-                    temp_audio.write(downloaded_file)
-                    audio_file_path = temp_audio.name
-                logger.info(f"Аудио сохранено во временный файл: {audio_file_path}")
-
-                # Создаём путь для текстового файла, убирая расширение .ogg
-                text_file_path = os.path.splitext(audio_file_path)[0] + ".txt"
-                logger.info(f"Ожидаемый путь к текстовому файлу: {text_file_path}")
-
-                # Логируем путь к утилите перед её вызовом
-                logger.info(f"Используется утилита преобразования аудио: {config['audio_to_text_tool']}")
-
-                # Отправляем временное сообщение о преобразовании речи в текст
-                transcribe_status = await bot.reply_to(message, "Преобразование речи в текст, подождите...")
-                logger.info(f"Отправлено временное сообщение о преобразовании в chat_id: {chat_id}, message_id: {transcribe_status.message_id}")
-
-                # Вызываем утилиту для преобразования аудио в текст
-                try:
-                    process = await asyncio.create_subprocess_exec(
-                        config["audio_to_text_tool"], audio_file_path,
-                        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-                    )
-                    stdout, stderr = await process.communicate()
-
-                    # Логируем вывод утилиты
-                    try:
-                        stdout_str = stdout.decode('cp866').strip() if stdout else "нет вывода"
-                    except UnicodeDecodeError as e:
-                        stdout_str = f"ошибка декодирования: {str(e)}"
-                        logger.warning(f"Не удалось декодировать stdout утилиты {config['audio_to_text_tool']}: {stdout[:100]}...")
-                    try:
-                        stderr_str = stderr.decode('cp866').strip() if stderr else "нет ошибок"
-                    except UnicodeDecodeError as e:
-                        stderr_str = f"ошибка декодирования: {str(e)}"
-                        logger.warning(f"Не удалось декодировать stderr утилиты {config['audio_to_text_tool']}: {stderr[:100]}...")
-
-                    logger.info(f"Вывод утилиты (stdout): {stdout_str[:100]}...")
-                    logger.info(f"Ошибки утилиты (stderr): {stderr_str[:100]}...")
-                    logger.info(f"Код завершения утилиты: {process.returncode}")
-
-                    # Проверяем код завершения и наличие ошибок в stderr
-                    if process.returncode != 0 or (stderr and stderr_str != "нет ошибок"):
-                        logger.error(f"Утилита завершилась с проблемой (returncode={process.returncode}): {stderr_str[:100]}...")
-                        await bot.reply_to(message, "Ошибка: утилита преобразования аудио завершилась с ошибкой или не выполнила задачу.")
-                        return
-
-                    # Проверяем наличие выходного файла
-                    if not os.path.exists(text_file_path):
-                        logger.error(f"Утилита не создала выходной файл: {text_file_path}")
-                        await bot.reply_to(message, "Ошибка: утилита не создала текстовый файл с распознанным текстом.")
-                        return
-
-                    logger.info("Аудио успешно преобразовано в текст")
-
-                    # Читаем текст из выходного файла
-                    try:
-                        with open(text_file_path, 'r', encoding='utf-8') as text_file:
-                            raw_text = text_file.read()
-                        logger.info(f"Прочитан текст из файла: {raw_text[:50]}...")
-                        clean_text = re.sub(r'\[\d{2}:\d{2}\.\d{3} --> \d{2}:\d{2}\.\d{3}\]\s*', '', raw_text).strip()
-                        logger.info(f"Текст после очистки: {clean_text[:50]}...")
-                        
-                        # Удаляем временное сообщение о преобразовании
-                        try:
-                            await bot.delete_message(chat_id=message.chat.id, message_id=transcribe_status.message_id)
-                            logger.info(f"Удалено временное сообщение о преобразовании в chat_id: {chat_id}, message_id: {transcribe_status.message_id}")
-                        except Exception as e:
-                            logger.warning(f"Не удалось удалить временное сообщение о преобразовании: {e}")
-
-                        # Отправляем распознанный текст пользователю
-                        await bot.reply_to(message, f"Распознанный текст:\n{clean_text}")
-                    except FileNotFoundError:
-                        logger.error(f"Выходной файл {text_file_path} не найден")
-                        await bot.reply_to(message, "Ошибка: утилита не создала текстовый файл.")
-                        return
-                    except Exception as e:
-                        logger.error(f"Ошибка при чтении текстового файла: {str(e)}")
-                        await bot.reply_to(message, "Ошибка: не удалось прочитать текст из файла.")
-                        return
-
-                    # Загружаем контекст
-                    context = load_context(chat_id)
-                    if not context:
-                        context = add_system_prompt(config["system_prompt"])
-                        logger.info("Используется системный промпт как контекст с разделителями")
-
-                    # Получаем среднее время генерации
-                    avg_time, count = get_avg_response_time(chat_id)
-                    status_text = "Генерация ответа, подождите..."
-                    if avg_time:
-                        status_text += f"\nСреднее время ответа: {avg_time:.2f} сек (на основе {count} ответов)"
-
-                    status_message = await bot.reply_to(message, status_text)
-                    logger.info(f"Отправлено сообщение о статусе в chat_id: {chat_id}, message_id: {status_message.message_id}")
-
-                    # Генерируем ответ ИИ
-                    ai_response, text_en, response_en, character_name, character_prompt, response_time = await generate_response_async(
-                        clean_text, config, chat_id, context, get_user_translate_enabled(chat_id), get_ai_translate_enabled(chat_id)
-                    )
-                    logger.info(f"Сгенерирован ответ: {ai_response[:50]}...")
-
-                    # Отправляем ответ
-                    message_parts = split_message(ai_response)
-                    await bot.edit_message_text(
-                        text=message_parts[0],
-                        chat_id=message.chat.id,
-                        message_id=status_message.message_id
-                    )
-                    for part in message_parts[1:]:
-                        await bot.send_message(chat_id=message.chat.id, text=part)
-
-                    # Отправляем временное сообщение о завершении
-                    temp_message = await bot.send_message(
-                        chat_id=message.chat.id,
-                        text=f"Генерация завершена за {response_time:.2f} сек"
-                    )
-                    await asyncio.sleep(temp_message_livetime(config))
-                    try:
-                        await bot.delete_message(chat_id=message.chat.id, message_id=temp_message.message_id)
-                    except Exception as e:
-                        logger.warning(f"Не удалось удалить временное сообщение о завершении: {e}")
-
-                except Exception as e:
-                    logger.error(f"Ошибка при обработке аудио-сообщения: {str(e)}")
-                    await bot.reply_to(message, "Произошла ошибка при обработке аудио-сообщения.")
-                    return
-
-                finally:
-                    # Удаляем временные файлы
-                    try:
-                        os.remove(audio_file_path)
-                        if os.path.exists(text_file_path):
-                            os.remove(text_file_path)
-                        logger.info(f"Удалены временные файлы: {audio_file_path}, {text_file_path}")
-                    except Exception as e:
-                        logger.warning(f"Не удалось удалить временные файлы: {e}")
-                
-        logger.info("Запуск polling")
-        await polling_with_logging()
+            if pending >= request_queue.max_depth:
+                await outbound.reply_to(message, "Слишком много запросов в очереди, подождите немного!")
+                logger.info("Распознавание для chat_id: %s отклонено: уже распознаётся %s сообщений", chat_id, pending)
+                return
+            # Распознавание идёт вне очереди чата и не задерживает обработчик обновлений
+            task = asyncio.create_task(process_voice(message))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+
+        if config.get("update_mode", "polling") == "webhook":
+            # Обновления приходят на встроенный aiohttp-сервер без задержек long polling
+            logger.info("Запуск в режиме webhook")
+            await WebhookServer.from_config(bot, config).serve_forever()
+        else:
+            # getUpdates не работает, пока зарегистрирован webhook
+            try:
+                await bot.delete_webhook()
+            except Exception as e:
+                logger.warning("Не удалось удалить webhook перед polling: %s", e)
+            logger.info("Запуск polling")
+            await polling_with_logging()
 
     except Exception as e:
-        logger.error(f"Критическая ошибка в main: {e}", exc_info=True)
+        logger.error("Критическая ошибка в main: %s", e, exc_info=True)
         raise
+    finally:
+        # Останавливаем очередь запросов и сервер метрик, сохраняем статистику ответов, закрываем сессии Kobold API,
+        # соединения с базой данных и пул перевода
+        if request_queue is not None:
+            await request_queue.close()
+        if outbound is not None:
+            await outbound.close()
+        await stop_metrics_server()
+        await response_stats.close()
+        await close_backends()
+        await close_storages()
+        translation_service.close()
+        transcription_service.close()
+        stop_logging()
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
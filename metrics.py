@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# metrics.py
+import bisect
+import contextlib
+import logging
+import time
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Текстовый формат экспозиции Prometheus
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Границы корзин гистограмм задержек по умолчанию (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Для быстрых операций: запросы к SQLite, проверки доступности
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# Все созданные метрики в порядке объявления
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"метрика {self.name} ожидает метки {self.labelnames}, получено {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        for key, value in self._values.items():
+            yield self.name, key, None, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, key, extra, value in self._samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Монотонно растущий счётчик."""
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Текущее значение: задаётся явно или вычисляется функцией при каждом опросе.
+
+    Функция возвращает число (метрика без меток) или словарь
+    {кортеж значений меток: значение}.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        self._function = function
+
+    def _samples(self):
+        if self._function is None:
+            yield from super()._samples()
+            return
+        try:
+            values = self._function()
+        except Exception as e:
+            logger.warning("Не удалось вычислить метрику %s: %s", self.name, e)
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            yield self.name, tuple(str(label) for label in key), None, value
+
+
+class _HistogramValue:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам; перцентили считаются на стороне Prometheus."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        item = self._values.get(key)
+        if item is None:
+            item = _HistogramValue(len(self.buckets))
+            self._values[key] = item
+        item.counts[bisect.bisect_left(self.buckets, value)] += 1
+        item.sum += value
+        item.count += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Замеряет длительность блока (в том числе блока с await)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        for key, item in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, item.counts):
+                cumulative += count
+                yield f"{self.name}_bucket", key, ("le", _format_value(bound)), cumulative
+            yield f"{self.name}_sum", key, None, item.sum
+            yield f"{self.name}_count", key, None, item.count
+
+
+# Kobold API
+KOBOLD_REQUEST_SECONDS = Histogram(
+    "kobold_request_seconds", "Длительность запроса генерации к бэкенду Kobold", ("backend", "outcome"))
+KOBOLD_HEALTH_CHECK_SECONDS = Histogram(
+    "kobold_health_check_seconds", "Длительность проверки доступности бэкенда Kobold", ("backend",), FAST_BUCKETS)
+KOBOLD_BACKEND_UP = Gauge("kobold_backend_up", "Доступен ли бэкенд Kobold по последней проверке", ("backend",))
+GENERATION_SECONDS = Histogram("generation_seconds", "Полное время подготовки ответа, включая перевод и очередь")
+SCHEDULER_WAIT_SECONDS = Histogram(
+    "scheduler_wait_seconds", "Ожидание места на бэкенде в глобальном планировщике", ("backend",))
+SCHEDULER_QUEUE_DEPTH = Gauge("scheduler_queue_depth", "Генерации, ожидающие места на бэкенде", ("backend",))
+GENERATIONS_ACTIVE = Gauge("generations_active", "Генерации, выполняющиеся на бэкенде", ("backend",))
+
+# Очередь запросов чатов
+REQUEST_QUEUE_DEPTH = Gauge("request_queue_depth", "Запросы, ожидающие в очередях чатов")
+REQUEST_QUEUE_CHATS = Gauge("request_queue_busy_chats", "Чаты с обрабатываемым или ожидающим запросом")
+
+# Перевод
+TRANSLATION_SECONDS = Histogram("translation_seconds", "Длительность перевода бэкендом", ("backend", "outcome"))
+TRANSLATION_CACHE_TOTAL = Counter("translation_cache_total", "Обращения к кэшу переводов", ("result",))
+
+# SQLite
+SQLITE_QUERY_SECONDS = Histogram(
+    "sqlite_query_seconds", "Длительность запроса к SQLite, включая ожидание потока-исполнителя",
+    ("operation",), FAST_BUCKETS)
+
+# Telegram Bot API
+TELEGRAM_API_SECONDS = Histogram("telegram_api_seconds", "Длительность вызова Telegram Bot API", ("method",))
+
+# Ошибки
+ERRORS_TOTAL = Counter("errors_total", "Ошибки по источнику и типу", ("source", "type"))
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus."""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+def instrument_telegram():
+    """Замеряет длительность и ошибки всех вызовов Telegram Bot API асинхронного клиента."""
+    from telebot import asyncio_helper
+
+    process_request = asyncio_helper._process_request
+    if getattr(process_request, "instrumented", False):
+        return
+
+    async def timed_process_request(token, url, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await process_request(token, url, *args, **kwargs)
+        except Exception as e:
+            ERRORS_TOTAL.inc(source="telegram", type=type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, method=url)
+
+    timed_process_request.instrumented = True
+    asyncio_helper._process_request = timed_process_request
+
+
+async def _handle_metrics(request):
+    return web.Response(body=render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+
+_runner = None
+
+
+async def start_metrics_server(config):
+    """Запускает HTTP-сервер с /metrics на metrics_host:metrics_port (0 — выключен)."""
+    global _runner
+    port = config.get("metrics_port", 0)
+    if not port or _runner is not None:
+        return
+    host = config.get("metrics_host", "127.0.0.1")
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    _runner = runner
+    logger.info("Метрики доступны по адресу http://%s:%s/metrics", host, port)
+
+
+async def stop_metrics_server():
+    """Останавливает сервер метрик."""
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
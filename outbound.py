@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# outbound.py
+import asyncio
+import logging
+import time
+from telebot.asyncio_helper import ApiTelegramException
+from metrics import Counter, Histogram, FAST_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_WAIT_SECONDS = Histogram(
+    "telegram_outbound_wait_seconds", "Ожидание лимита перед отправкой в Telegram", (), FAST_BUCKETS)
+OUTBOUND_RETRIES_TOTAL = Counter("telegram_outbound_retries_total", "Повторы после ответа 429 от Telegram")
+OUTBOUND_COALESCED_TOTAL = Counter(
+    "telegram_outbound_coalesced_total", "Правки сообщений, объединённые с ещё не отправленной правкой")
+
+# Сколько простаивающих чатов хранить, прежде чем удалять их состояние
+MAX_IDLE_CHATS = 1024
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity в запасе (rate <= 0 — без лимита)."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Через сколько секунд появится токен (0 — уже есть)."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+    def full(self, now):
+        if self.rate <= 0:
+            return True
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+    def reconfigure(self, rate, capacity):
+        self._refill(time.monotonic())
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = min(self.tokens, self.capacity)
+
+
+class ChatLimiter:
+    """Состояние одного чата: ведро токенов, порядок отправки и пауза после 429."""
+
+    __slots__ = ("bucket", "lock", "users", "blocked_until")
+
+    def __init__(self, rate, capacity):
+        self.bucket = TokenBucket(rate, capacity)
+        self.lock = asyncio.Lock()
+        self.users = 0
+        self.blocked_until = 0.0
+
+
+class PendingEdit:
+    """Правка сообщения, ожидающая отправки; новые правки того же сообщения заменяют её текст."""
+
+    __slots__ = ("text", "kwargs", "task")
+
+    def __init__(self, text, kwargs):
+        self.text = text
+        self.kwargs = kwargs
+        self.task = None
+
+
+def retry_after(error):
+    """Время ожидания из ответа 429 (parameters.retry_after) или None для других ошибок."""
+    if not isinstance(error, ApiTelegramException) or error.error_code != 429:
+        return None
+    parameters = error.result_json.get("parameters") or {}
+    return parameters.get("retry_after", 1)
+
+
+class OutboundDispatcher:
+    """Исходящие сообщения бота с учётом лимитов Telegram.
+
+    Перед каждым вызовом берётся токен из ведра чата (для групп лимит
+    ниже) и из общего ведра бота. Вызовы одного чата выполняются строго по
+    очереди, поэтому части длинного ответа не перемешиваются. На ответ 429
+    чат ставится на паузу retry_after секунд и вызов повторяется. Правки
+    одного сообщения, ещё не ушедшие в Telegram, объединяются: отправляется
+    только последний текст.
+    """
+
+    def __init__(self, bot, global_rate=30, chat_rate=1.0, group_rate=20 / 60, chat_burst=3,
+                 max_retries=3, max_retry_after=60):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self._global = TokenBucket(global_rate, global_rate)
+        self._global_lock = asyncio.Lock()
+        self._chats = {}
+        self._edits = {}
+
+    def configure(self, config):
+        """Применяет лимиты из конфигурации, в том числе к уже известным чатам."""
+        global_rate = config.get("outbound_global_rate", self._global.rate)
+        self._global.reconfigure(global_rate, global_rate)
+        self.chat_rate = config.get("outbound_chat_rate", self.chat_rate)
+        self.group_rate = config.get("outbound_group_rate", self.group_rate)
+        self.chat_burst = config.get("outbound_chat_burst", self.chat_burst)
+        self.max_retries = config.get("outbound_max_retries", self.max_retries)
+        self.max_retry_after = config.get("outbound_max_retry_after", self.max_retry_after)
+        for chat_id, limiter in self._chats.items():
+            limiter.bucket.reconfigure(self._rate_for(chat_id), self.chat_burst)
+        logger.info("Лимиты отправки: %s/сек всего, %s/сек на чат, %.2f/сек на группу",
+                    global_rate, self.chat_rate, self.group_rate)
+
+    def _rate_for(self, chat_id):
+        # У групп и каналов отрицательный chat_id
+        return self.group_rate if chat_id < 0 else self.chat_rate
+
+    def _chat(self, chat_id):
+        limiter = self._chats.get(chat_id)
+        if limiter is None:
+            if len(self._chats) >= MAX_IDLE_CHATS:
+                self._sweep()
+            limiter = ChatLimiter(self._rate_for(chat_id), self.chat_burst)
+            self._chats[chat_id] = limiter
+        return limiter
+
+    def _sweep(self):
+        # Удаляем чаты без ожидающих вызовов, у которых ведро уже восстановилось
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, limiter in self._chats.items()
+                        if not limiter.users and limiter.blocked_until <= now and limiter.bucket.full(now)]:
+            del self._chats[chat_id]
+
+    async def _acquire(self, limiter, limited):
+        while True:
+            now = time.monotonic()
+            delay = limiter.blocked_until - now
+            if limited:
+                delay = max(delay, limiter.bucket.wait_time(now))
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        if not limited:
+            return
+        async with self._global_lock:
+            while True:
+                delay = self._global.wait_time(time.monotonic())
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self._global.take()
+        limiter.bucket.take()
+
+    async def _call(self, chat_id, func, args, kwargs, limited=True):
+        limiter = self._chat(chat_id)
+        limiter.users += 1
+        try:
+            async with limiter.lock:
+                attempt = 0
+                while True:
+                    started = time.perf_counter()
+                    await self._acquire(limiter, limited)
+                    OUTBOUND_WAIT_SECONDS.observe(time.perf_counter() - started)
+                    try:
+                        return await func(*args, **kwargs)
+                    except ApiTelegramException as e:
+                        delay = retry_after(e)
+                        if delay is None or attempt >= self.max_retries or delay > self.max_retry_after:
+                            raise
+                        attempt += 1
+                        limiter.blocked_until = time.monotonic() + delay
+                        OUTBOUND_RETRIES_TOTAL.inc()
+                        logger.warning("Telegram ограничил отправку в chat_id %s: повтор через %s сек "
+                                       "(попытка %s/%s)", chat_id, delay, attempt, self.max_retries)
+        finally:
+            limiter.users -= 1
+
+    async def call(self, chat_id, func, *args, **kwargs):
+        """Вызывает func(*args, **kwargs) по лимитам чата chat_id; при 429 func вызывается повторно."""
+        return await self._call(chat_id, func, args, kwargs)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self._call(chat_id, self.bot.send_message, (chat_id, text), kwargs)
+
+    async def reply_to(self, message, text, **kwargs):
+        return await self._call(message.chat.id, self.bot.reply_to, (message, text), kwargs)
+
+    async def delete_message(self, chat_id, message_id):
+        # Удаление не расходует токены, но соблюдает порядок и паузу после 429
+        return await self._call(chat_id, self.bot.delete_message, (chat_id, message_id), {}, limited=False)
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        """Правит сообщение; если предыдущая правка ещё ждёт отправки, её текст просто заменяется."""
+        key = (chat_id, message_id)
+        pending = self._edits.get(key)
+        if pending is not None:
+            pending.text = text
+            pending.kwargs = kwargs
+            OUTBOUND_COALESCED_TOTAL.inc()
+        else:
+            pending = PendingEdit(text, kwargs)
+            self._edits[key] = pending
+            pending.task = asyncio.create_task(self._call(chat_id, self._edit, (key, pending), {}))
+            pending.task.add_done_callback(lambda task: self._edit_done(key, pending))
+        # Отмена вызывающего не отменяет правку: её могут ждать и другие
+        return await asyncio.shield(pending.task)
+
+    async def _edit(self, key, pending):
+        # Правка уходит в Telegram: следующие правки сообщения встанут в очередь за ней
+        if self._edits.get(key) is pending:
+            del self._edits[key]
+        chat_id, message_id = key
+        return await self.bot.edit_message_text(text=pending.text, chat_id=chat_id, message_id=message_id,
+                                                **pending.kwargs)
+
+    def _edit_done(self, key, pending):
+        if self._edits.get(key) is pending:
+            del self._edits[key]
+        # Ошибку уже получили (или не ждут) вызывающие; помечаем её обработанной
+        if not pending.task.cancelled():
+            pending.task.exception()
+
+    async def close(self):
+        """Отменяет правки, ожидающие отправки (вызывается при остановке бота)."""
+        tasks = [pending.task for pending in self._edits.values()]
+        self._edits.clear()
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# payload.py
+import json
+import logging
+from types import MappingProxyType
+
+try:
+    import orjson  # необязательная зависимость: заметно быстрее стандартного json
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Параметры сэмплера по умолчанию (пресет "default")
+DEFAULT_SAMPLER_SETTINGS = {
+    "max_tokens": 512,
+    "typical_p": 1,
+    "typical": 1,
+    "sampler_seed": -1,
+    "min_p": 0,
+    "repetition_penalty": 1.22,
+    "frequency_penalty": 0,
+    "presence_penalty": 0,
+    "top_k": 0,
+    "skew": 0,
+    "min_tokens": 0,
+    "add_bos_token": True,
+    "smoothing_factor": 0,
+    "smoothing_curve": 1,
+    "dry_allowed_length": 2,
+    "dry_multiplier": 0,
+    "dry_base": 1.75,
+    "dry_sequence_breakers": ["\\n", ":", "\\\"", "*"],
+    "dry_penalty_last_n": 0,
+    "max_tokens_second": 0,
+    "ban_eos_token": False,
+    "skip_special_tokens": True,
+    "top_a": 0,
+    "tfs": 1,
+    "mirostat_mode": 0,
+    "mirostat_tau": 5,
+    "mirostat_eta": 0.1,
+    "custom_token_bans": "",
+    "banned_strings": [],
+    "sampler_order": [6, 0, 1, 3, 4, 2, 5],
+    "xtc_threshold": 0.1,
+    "xtc_probability": 0,
+    "nsigma": 0,
+    "grammar": "",
+    "trim_stop": True,
+    "rep_pen": 1.22,
+    "rep_pen_range": 0,
+    "repetition_penalty_range": 0,
+    "seed": -1,
+    "guidance_scale": 1,
+    "negative_prompt": "",
+    "grammar_string": "",
+    "repeat_penalty": 1.22,
+    "tfs_z": 1,
+    "repeat_last_n": 0,
+    "n_predict": 512,
+    "num_predict": 512,
+    "mirostat": 0,
+    "ignore_eos": False,
+    "rep_pen_slope": 1,
+}
+
+# Поля, которые заполняются для каждого запроса и не могут задаваться пресетом
+REQUEST_FIELDS = ("prompt", "memory", "max_length", "stopping_strings", "stop")
+
+
+def dumps(obj):
+    """Кодирует объект в JSON (bytes), используя orjson, если он установлен."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("ascii")
+
+
+def loads(data):
+    """Разбирает JSON; ошибки — json.JSONDecodeError (orjson.JSONDecodeError его подкласс)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _freeze(value):
+    # Вложенные списки превращаются в кортежи: их нельзя случайно изменить между запросами
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _check_type(key, value, default):
+    if isinstance(default, bool):
+        ok = isinstance(value, bool)
+    elif isinstance(default, (int, float)):
+        ok = isinstance(value, (int, float)) and not isinstance(value, bool)
+    else:
+        ok = isinstance(value, type(default))
+    if not ok:
+        raise TypeError(f"параметр {key} должен иметь тип {type(default).__name__}, получено {value!r}")
+
+
+class PayloadTemplate:
+    """Неизменяемый набор параметров сэмплера, к которому добавляются поля запроса."""
+
+    __slots__ = ("preset", "settings")
+
+    def __init__(self, preset, settings):
+        self.preset = preset
+        self.settings = MappingProxyType({key: _freeze(value) for key, value in settings.items()})
+
+    def build(self, prompt, memory, max_length, stop):
+        """Возвращает payload запроса генерации."""
+        payload = dict(self.settings)
+        payload["prompt"] = prompt
+        payload["memory"] = memory
+        payload["max_length"] = max_length
+        payload["stopping_strings"] = stop
+        payload["stop"] = stop
+        return payload
+
+
+def compile_template(config):
+    """Собирает и проверяет шаблон из sampler_presets[sampler_preset].
+
+    Поверх пресета "default" применяются temperature, top_p, max_new_tokens и
+    max_context_length из конфигурации, затем значения выбранного пресета.
+    Выбрасывает ValueError/TypeError при ошибке в пресете.
+    """
+    presets = config.get("sampler_presets", {})
+    name = config.get("sampler_preset", "default")
+    if name != "default" and name not in presets:
+        raise ValueError(f"пресет сэмплера '{name}' не найден в sampler_presets")
+
+    settings = dict(DEFAULT_SAMPLER_SETTINGS)
+    settings["max_new_tokens"] = config.get("max_new_tokens", 512)
+    settings["temperature"] = config.get("temperature", 0.8)
+    settings["top_p"] = config.get("top_p", 0.9)
+    settings["truncation_length"] = config.get("max_context_length", 8192)
+    settings["num_ctx"] = config.get("max_context_length", 8192)
+
+    for key, value in presets.get(name, {}).items():
+        if key in REQUEST_FIELDS:
+            raise ValueError(f"параметр {key} задаётся для каждого запроса и не может быть в пресете")
+        if key in settings:
+            _check_type(key, value, settings[key])
+        settings[key] = value
+
+    if settings["temperature"] < 0:
+        raise ValueError("temperature не может быть отрицательной")
+    if not 0 <= settings["top_p"] <= 1:
+        raise ValueError("top_p должен быть в диапазоне 0..1")
+    return PayloadTemplate(name, settings)
+
+
+_template = None
+
+
+def configure_payload(config):
+    """Компилирует шаблон при загрузке и перезагрузке конфигурации.
+
+    Если новый пресет некорректен, остаётся предыдущий шаблон.
+    """
+    global _template
+    try:
+        template = compile_template(config)
+    except (ValueError, TypeError) as e:
+        if _template is None:
+            raise
+        logger.error("Пресет сэмплера не применён: %s. Остаётся '%s'", e, _template.preset)
+        return _template
+    _template = template
+    logger.info("Пресет сэмплера: %s, сериализатор JSON: %s", template.preset, 'orjson' if orjson else 'json')
+    return template
+
+
+def get_template(config):
+    """Текущий шаблон payload (компилируется при первом обращении)."""
+    if _template is None:
+        configure_payload(config)
+    return _template
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# request_queue.py
+import asyncio
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Политики поведения при новом сообщении, пока чат занят генерацией:
+#   queue    — поставить в очередь за предыдущими;
+#   coalesce — дописать к ещё не начатому текстовому запросу, чтобы ответить одним промптом;
+#   reject   — отказать, как раньше.
+QUEUE_POLICIES = ("queue", "coalesce", "reject")
+
+# Результаты постановки запроса в очередь
+QUEUED = "queued"
+COALESCED = "coalesced"
+REJECTED_BUSY = "busy"
+REJECTED_FULL = "full"
+
+
+class WorkItem:
+    """Запрос на генерацию ответа, ожидающий обработки в очереди чата."""
+
+    __slots__ = ("chat_id", "kind", "text", "message", "messages", "enqueued_at", "started",
+                 "status_message_id", "status_text", "ready", "trace")
+
+    def __init__(self, chat_id, kind, message, text="", trace=None):
+        self.chat_id = chat_id
+        self.kind = kind  # "text", "continue" или "voice"
+        self.text = text
+        self.message = message
+        self.messages = [message]  # все сообщения пользователя, объединённые в этот запрос
+        self.enqueued_at = time.monotonic()
+        self.started = False
+        self.status_message_id = None
+        self.status_text = None
+        # Устанавливается, когда обработчик отправил сообщение о статусе (или не смог его отправить)
+        self.ready = asyncio.Event()
+        # Трассировка, начатая до постановки в очередь (например, на этапе распознавания речи)
+        self.trace = trace
+
+    def coalescible(self):
+        """Можно ли объединять запрос с соседними: только обычный текст, не "..."."""
+        return self.kind == "text" and self.text.strip() != "..."
+
+    def merge(self, other):
+        """Дописывает текст другого запроса к этому."""
+        self.text = f"{self.text}\n{other.text}"
+        self.messages.append(other.message)
+
+    def attach_status(self, message_id, text):
+        """Запоминает сообщение о статусе, которое будет редактироваться при обработке."""
+        self.status_message_id = message_id
+        self.status_text = text
+
+
+class ChatQueue:
+    """Очередь одного чата: ожидающие запросы, текущий запрос и задача-обработчик."""
+
+    __slots__ = ("pending", "current", "worker")
+
+    def __init__(self):
+        self.pending = deque()
+        self.current = None
+        self.worker = None
+
+
+class OrderedStage:
+    """Этап подготовки запросов до постановки в очередь чата (например, распознавание речи).
+
+    Запросы разных и одного чата готовятся параллельно и не занимают
+    очередь генерации, но результаты одного чата передаются дальше в
+    порядке поступления: deliver вызывается только после того, как
+    завершился предыдущий запрос этого чата.
+    """
+
+    def __init__(self):
+        self._tails = {}
+        self._pending = {}
+
+    def pending(self, chat_id):
+        """Число запросов чата на этом этапе."""
+        return self._pending.get(chat_id, 0)
+
+    async def run(self, chat_id, prepare, deliver):
+        """Выполняет prepare(), затем по очереди чата deliver(результат) и возвращает его результат."""
+        previous = self._tails.get(chat_id)
+        done = asyncio.Event()
+        self._tails[chat_id] = done
+        self._pending[chat_id] = self._pending.get(chat_id, 0) + 1
+        try:
+            result = await prepare()
+            if previous is not None:
+                await previous.wait()
+            return await deliver(result)
+        finally:
+            done.set()
+            self._pending[chat_id] -= 1
+            if not self._pending[chat_id]:
+                del self._pending[chat_id]
+            if self._tails.get(chat_id) is done:
+                del self._tails[chat_id]
+
+
+class RequestQueue:
+    """Очереди запросов по чатам с последовательной обработкой внутри чата.
+
+    Обработчики сообщений только ставят запросы в очередь; для каждого
+    занятого чата работает одна задача, которая по порядку передаёт запросы
+    в process(item). Когда очередь продвигается, для ожидающих запросов
+    вызывается on_position(item, позиция), чтобы обновить их статус.
+    """
+
+    def __init__(self, process, on_position=None, max_depth=5, policy="queue"):
+        self.process = process
+        self.on_position = on_position
+        self.max_depth = max_depth
+        self.policy = policy
+        self._chats = {}
+        self._notifications = set()
+
+    def configure(self, config):
+        """Применяет глубину очереди и политику из конфигурации."""
+        policy = config.get("queue_policy", self.policy)
+        if policy not in QUEUE_POLICIES:
+            logger.warning("Неизвестная политика очереди '%s', используется 'queue'", policy)
+            policy = "queue"
+        self.policy = policy
+        self.max_depth = config.get("queue_max_depth", self.max_depth)
+        logger.info("Очередь запросов: политика %s, глубина %s", self.policy, self.max_depth)
+
+    def depth(self, chat_id):
+        """Число запросов чата, ожидающих обработки."""
+        chat = self._chats.get(chat_id)
+        return len(chat.pending) if chat else 0
+
+    def total_depth(self):
+        """Число ожидающих запросов во всех чатах."""
+        return sum(len(chat.pending) for chat in self._chats.values())
+
+    def busy_chats(self):
+        """Число чатов с обрабатываемым или ожидающим запросом."""
+        return len(self._chats)
+
+    def busy(self, chat_id):
+        """Обрабатывается ли сейчас запрос чата или есть ожидающие."""
+        chat = self._chats.get(chat_id)
+        return chat is not None and (chat.current is not None or bool(chat.pending))
+
+    def submit(self, item):
+        """Ставит запрос в очередь чата. Возвращает пару (результат, позиция).
+
+        Позиция — число запросов перед этим: 0 означает, что обработка
+        начнётся сразу. Для COALESCED возвращается позиция запроса, к
+        которому присоединён текст.
+        """
+        chat = self._chats.get(item.chat_id)
+        if chat is None:
+            chat = ChatQueue()
+            self._chats[item.chat_id] = chat
+        ahead = len(chat.pending) + (1 if chat.current is not None else 0)
+
+        if self.policy == "reject" and ahead:
+            return REJECTED_BUSY, ahead
+        if (self.policy == "coalesce" and item.coalescible()
+                and chat.pending and chat.pending[-1].coalescible()):
+            chat.pending[-1].merge(item)
+            logger.debug("Сообщение chat_id %s объединено с ожидающим запросом", item.chat_id)
+            return COALESCED, ahead - 1
+        # Первый запрос ещё не взят обработчиком, но уже не ждёт других — в глубину не считается
+        waiting = len(chat.pending) if chat.current is not None else max(len(chat.pending) - 1, 0)
+        if ahead and waiting >= self.max_depth:
+            return REJECTED_FULL, ahead
+
+        chat.pending.append(item)
+        if chat.worker is None or chat.worker.done():
+            chat.worker = asyncio.create_task(self._drain(item.chat_id, chat))
+        logger.debug("Запрос %s chat_id %s поставлен в очередь, позиция %s", item.kind, item.chat_id, ahead)
+        return QUEUED, ahead
+
+    async def _drain(self, chat_id, chat):
+        while chat.pending:
+            item = chat.pending.popleft()
+            chat.current = item
+            self._notify_positions(chat)
+            try:
+                await item.ready.wait()
+                item.started = True
+                waited = time.monotonic() - item.enqueued_at
+                logger.info("Начата обработка запроса %s chat_id %s после %.2f сек ожидания", item.kind, chat_id, waited)
+                await self.process(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка при обработке запроса chat_id %s: %s", chat_id, e, exc_info=True)
+            finally:
+                chat.current = None
+        # Пустая очередь больше не нужна: следующий запрос создаст новую
+        if self._chats.get(chat_id) is chat:
+            del self._chats[chat_id]
+
+    def _notify_positions(self, chat):
+        if self.on_position is None:
+            return
+        for position, item in enumerate(chat.pending, start=1):
+            task = asyncio.create_task(self._notify(item, position))
+            self._notifications.add(task)
+            task.add_done_callback(self._notifications.discard)
+
+    async def _notify(self, item, position):
+        try:
+            await self.on_position(item, position)
+        except Exception as e:
+            logger.warning("Не удалось обновить позицию в очереди для chat_id %s: %s", item.chat_id, e)
+
+    async def close(self):
+        """Останавливает обработку всех очередей (вызывается при остановке бота)."""
+        tasks = [chat.worker for chat in self._chats.values() if chat.worker is not None]
+        tasks.extend(self._notifications)
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._chats.clear()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# response_stats.py
+import asyncio
+import logging
+import time
+from collections import deque
+from storage import get_storage, LRUCache
+
+logger = logging.getLogger(__name__)
+
+INSERT_RESPONSE_TIME_SQL = (
+    "INSERT INTO response_times (chat_id, response_time, timestamp, prompt_time, cache_reuse_estimated, max_length) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+# Оставляем в таблице только последние keep записей чата
+PRUNE_RESPONSE_TIMES_SQL = '''
+    DELETE FROM response_times WHERE chat_id = ? AND id < (
+        SELECT id FROM response_times WHERE chat_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+    )
+'''
+SELECT_RESPONSE_TIMES_SQL = "SELECT chat_id, response_time, max_length FROM response_times ORDER BY id"
+
+# Во сколько раз длина ответа может изменить оценку (защита от выбросов)
+MAX_LENGTH_SCALE = 4.0
+
+
+def percentile(sorted_values, fraction):
+    """Перцентиль отсортированного списка методом ближайшего ранга."""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+class RollingStats:
+    """Последние времена ответа и их экспоненциальное скользящее среднее."""
+
+    __slots__ = ("samples", "ewma", "ewma_length")
+
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        self.ewma = None
+        self.ewma_length = None  # средняя запрошенная длина ответа в токенах
+
+    def add(self, value, max_length, alpha):
+        self.samples.append(value)
+        self.ewma = value if self.ewma is None else alpha * value + (1 - alpha) * self.ewma
+        if max_length:
+            if self.ewma_length is None:
+                self.ewma_length = max_length
+            else:
+                self.ewma_length = alpha * max_length + (1 - alpha) * self.ewma_length
+
+    def resize(self, window):
+        if self.samples.maxlen != window:
+            self.samples = deque(self.samples, maxlen=window)
+
+    def percentile(self, fraction):
+        return percentile(sorted(self.samples), fraction)
+
+
+class Estimate:
+    """Оценка времени ответа: eta — секунды, count — число ответов в основе, scope — "chat" или "global"."""
+
+    __slots__ = ("eta", "count", "scope", "p90")
+
+    def __init__(self, eta, count, scope, p90=None):
+        self.eta = eta
+        self.count = count
+        self.scope = scope
+        self.p90 = p90
+
+
+class ResponseStats:
+    """Статистика времени ответа в памяти с пакетной записью в response_times.
+
+    Записывается время ответа без ожидания места в планировщике бэкенда,
+    поэтому очередь других чатов в оценке добавляется один раз — через backlog.
+
+    Для каждого чата хранится кольцевой буфер последних ответов и EWMA,
+    плюс общая статистика по всем чатам — она используется для чатов без
+    истории. Оценка для сообщения о статусе считается без обращения к
+    SQLite; новые записи копятся и сохраняются одной транзакцией раз в
+    flush_interval секунд, а при запуске статистика восстанавливается из
+    таблицы.
+    """
+
+    def __init__(self, window=20, global_window=200, alpha=0.3, min_samples=2, flush_interval=30, max_chats=10000):
+        self.window = window
+        self.global_window = global_window
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.flush_interval = flush_interval
+        self.db_file = "context.db"
+        self._chats = LRUCache(max_size=max_chats)
+        self._global = RollingStats(global_window)
+        self._pending = []
+        self._flush_task = None
+        self._flush_lock = None
+
+    def configure(self, config):
+        """Применяет размер окна, коэффициент сглаживания и интервал записи из конфигурации."""
+        self.window = config.get("response_stats_window", self.window)
+        self.global_window = config.get("response_stats_global_window", self.global_window)
+        self.alpha = config.get("response_stats_alpha", self.alpha)
+        self.flush_interval = config.get("response_stats_flush_interval", self.flush_interval)
+        self._global.resize(self.global_window)
+
+    def _chat(self, chat_id):
+        stats = self._chats.get(chat_id)
+        if stats is None:
+            stats = RollingStats(self.window)
+            self._chats.set(chat_id, stats)
+        else:
+            stats.resize(self.window)
+        return stats
+
+    def _add(self, chat_id, response_time, max_length):
+        self._chat(chat_id).add(response_time, max_length, self.alpha)
+        self._global.add(response_time, max_length, self.alpha)
+
+    def record(self, chat_id, response_time, prompt_time=None, cache_reuse_estimated=None, max_length=None):
+        """Учитывает время ответа; запись в базу произойдёт при следующем сбросе.
+
+        cache_reuse_estimated — клиентская оценка того, что бэкенд взял промпт из кэша.
+        """
+        self._add(chat_id, response_time, max_length)
+        if cache_reuse_estimated is not None:
+            cache_reuse_estimated = int(cache_reuse_estimated)
+        self._pending.append((chat_id, response_time, int(time.time()), prompt_time, cache_reuse_estimated,
+                              max_length))
+
+    def estimate(self, chat_id, max_length=None, ahead=0, backlog=0.0):
+        """Оценивает время ответа или возвращает None, если данных мало.
+
+        max_length масштабирует оценку относительно средней длины прошлых
+        ответов; ahead — число запросов чата впереди, backlog — сколько
+        генераций других чатов приходится на одно место бэкенда.
+        """
+        stats = self._chats.get(chat_id)
+        scope = "chat"
+        if stats is None or len(stats.samples) < self.min_samples:
+            stats = self._global
+            scope = "global"
+            if len(stats.samples) < self.min_samples:
+                return None
+        base = stats.ewma
+        if max_length and stats.ewma_length:
+            base *= min(max(max_length / stats.ewma_length, 1 / MAX_LENGTH_SCALE), MAX_LENGTH_SCALE)
+        eta = base * (1 + ahead) + (self._global.ewma or base) * backlog
+        return Estimate(eta, len(stats.samples), scope, stats.percentile(0.9))
+
+    def summary(self):
+        """Общая статистика: число ответов в окне, EWMA, медиана и p90."""
+        values = sorted(self._global.samples)
+        return {
+            "count": len(values),
+            "ewma": self._global.ewma,
+            "p50": percentile(values, 0.5),
+            "p90": percentile(values, 0.9),
+            "chats": len(self._chats),
+            "pending": len(self._pending),
+        }
+
+    async def load(self, db_file="context.db"):
+        """Восстанавливает статистику из response_times (вызывается при запуске)."""
+        self.db_file = db_file
+        rows = await get_storage(db_file).fetchall(SELECT_RESPONSE_TIMES_SQL)
+        for chat_id, response_time, max_length in rows:
+            self._add(chat_id, response_time, max_length)
+        logger.info("Статистика времени ответа загружена: %s записей", len(rows))
+
+    async def flush(self):
+        """Записывает накопленные ответы одной транзакцией и удаляет старые записи их чатов."""
+        if not self._pending:
+            return
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            pending, self._pending = self._pending, []
+            statements = [(INSERT_RESPONSE_TIME_SQL, row) for row in pending]
+            for chat_id in {row[0] for row in pending}:
+                statements.append((PRUNE_RESPONSE_TIMES_SQL, (chat_id, chat_id, max(self.window, 1) - 1)))
+            try:
+                await get_storage(self.db_file).transaction(statements)
+            except Exception as e:
+                # Не теряем записи: они уйдут со следующим сбросом
+                self._pending[:0] = pending
+                logger.warning("Не удалось сохранить статистику времени ответа: %s", e)
+                return
+            logger.debug("Сохранено записей времени ответа: %s", len(pending))
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def start(self, db_file="context.db"):
+        """Загружает статистику и запускает периодическую запись в базу."""
+        await self.load(db_file)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Останавливает периодическую запись и сохраняет оставшиеся записи."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
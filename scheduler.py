@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# scheduler.py
+import asyncio
+import contextlib
+import logging
+import statistics
+import time
+from collections import deque
+from metrics import SCHEDULER_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты запросов: меньшее значение обслуживается раньше
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Приоритеты по виду запроса, если в конфигурации не задано иное
+DEFAULT_PRIORITIES = {"text": PRIORITY_NORMAL, "voice": PRIORITY_NORMAL, "continue": PRIORITY_LOW}
+
+# Способы выбора следующего чата среди ожидающих с одинаковым приоритетом:
+#   fifo        — в порядке поступления запросов;
+#   round_robin — чаты по очереди, независимо от того, сколько запросов прислал каждый;
+#   weighted    — как round_robin, но чат с весом 2 получает вдвое больше генераций.
+SCHEDULER_POLICIES = ("fifo", "round_robin", "weighted")
+
+# Сколько последних ожиданий хранится для перцентилей
+WAIT_SAMPLES = 512
+
+
+def priority_for(kind, config):
+    """Возвращает приоритет вида запроса ("text", "voice", "continue") с учётом конфигурации."""
+    priorities = config.get("scheduler_priorities", {})
+    return priorities.get(kind, DEFAULT_PRIORITIES.get(kind, PRIORITY_NORMAL))
+
+
+class _Waiter:
+    __slots__ = ("chat_id", "priority", "enqueued_at", "future")
+
+    def __init__(self, chat_id, priority, future):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.future = future
+
+
+class GenerationScheduler:
+    """Глобальная очередь генераций перед одним бэкендом.
+
+    Одновременно выполняется не больше max_in_flight запросов, остальные ждут.
+    Освободившееся место получает запрос с наивысшим приоритетом, а среди
+    равных — чат, который обслуживался меньше других (взвешенная честная
+    очередь по виртуальному времени). Ожидание повышает приоритет на одну
+    ступень каждые aging секунд, чтобы низкий приоритет не голодал.
+    """
+
+    def __init__(self, name, max_in_flight=1, policy="round_robin", weights=None, aging=60):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.policy = policy
+        self.weights = weights or {}
+        self.aging = aging
+        self.in_flight = 0
+        self._waiting = {}  # chat_id -> deque ожидающих запросов чата
+        self._vtime = {}  # chat_id -> виртуальное время окончания последнего обслуживания
+        self._vclock = 0.0
+
+        # Метрики
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._recent_waits = deque(maxlen=WAIT_SAMPLES)
+
+    def configure(self, config, max_in_flight=None):
+        """Применяет лимит параллельности, политику, веса чатов и старение из конфигурации.
+
+        max_in_flight, если задан, заменяет kobold_max_in_flight (ёмкость конкретного бэкенда).
+        """
+        if max_in_flight is None:
+            max_in_flight = config.get("kobold_max_in_flight", self.max_in_flight)
+        self.max_in_flight = max(1, max_in_flight)
+        policy = config.get("scheduler_policy", self.policy)
+        if policy not in SCHEDULER_POLICIES:
+            logger.warning("Неизвестная политика планировщика '%s', используется 'round_robin'", policy)
+            policy = "round_robin"
+        self.policy = policy
+        # Ключи JSON — строки, chat_id — целые числа
+        self.weights = {int(chat_id): weight for chat_id, weight in config.get("scheduler_chat_weights", {}).items()}
+        self.aging = config.get("scheduler_aging", self.aging)
+        # Лимит мог вырасти: раздаём освободившиеся места
+        self._dispatch()
+
+    def depth(self):
+        """Число запросов, ожидающих места на бэкенде."""
+        return sum(len(queue) for queue in self._waiting.values())
+
+    def _weight(self, chat_id):
+        if self.policy != "weighted":
+            return 1.0
+        return max(float(self.weights.get(chat_id, 1.0)), 0.01)
+
+    def _effective_priority(self, waiter, now):
+        if not self.aging:
+            return waiter.priority
+        return waiter.priority - int((now - waiter.enqueued_at) / self.aging)
+
+    def _pick(self):
+        """Извлекает следующий запрос для обслуживания или возвращает None."""
+        now = time.monotonic()
+        best_chat = None
+        best_key = None
+        for chat_id, queue in self._waiting.items():
+            head = queue[0]
+            if self.policy == "fifo":
+                key = (self._effective_priority(head, now), head.enqueued_at)
+            else:
+                start = max(self._vtime.get(chat_id, 0.0), self._vclock)
+                key = (self._effective_priority(head, now), start, head.enqueued_at)
+            if best_key is None or key < best_key:
+                best_chat, best_key = chat_id, key
+        if best_chat is None:
+            return None
+        queue = self._waiting[best_chat]
+        waiter = queue.popleft()
+        if not queue:
+            del self._waiting[best_chat]
+        start = max(self._vtime.get(best_chat, 0.0), self._vclock)
+        self._vclock = start
+        self._vtime[best_chat] = start + 1.0 / self._weight(best_chat)
+        # Чаты, отставшие от часов, ничем не отличаются от новых — их записи не нужны
+        if len(self._vtime) > 1024:
+            self._vtime = {chat_id: vtime for chat_id, vtime in self._vtime.items() if vtime > self._vclock}
+        return waiter
+
+    def _dispatch(self):
+        while self.in_flight < self.max_in_flight:
+            waiter = self._pick()
+            if waiter is None:
+                return
+            if waiter.future.done():
+                continue  # ожидание уже отменено
+            self.in_flight += 1
+            self._record_wait(time.monotonic() - waiter.enqueued_at)
+            waiter.future.set_result(None)
+
+    def _record_wait(self, waited):
+        self.granted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self._recent_waits.append(waited)
+        SCHEDULER_WAIT_SECONDS.observe(waited, backend=self.name)
+
+    async def acquire(self, chat_id, priority=PRIORITY_NORMAL):
+        """Ждёт свободного места на бэкенде. Возвращает время ожидания в секундах."""
+        if self.in_flight < self.max_in_flight and not self._waiting:
+            self.in_flight += 1
+            self._record_wait(0.0)
+            return 0.0
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(chat_id, priority, loop.create_future())
+        self._waiting.setdefault(chat_id, deque()).append(waiter)
+        logger.info("Генерация для chat_id %s ждёт места на %s: в очереди %s, выполняется %s/%s",
+                    chat_id, self.name, self.depth(), self.in_flight, self.max_in_flight)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Место уже выдано, но запрос отменён — возвращаем его
+                self.release()
+            else:
+                queue = self._waiting.get(chat_id)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._waiting[chat_id]
+            raise
+        waited = time.monotonic() - waiter.enqueued_at
+        logger.info("Генерация для chat_id %s получила место на %s после %.2f сек ожидания", chat_id, self.name, waited)
+        return waited
+
+    def release(self):
+        """Освобождает место на бэкенде и передаёт его следующему запросу."""
+        self.in_flight -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, chat_id, priority=PRIORITY_NORMAL):
+        """Контекст, удерживающий место на бэкенде на время запроса. Отдаёт время ожидания."""
+        waited = await self.acquire(chat_id, priority)
+        try:
+            yield waited
+        finally:
+            self.release()
+
+    def stats(self):
+        """Метрики планировщика: глубина очереди, загрузка и время ожидания."""
+        waits = sorted(self._recent_waits)
+        return {
+            "backend": self.name,
+            "policy": self.policy,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queue_depth": self.depth(),
+            "waiting_chats": len(self._waiting),
+            "granted": self.granted,
+            "avg_wait": self.total_wait / self.granted if self.granted else 0.0,
+            "max_wait": self.max_wait,
+            "p50_wait": statistics.median(waits) if waits else 0.0,
+            "p95_wait": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0,
+        }
+
+
+# Планировщики по адресу бэкенда
+_schedulers = {}
+
+
+def get_scheduler(backend, config):
+    """Возвращает планировщик бэкенда, применяя текущие настройки из конфигурации."""
+    scheduler = _schedulers.get(backend.base_url)
+    if scheduler is None:
+        scheduler = GenerationScheduler(backend.base_url)
+        _schedulers[backend.base_url] = scheduler
+    scheduler.configure(config, backend.capacity)
+    return scheduler
+
+
+def scheduler_stats():
+    """Метрики всех планировщиков."""
+    return [scheduler.stats() for scheduler in _schedulers.values()]
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# storage.py
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from metrics import SQLITE_QUERY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Размер кэша подготовленных выражений sqlite3 на соединение
+STATEMENT_CACHE_SIZE = 128
+# Сколько запрос ждёт блокировки базы, прежде чем завершиться ошибкой «database is locked»
+BUSY_TIMEOUT_MS = 5000
+
+
+class Storage:
+    """Хранилище на одном долгоживущем соединении SQLite.
+
+    Все запросы выполняются в отдельном потоке-исполнителе, поэтому
+    обращения к базе не блокируют цикл событий asyncio. Соединение
+    открывается в режиме WAL, а повторяющиеся запросы берутся из кэша
+    подготовленных выражений sqlite3.
+
+    Запущенный запрос нельзя прервать из asyncio: отмена ожидающей
+    корутины не останавливает поток, и следующие запросы ждут его в очереди.
+    Поэтому ожидание блокировки базы ограничено внутри самого вызова
+    (busy_timeout и timeout соединения, BUSY_TIMEOUT_MS).
+    """
+
+    def __init__(self, db_file="context.db"):
+        self.db_file = db_file
+        self._conn = None
+        # Один поток: соединение SQLite используется строго последовательно
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"sqlite-{db_file}")
+
+    def _connect(self):
+        """Открывает соединение (вызывается только из потока-исполнителя)."""
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                                   cached_statements=STATEMENT_CACHE_SIZE)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            self._conn = conn
+            logger.info("Открыто соединение с базой данных: %s (WAL)", self.db_file)
+        return self._conn
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        with SQLITE_QUERY_SECONDS.time(operation=func.__name__.lstrip("_")):
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    def _execute(self, sql, params):
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(sql, params)
+            return cursor.rowcount
+
+    def _executemany(self, sql, seq_of_params):
+        conn = self._connect()
+        with conn:
+            cursor = conn.executemany(sql, seq_of_params)
+            return cursor.rowcount
+
+    def _script(self, statements):
+        """Выполняет несколько выражений в одной транзакции."""
+        conn = self._connect()
+        with conn:
+            for sql, params in statements:
+                conn.execute(sql, params)
+
+    def _fetchone(self, sql, params):
+        return self._connect().execute(sql, params).fetchone()
+
+    def _fetchall(self, sql, params):
+        return self._connect().execute(sql, params).fetchall()
+
+    async def execute(self, sql, params=()):
+        """Выполняет изменяющий запрос и фиксирует транзакцию. Возвращает rowcount."""
+        return await self._run(self._execute, sql, params)
+
+    async def executemany(self, sql, seq_of_params):
+        """Выполняет запрос для набора параметров в одной транзакции."""
+        return await self._run(self._executemany, sql, list(seq_of_params))
+
+    async def transaction(self, statements):
+        """Выполняет список пар (sql, params) атомарно."""
+        return await self._run(self._script, list(statements))
+
+    async def fetchone(self, sql, params=()):
+        """Возвращает первую строку результата или None."""
+        return await self._run(self._fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        """Возвращает все строки результата."""
+        return await self._run(self._fetchall, sql, params)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            logger.info("Соединение с базой данных закрыто: %s", self.db_file)
+
+    async def close(self):
+        """Закрывает соединение и останавливает поток-исполнитель."""
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+
+class LRUCache:
+    """Кэш в памяти с вытеснением по LRU и необязательным временем жизни записей."""
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def configure(self, max_size=None, ttl=None):
+        """Меняет размер и TTL кэша, вытесняя лишние записи."""
+        if max_size is not None:
+            self.max_size = max_size
+        self.ttl = ttl
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        value, stored_at = item
+        if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return item[0] if item is not None else default
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Хранилища по имени файла базы данных
+_storages = {}
+
+
+def get_storage(db_file="context.db"):
+    """Возвращает общее хранилище для указанного файла базы данных."""
+    storage = _storages.get(db_file)
+    if storage is None:
+        storage = Storage(db_file)
+        _storages[db_file] = storage
+    return storage
+
+
+async def close_storages():
+    """Закрывает все открытые хранилища (вызывается при остановке бота)."""
+    while _storages:
+        _, storage = _storages.popitem()
+        await storage.close()
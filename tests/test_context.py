@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# tests/test_context.py
+import asyncio
+import sqlite3
+import context
+from context import CREATE_TURNS_TABLE_SQL, SYSTEM_PROMPT_START, SYSTEM_PROMPT_END, load_turns, has_turns
+from storage import close_storages
+
+
+def test_concurrent_legacy_migration_runs_once(tmp_path):
+    db_file = str(tmp_path / "context.db")
+    conn = sqlite3.connect(db_file)
+    conn.execute("CREATE TABLE user_context (chat_id INTEGER PRIMARY KEY, context TEXT NOT NULL)")
+    conn.execute(CREATE_TURNS_TABLE_SQL)
+    legacy = f"{SYSTEM_PROMPT_START}Ты — Врок.{SYSTEM_PROMPT_END}User: привет\nVrok: здравствуй"
+    conn.execute("INSERT INTO user_context (chat_id, context) VALUES (?, ?)", (42, legacy))
+    conn.commit()
+    conn.close()
+
+    async def run():
+        try:
+            return await asyncio.gather(load_turns(42, db_file=db_file), load_turns(42, db_file=db_file),
+                                        has_turns(42, db_file=db_file))
+        finally:
+            await close_storages()
+
+    context._legacy_checked.discard(42)
+    (first_system, first_turns), (second_system, second_turns), present = asyncio.run(run())
+    assert present
+    assert first_system.text == second_system.text == "Ты — Врок."
+    assert [turn.text for turn in first_turns] == [turn.text for turn in second_turns] == ["User: привет", "\nVrok: здравствуй"]
+    conn = sqlite3.connect(db_file)
+    assert conn.execute("SELECT COUNT(*) FROM context_turns WHERE chat_id = 42").fetchone()[0] == 3
+    assert conn.execute("SELECT COUNT(*) FROM user_context").fetchone()[0] == 0
+    conn.close()
+    assert 42 not in context._legacy_locks
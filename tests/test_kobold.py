@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# tests/test_kobold.py
+import asyncio
+import json
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import unused_port
+from kobold import KoboldBackend, read_token_stream
+from payload import dumps
+from utils import request_generation
+
+SSE_BODY = (
+    "event: message\n"
+    'data: {"token": "Hel"}\n\n'
+    "data: not json\n\n"
+    "data:\n\n"
+    ": keep-alive\n\n"
+    'data: {"token": "lo"}\n\n'
+    'data: {"finish_reason": "length"}\n\n'
+    'data: {"token": "!"}\n\n'
+)
+
+
+async def serve(routes):
+    """Поднимает заглушку Kobold на свободном порту и возвращает (runner, base_url)."""
+    app = web.Application()
+    for method, path, handler in routes:
+        app.router.add_route(method, path, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = unused_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, f"http://127.0.0.1:{port}"
+
+
+async def sse(request):
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    # Токены приходят отдельными частями, как у KoboldCpp
+    for event in SSE_BODY.split("\n\n"):
+        await response.write((event + "\n\n").encode())
+        await asyncio.sleep(0)
+    await response.write_eof()
+    return response
+
+
+def test_read_token_stream_accumulates_tokens_and_skips_malformed_lines():
+    async def run():
+        runner, base_url = await serve([("POST", "/stream", sse)])
+        partials = []
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(f"{base_url}/stream") as response:
+                    text = await read_token_stream(response, partials.append)
+        finally:
+            await runner.cleanup()
+        return text, partials
+
+    text, partials = asyncio.run(run())
+    assert text == "Hello!"
+    assert partials == ["Hel", "Hello", "Hello!"]
+
+
+def test_request_generation_streams_tokens():
+    async def run():
+        runner, base_url = await serve([("POST", "/api/extra/generate/stream", sse)])
+        backend = KoboldBackend(f"{base_url}/api/v1/generate")
+        await backend.start()
+        partials = []
+        try:
+            result, error = await request_generation(backend, dumps({"prompt": "Hi"}), {}, 1, partials.append)
+        finally:
+            await backend.close()
+            await runner.cleanup()
+        return result, error, partials
+
+    result, error, partials = asyncio.run(run())
+    assert error is None
+    assert result == {"results": [{"text": "Hello!"}]}
+    assert partials[-1] == "Hello!"
+
+
+def test_request_generation_falls_back_when_stream_endpoint_is_missing():
+    calls = []
+
+    async def generate(request):
+        calls.append(json.loads(await request.read()))
+        return web.json_response({"results": [{"text": "plain answer"}]})
+
+    async def run():
+        # Эндпоинта потоковой генерации нет: заглушка отвечает 404
+        runner, base_url = await serve([("POST", "/api/v1/generate", generate)])
+        backend = KoboldBackend(f"{base_url}/api/v1/generate")
+        await backend.start()
+        partials = []
+        try:
+            result, error = await request_generation(backend, dumps({"prompt": "Hi"}), {}, 1, partials.append)
+            supports_stream = backend.supports_stream
+        finally:
+            await backend.close()
+            await runner.cleanup()
+        return result, error, supports_stream
+
+    result, error, supports_stream = asyncio.run(run())
+    assert error is None
+    assert result["results"][0]["text"] == "plain answer"
+    assert supports_stream is False
+    assert calls == [{"prompt": "Hi"}]
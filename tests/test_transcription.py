@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# tests/test_transcription.py
+from transcription import batch_layout, SAMPLE_RATE, WINDOW_SECONDS
+
+
+def test_batch_layout_windows_are_sample_offsets():
+    lengths = [2 * SAMPLE_RATE, SAMPLE_RATE // 2]
+    spans, windows = batch_layout(lengths)
+    assert windows == [
+        {"start": 0, "end": 2 * SAMPLE_RATE},
+        {"start": 2 * SAMPLE_RATE, "end": 2 * SAMPLE_RATE + SAMPLE_RATE // 2},
+    ]
+    assert all(isinstance(value, int) for window in windows for value in window.values())
+    # Границы сообщений для раскладки сегментов остаются в секундах
+    assert spans == [(0.0, 2.0), (2.0, 2.5)]
+
+
+def test_batch_layout_splits_long_clip_into_model_windows():
+    window = WINDOW_SECONDS * SAMPLE_RATE
+    spans, windows = batch_layout([SAMPLE_RATE, 2 * window + SAMPLE_RATE])
+    assert [(w["start"], w["end"]) for w in windows] == [
+        (0, SAMPLE_RATE),
+        (SAMPLE_RATE, SAMPLE_RATE + window),
+        (SAMPLE_RATE + window, SAMPLE_RATE + 2 * window),
+        (SAMPLE_RATE + 2 * window, 2 * SAMPLE_RATE + 2 * window),
+    ]
+    assert spans[1] == (1.0, 2.0 + 2 * WINDOW_SECONDS)
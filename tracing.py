@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# tracing.py
+import contextlib
+import json
+import logging
+import time
+from storage import get_storage
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Этапы подготовки ответа в порядке выполнения и их подписи для /traces
+STAGES = (
+    ("transcription", "распознавание речи"),
+    ("queue_wait", "очередь чата"),
+    ("settings", "настройки"),
+    ("input_translation", "перевод запроса"),
+    ("context", "контекст"),
+    ("prompt_build", "сборка промпта"),
+    ("scheduler_wait", "ожидание бэкенда"),
+    ("kobold_first_token", "первый токен"),
+    ("kobold_total", "генерация"),
+    ("output_translation", "перевод ответа"),
+    ("context_save", "сохранение контекста"),
+    ("telegram_send", "отправка"),
+)
+
+REPLY_STAGE_SECONDS = Histogram("reply_stage_seconds", "Длительность этапа подготовки ответа", ("stage",))
+
+CREATE_TRACES_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS reply_traces (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        total REAL NOT NULL,
+        stages TEXT NOT NULL
+    )
+'''
+CREATE_TRACES_INDEX_SQL = "CREATE INDEX IF NOT EXISTS reply_traces_chat ON reply_traces (chat_id, id)"
+
+INSERT_TRACE_SQL = "INSERT INTO reply_traces (chat_id, kind, timestamp, total, stages) VALUES (?, ?, ?, ?, ?)"
+# Оставляем только последние keep трассировок чата
+PRUNE_TRACES_SQL = '''
+    DELETE FROM reply_traces WHERE chat_id = ? AND id < (
+        SELECT id FROM reply_traces WHERE chat_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+    )
+'''
+SELECT_TRACES_SQL = "SELECT timestamp, kind, total, stages FROM reply_traces WHERE chat_id = ? ORDER BY id DESC LIMIT ?"
+
+
+class ReplyTrace:
+    """Время этапов подготовки одного ответа.
+
+    started — момент постановки запроса в очередь (time.monotonic()), от
+    него считается полное время ответа. Повторные замеры одного этапа
+    (например, попытки на разных бэкендах) суммируются.
+    """
+
+    __slots__ = ("chat_id", "kind", "started", "timestamp", "stages", "total")
+
+    def __init__(self, chat_id, kind, started=None):
+        self.chat_id = chat_id
+        self.kind = kind
+        self.started = time.monotonic() if started is None else started
+        self.timestamp = int(time.time())
+        self.stages = {}
+        self.total = None
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Замеряет длительность блока как этап name."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def first_token_hook(self, callback, started):
+        """Оборачивает on_partial так, чтобы первый токен отметил время до первого токена."""
+        def on_partial(text):
+            if "kobold_first_token" not in self.stages:
+                self.add("kobold_first_token", time.perf_counter() - started)
+            return callback(text)
+        return on_partial
+
+    def finish(self):
+        """Фиксирует полное время ответа."""
+        self.total = time.monotonic() - self.started
+        return self.total
+
+    def summary(self):
+        """Этапы одной строкой: «очередь чата 0.00 · настройки 0.01 · ...»."""
+        return format_stages(self.stages)
+
+
+def trace_stage(trace, name):
+    """trace.stage(name) или пустой контекст, если трассировка не ведётся."""
+    if trace is None:
+        return contextlib.nullcontext()
+    return trace.stage(name)
+
+
+def format_stages(stages):
+    parts = [f"{label} {stages[name]:.2f}" for name, label in STAGES if name in stages]
+    return " · ".join(parts)
+
+
+async def save_trace(trace, keep=50, db_file="context.db"):
+    """Пишет трассировку в журнал, метрики и таблицу reply_traces (последние keep на чат)."""
+    total = trace.total if trace.total is not None else trace.finish()
+    logger.info("Трассировка ответа chat_id %s (%s): всего %.2f сек; %s", trace.chat_id, trace.kind, total, trace.summary())
+    for stage, seconds in trace.stages.items():
+        REPLY_STAGE_SECONDS.observe(seconds, stage=stage)
+    await get_storage(db_file).transaction([
+        (INSERT_TRACE_SQL, (trace.chat_id, trace.kind, trace.timestamp, total,
+                            json.dumps({stage: round(seconds, 4) for stage, seconds in trace.stages.items()}))),
+        (PRUNE_TRACES_SQL, (trace.chat_id, trace.chat_id, max(keep, 1) - 1)),
+    ])
+
+
+async def recent_traces(chat_id, limit=5, db_file="context.db"):
+    """Последние трассировки чата: список (timestamp, kind, total, {этап: сек}), новые первыми."""
+    rows = await get_storage(db_file).fetchall(SELECT_TRACES_SQL, (chat_id, limit))
+    return [(timestamp, kind, total, json.loads(stages)) for timestamp, kind, total, stages in rows]
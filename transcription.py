@@ -0,0 +1,618 @@
+# -*- coding: utf-8 -*-
+# transcription.py
+import asyncio
+import contextlib
+import importlib.util
+import logging
+import multiprocessing
+import os
+import pickle
+import re
+import socket
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.reduction import ForkingPickler
+from telebot import asyncio_helper
+from metrics import Histogram, ERRORS_TOTAL
+
+logger = logging.getLogger(__name__)
+
+TRANSCRIPTION_SECONDS = Histogram(
+    "transcription_seconds", "Длительность распознавания голосового сообщения", ("backend", "outcome"))
+TRANSCRIPTION_BATCH_SIZE = Histogram(
+    "transcription_batch_size", "Число сообщений в пакете распознавания", (), (1, 2, 4, 8, 16, 32))
+
+# Метки времени, которые утилита пишет перед каждым сегментом: [00:01.000 --> 00:04.000]
+TIMESTAMP_PATTERN = re.compile(r'\[\d{2}:\d{2}\.\d{3} --> \d{2}:\d{2}\.\d{3}\]\s*')
+
+# Размер части при потоковом скачивании голосового сообщения
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Байт, которым процесс с моделью подтверждает, что готов читать аудио из сокета
+STREAM_READY = b"\x01"
+
+# Частота дискретизации, с которой работает whisper, и максимальная длина окна модели в секундах
+SAMPLE_RATE = 16000
+WINDOW_SECONDS = 30
+
+
+class TranscriptionError(Exception):
+    """Ошибка распознавания; текст исключения можно показать пользователю."""
+
+
+async def telegram_file_chunks(token, file_path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Скачивает файл Telegram частями через сессию telebot.
+
+    Следующая часть читается из сети, только когда потребитель обработал
+    предыдущую: буфер aiohttp ограничен, и при его заполнении чтение из
+    сокета приостанавливается.
+    """
+    if asyncio_helper.FILE_URL is None:
+        url = f"https://api.telegram.org/file/bot{token}/{file_path}"
+    else:
+        url = asyncio_helper.FILE_URL.format(token, file_path)
+    session = await asyncio_helper.session_manager.get_session()
+    async with session.get(url, proxy=asyncio_helper.proxy) as response:
+        if response.status != 200:
+            raise asyncio_helper.ApiHTTPException('Download file', response)
+        async for chunk in response.content.iter_chunked(chunk_size):
+            yield chunk
+
+
+async def _single_chunk(audio):
+    yield audio
+
+
+# Модель живёт в процессе-обработчике пула и загружается один раз при его запуске
+_worker_model = None
+_worker_pipeline = None
+_worker_options = None
+
+
+def _init_worker(model_name, device, compute_type, cpu_threads, options):
+    global _worker_model, _worker_pipeline, _worker_options
+    from faster_whisper import WhisperModel
+    _worker_model = WhisperModel(model_name, device=device, compute_type=compute_type, cpu_threads=cpu_threads)
+    _worker_options = options
+    try:
+        from faster_whisper import BatchedInferencePipeline
+    except ImportError:
+        # Старые версии faster-whisper: пакет распознаётся по одному сообщению
+        _worker_pipeline = None
+    else:
+        _worker_pipeline = BatchedInferencePipeline(model=_worker_model)
+
+
+def _worker_ping():
+    return os.getpid()
+
+
+def _open_stream(source):
+    """Открывает сокет, переданный из основного процесса, и подтверждает готовность читать.
+
+    Основной процесс начинает скачивать файл только после подтверждения,
+    а декодер читает аудио из сокета по мере поступления частей.
+    """
+    sock = pickle.loads(source)
+    try:
+        sock.sendall(STREAM_READY)
+        return sock.makefile("rb")
+    finally:
+        # makefile держит свою ссылку на сокет
+        sock.close()
+
+
+def _transcribe_file(audio):
+    segments, _ = _worker_model.transcribe(audio, **_worker_options)
+    return " ".join(segment.text.strip() for segment in segments).strip()
+
+
+def _worker_transcribe(source):
+    with _open_stream(source) as audio:
+        return _transcribe_file(audio)
+
+
+def batch_layout(lengths, sampling_rate=SAMPLE_RATE, window_seconds=WINDOW_SECONDS):
+    """Раскладка склеенных сообщений по длинам в отсчётах.
+
+    Возвращает (spans, windows): границы сообщений в секундах — по ним
+    сегменты результата раскладываются обратно, и окна модели для
+    clip_timestamps. faster-whisper режет аудио по clip_timestamps в
+    отсчётах, поэтому окна задаются целыми индексами отсчётов.
+    """
+    spans, windows = [], []
+    window = int(window_seconds * sampling_rate)
+    offset = 0
+    for length in lengths:
+        spans.append((offset / sampling_rate, (offset + length) / sampling_rate))
+        for start in range(offset, offset + length, window):
+            windows.append({"start": start, "end": min(start + window, offset + length)})
+        offset += length
+    return spans, windows
+
+
+def _worker_transcribe_batch(sources):
+    """Распознаёт пакет сообщений одним проходом модели.
+
+    Сообщения декодируются и склеиваются в одну дорожку, а границы
+    сообщений (порезанные на окна модели) передаются в clip_timestamps,
+    поэтому кодировщик обрабатывает окна всех сообщений пакетами. Сегменты
+    результата раскладываются обратно по сообщениям по времени начала.
+    Готовность подтверждается сразу по всем сокетам, поэтому основной
+    процесс скачивает сообщения пакета параллельно, пока они декодируются.
+    Возвращает список: текст или исключение для каждого сообщения.
+    """
+    streams = [_worker_safe(_open_stream, source) for source in sources]
+    try:
+        return _transcribe_streams(streams)
+    finally:
+        for stream in streams:
+            if not isinstance(stream, Exception):
+                stream.close()
+
+
+def _transcribe_streams(streams):
+    if _worker_pipeline is None or len(streams) == 1:
+        return [stream if isinstance(stream, Exception) else _worker_safe(_transcribe_file, stream)
+                for stream in streams]
+    import numpy
+    from faster_whisper import decode_audio
+    results = [None] * len(streams)
+    indices, parts = [], []
+    for index, stream in enumerate(streams):
+        if isinstance(stream, Exception):
+            results[index] = stream
+            continue
+        try:
+            parts.append(decode_audio(stream, sampling_rate=SAMPLE_RATE))
+        except Exception as e:
+            results[index] = e
+            continue
+        indices.append(index)
+    if not parts:
+        return results
+    bounds, windows = batch_layout([len(samples) for samples in parts])
+    spans = [(index, start, end) for index, (start, end) in zip(indices, bounds)]
+    options = dict(_worker_options, vad_filter=False)
+    try:
+        segments, _ = _worker_pipeline.transcribe(numpy.concatenate(parts), clip_timestamps=windows,
+                                                  batch_size=len(windows), **options)
+        texts = {index: [] for index, _, _ in spans}
+        for segment in segments:
+            # Сегмент принадлежит сообщению, в границы которого попадает его начало
+            for index, start, end in spans:
+                if start <= segment.start < end:
+                    texts[index].append(segment.text.strip())
+                    break
+    except Exception as e:
+        for index, _, _ in spans:
+            results[index] = e
+        return results
+    for index, parts_text in texts.items():
+        results[index] = " ".join(parts_text).strip()
+    return results
+
+
+def _worker_safe(func, *args):
+    try:
+        return func(*args)
+    except Exception as e:
+        return e
+
+
+class MicroBatcher:
+    """Собирает запросы, пришедшие в течение window секунд, в пакеты до max_size штук.
+
+    Первый запрос открывает окно; пакет отправляется в run_batch(список)
+    по истечении окна или сразу при наборе max_size. run_batch возвращает
+    результаты в том же порядке; исключение в списке результатов
+    передаётся только своему вызывающему.
+    """
+
+    def __init__(self, run_batch, window=0.05, max_size=4):
+        self.run_batch = run_batch
+        self.window = window
+        self.max_size = max_size
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # Вызывающие, ушедшие до отправки пакета, в него не попадают
+        batch, self._pending = [entry for entry in self._pending if not entry[1].done()], []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        TRANSCRIPTION_BATCH_SIZE.observe(len(batch))
+        try:
+            results = await self.run_batch([item for item, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            # Вызывающий мог уже уйти по тайм-ауту
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class WhisperBackend:
+    """Распознавание моделью faster-whisper в пуле процессов.
+
+    Каждый процесс пула один раз загружает модель и держит её в памяти,
+    поэтому сообщение стоит только времени декодирования. Аудио передаётся
+    в процесс через сокет по мере скачивания, без буфера и временных
+    файлов в основном процессе. При batch_size
+    больше 1 сообщения, пришедшие в течение batch_window секунд,
+    распознаются одним пакетом.
+    """
+
+    name = "whisper"
+
+    def __init__(self, model="small", device="cpu", compute_type="int8", cpu_threads=0, workers=1,
+                 language="ru", beam_size=5, vad_filter=True, batch_size=1, batch_window=0.05):
+        # Необязательная зависимость: без неё бэкенд просто не подключается
+        if importlib.util.find_spec("faster_whisper") is None:
+            raise ImportError("пакет faster_whisper не установлен")
+        self.model = model
+        self.workers = workers
+        self.batch_size = max(batch_size, 1)
+        self._batcher = MicroBatcher(self._run_batch, batch_window, self.batch_size) if self.batch_size > 1 else None
+        options = {"language": language or None, "beam_size": beam_size, "vad_filter": vad_filter}
+        self._initargs = (model, device, compute_type, cpu_threads, options)
+        self._executor = self._create_executor()
+
+    def _create_executor(self):
+        # spawn: процессы не наследуют потоки и сессии основного процесса
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=self._initargs,
+        )
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            # Процесс с моделью аварийно завершился: следующий запрос получит новый пул
+            if self._executor is executor:
+                logger.error("Пул процессов распознавания сломан, создаётся заново")
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._create_executor()
+            raise
+
+    async def warm_up(self):
+        """Запускает процессы пула, чтобы модель загрузилась до первого сообщения."""
+        started = time.perf_counter()
+        pids = await asyncio.gather(*(self._run(_worker_ping) for _ in range(self.workers)))
+        logger.info("Модель распознавания %s загружена в %s процесс(ах) за %.1f сек",
+                    self.model, len(set(pids)), time.perf_counter() - started)
+
+    async def transcribe_stream(self, chunks):
+        """Передаёт части аудио процессу с моделью по мере их получения.
+
+        Процессу отдаётся один конец пары сокетов; когда он подтверждает
+        готовность, части пишутся в сокет, и декодер читает их, пока файл
+        ещё скачивается. Основной процесс не держит аудио целиком. whisper
+        строит признаки по всей дорожке, поэтому сам проход модели
+        начинается после конца файла; перекрываются скачивание и
+        декодирование opus.
+        """
+        loop = asyncio.get_running_loop()
+        parent, child = socket.socketpair()
+        try:
+            parent.setblocking(False)
+            # Сокет сериализуется сразу: к моменту отправки пакета он может быть уже закрыт
+            source = bytes(ForkingPickler.dumps(child))
+        finally:
+            child.close()
+        with parent:
+            if self._batcher is not None:
+                result = asyncio.ensure_future(self._batcher.submit(source))
+            else:
+                result = asyncio.ensure_future(self._run(_worker_transcribe, source))
+            ready = asyncio.ensure_future(loop.sock_recv(parent, 1))
+            try:
+                await asyncio.wait((ready, result), return_when=asyncio.FIRST_COMPLETED)
+                if ready.done() and ready.result() == STREAM_READY:
+                    try:
+                        async for chunk in chunks:
+                            await loop.sock_sendall(parent, chunk)
+                        parent.shutdown(socket.SHUT_WR)
+                    except ConnectionError:
+                        # Процесс перестал читать: причину сообщит результат
+                        pass
+                return await result
+            finally:
+                for future in (ready, result):
+                    if not future.done():
+                        future.cancel()
+
+    async def _run_batch(self, sources):
+        return await self._run(_worker_transcribe_batch, sources)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ToolBackend:
+    """Распознавание внешней утилитой (audio_to_text_tool), как раньше.
+
+    input_mode="file": утилита принимает путь к .ogg и пишет рядом .txt,
+    поэтому части аудио по мере получения дописываются во временный файл
+    (без буфера в памяти). input_mode="stdin": части пишутся во входной
+    поток утилиты по мере скачивания, а текст читается из её вывода
+    (utf-8). Модель загружается заново при каждом вызове.
+    """
+
+    name = "tool"
+
+    def __init__(self, tool, input_mode="file"):
+        if input_mode not in ("file", "stdin"):
+            raise ValueError(f"Неизвестный режим передачи аудио утилите: {input_mode}")
+        self.tool = tool
+        self.input_mode = input_mode
+
+    async def warm_up(self):
+        pass
+
+    async def transcribe_stream(self, chunks):
+        if self.input_mode == "stdin":
+            return await self._transcribe_stdin(chunks)
+        return await self._transcribe_file(chunks)
+
+    async def _transcribe_stdin(self, chunks):
+        process = await asyncio.create_subprocess_exec(
+            self.tool, "-",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        # Вывод читается параллельно с записью, иначе утилита может встать на полном канале
+        output = asyncio.ensure_future(asyncio.gather(process.stdout.read(), process.stderr.read()))
+        try:
+            try:
+                async for chunk in chunks:
+                    process.stdin.write(chunk)
+                    await process.stdin.drain()
+                process.stdin.close()
+            except ConnectionError:
+                # Утилита закрыла вход раньше времени: причину покажут код завершения и stderr
+                pass
+            stdout, stderr = await output
+            await process.wait()
+        except (asyncio.CancelledError, Exception):
+            output.cancel()
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        self._check_result(process, stdout, stderr)
+        return TIMESTAMP_PATTERN.sub('', stdout.decode('utf-8', errors='replace')).strip()
+
+    async def _transcribe_file(self, chunks):
+        temp_audio = tempfile.NamedTemporaryFile(delete=False, suffix=".ogg")
+        audio_file_path = temp_audio.name
+        text_file_path = os.path.splitext(audio_file_path)[0] + ".txt"
+        try:
+            with temp_audio:
+                async for chunk in chunks:
+                    temp_audio.write(chunk)
+            logger.debug("Аудио сохранено во временный файл: %s, утилита: %s", audio_file_path, self.tool)
+            process = await asyncio.create_subprocess_exec(
+                self.tool, audio_file_path,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                stdout, stderr = await process.communicate()
+            except (asyncio.CancelledError, Exception):
+                # Тайм-аут или остановка: утилита не должна продолжать работу без нас
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+            self._check_result(process, stdout, stderr)
+            try:
+                with open(text_file_path, 'r', encoding='utf-8') as text_file:
+                    raw_text = text_file.read()
+            except FileNotFoundError:
+                logger.error("Утилита не создала выходной файл: %s", text_file_path)
+                raise TranscriptionError("Ошибка: утилита не создала текстовый файл с распознанным текстом.")
+            logger.debug("Прочитан текст из файла: %s...", raw_text[:50])
+            return TIMESTAMP_PATTERN.sub('', raw_text).strip()
+        finally:
+            for path in (audio_file_path, text_file_path):
+                try:
+                    if os.path.exists(path):
+                        os.remove(path)
+                except OSError as e:
+                    logger.warning("Не удалось удалить временный файл %s: %s", path, e)
+
+    def _check_result(self, process, stdout, stderr):
+        # Логируем вывод утилиты
+        try:
+            stdout_str = stdout.decode('cp866').strip() if stdout else "нет вывода"
+        except UnicodeDecodeError as e:
+            stdout_str = f"ошибка декодирования: {str(e)}"
+            logger.warning("Не удалось декодировать stdout утилиты %s: %s...", self.tool, stdout[:100])
+        try:
+            stderr_str = stderr.decode('cp866').strip() if stderr else "нет ошибок"
+        except UnicodeDecodeError as e:
+            stderr_str = f"ошибка декодирования: {str(e)}"
+            logger.warning("Не удалось декодировать stderr утилиты %s: %s...", self.tool, stderr[:100])
+        logger.debug("Вывод утилиты (stdout): %s...", stdout_str[:100])
+        logger.debug("Ошибки утилиты (stderr): %s...", stderr_str[:100])
+        logger.debug("Код завершения утилиты: %s", process.returncode)
+
+        # Проверяем код завершения и наличие ошибок в stderr
+        if process.returncode != 0 or (stderr and stderr_str != "нет ошибок"):
+            logger.error("Утилита завершилась с проблемой (returncode=%s): %s...", process.returncode, stderr_str[:100])
+            raise TranscriptionError("Ошибка: утилита преобразования аудио завершилась с ошибкой или не выполнила задачу.")
+
+    def close(self):
+        pass
+
+
+def tool_backend(config):
+    return ToolBackend(config.get("audio_to_text_tool", "Transcribe.cmd"),
+                       config.get("audio_to_text_tool_input", "file"))
+
+
+def create_backend(config):
+    """Создаёт бэкенд распознавания по transcription_backend из конфигурации.
+
+    "auto" (по умолчанию) — whisper, если установлен faster_whisper, иначе утилита.
+    """
+    name = config.get("transcription_backend", "auto")
+    if name == "auto":
+        name = "whisper" if importlib.util.find_spec("faster_whisper") is not None else "tool"
+    if name == "whisper":
+        return WhisperBackend(
+            model=config.get("whisper_model", "small"),
+            device=config.get("whisper_device", "cpu"),
+            compute_type=config.get("whisper_compute_type", "int8"),
+            cpu_threads=config.get("whisper_cpu_threads", 0),
+            workers=config.get("transcription_concurrency", 1),
+            language=config.get("whisper_language", "ru"),
+            beam_size=config.get("whisper_beam_size", 5),
+            batch_size=config.get("transcription_batch_size", 4),
+            batch_window=config.get("transcription_batch_window", 0.05),
+        )
+    if name == "tool":
+        return tool_backend(config)
+    raise ValueError(f"Неизвестный бэкенд распознавания: {name}")
+
+
+# Параметры конфигурации, при изменении которых бэкенд пересоздаётся
+BACKEND_KEYS = ("transcription_backend", "transcription_concurrency", "audio_to_text_tool",
+                "audio_to_text_tool_input", "whisper_model",
+                "whisper_device", "whisper_compute_type", "whisper_cpu_threads", "whisper_language", "whisper_beam_size",
+                "transcription_batch_size", "transcription_batch_window")
+
+
+class TranscriptionService:
+    """Асинхронное распознавание голосовых сообщений.
+
+    Одновременно выполняется не больше transcription_concurrency
+    распознаваний (для whisper — столько пакетов по batch_size сообщений),
+    каждое ограничено тайм-аутом. Аудио читается из
+    источника частями уже внутри слота, поэтому ожидающие сообщения не
+    держат файлы в памяти, а размер одного сообщения ограничен max_bytes.
+    Если бэкенд whisper недоступен (не установлен faster_whisper),
+    используется утилита.
+    """
+
+    def __init__(self, concurrency=1, timeout=300, max_bytes=20 * 1024 * 1024):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.backend = None
+        self._settings = None
+        self._semaphore = None
+
+    def configure(self, config):
+        """Применяет бэкенд, параллельность и тайм-аут; бэкенд пересоздаётся только при изменении настроек."""
+        self.timeout = config.get("transcription_timeout", self.timeout)
+        self.max_bytes = config.get("transcription_max_bytes", self.max_bytes)
+        settings = tuple(config.get(key) for key in BACKEND_KEYS)
+        if settings == self._settings:
+            return
+        try:
+            backend = create_backend(config)
+        except Exception as e:
+            logger.warning("Бэкенд распознавания '%s' недоступен: %s, используется утилита %s",
+                           config.get('transcription_backend'), e, config.get('audio_to_text_tool'))
+            backend = tool_backend(config)
+        if self.backend is not None:
+            self.backend.close()
+        self.backend = backend
+        self._settings = settings
+        self.concurrency = config.get("transcription_concurrency", self.concurrency)
+        self._semaphore = None
+        logger.info("Распознавание речи: бэкенд %s, параллельность %s, пакет %s, тайм-аут %s сек",
+                    backend.name, self.concurrency, getattr(backend, 'batch_size', 1), self.timeout)
+
+    async def warm_up(self):
+        """Заранее загружает модель (для бэкенда whisper)."""
+        try:
+            await self.backend.warm_up()
+        except Exception as e:
+            logger.error("Не удалось загрузить модель распознавания: %s", e, exc_info=True)
+
+    async def transcribe(self, audio):
+        """Распознаёт аудио (bytes) и возвращает текст."""
+        return await self.transcribe_stream(_single_chunk(audio), len(audio))
+
+    def _too_large(self):
+        return TranscriptionError(f"Ошибка: голосовое сообщение больше {self.max_bytes / (1024 * 1024):.1f} МБ, "
+                                  f"распознать его нельзя.")
+
+    async def _limit(self, chunks):
+        received = 0
+        async for chunk in chunks:
+            received += len(chunk)
+            if received > self.max_bytes:
+                raise self._too_large()
+            yield chunk
+
+    async def transcribe_stream(self, chunks, size=None):
+        """Распознаёт аудио из асинхронного итератора частей (bytes) и возвращает текст.
+
+        size — заявленный размер файла, если известен: слишком большой файл
+        отклоняется до скачивания. Выбрасывает TranscriptionError с
+        сообщением для пользователя.
+        """
+        async with contextlib.aclosing(chunks):
+            if size is not None and size > self.max_bytes:
+                ERRORS_TOTAL.inc(source="transcription", type="TooLarge")
+                raise self._too_large()
+            return await self._transcribe(chunks)
+
+    async def _transcribe(self, chunks):
+        backend = self.backend
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency * getattr(backend, "batch_size", 1))
+        async with self._semaphore:
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                text = await asyncio.wait_for(backend.transcribe_stream(self._limit(chunks)), self.timeout)
+                outcome = "ok"
+            except TranscriptionError:
+                ERRORS_TOTAL.inc(source="transcription", type="TranscriptionError")
+                raise
+            except asyncio.TimeoutError:
+                ERRORS_TOTAL.inc(source="transcription", type="TimeoutError")
+                raise TranscriptionError(f"Ошибка: распознавание речи не уложилось в {self.timeout} сек.")
+            except Exception as e:
+                logger.error("Ошибка распознавания (%s): %s", backend.name, e, exc_info=True)
+                ERRORS_TOTAL.inc(source="transcription", type=type(e).__name__)
+                raise TranscriptionError("Ошибка: не удалось распознать голосовое сообщение.")
+            finally:
+                TRANSCRIPTION_SECONDS.observe(time.perf_counter() - started, backend=backend.name, outcome=outcome)
+        logger.info("Аудио преобразовано в текст за %.2f сек (%s)", time.perf_counter() - started, backend.name)
+        return text
+
+    def close(self):
+        if self.backend is not None:
+            self.backend.close()
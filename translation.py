@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+# translation.py
+import asyncio
+import json
+import logging
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import certifi
+from deep_translator import GoogleTranslator
+from storage import get_storage, LRUCache
+from metrics import TRANSLATION_SECONDS, TRANSLATION_CACHE_TOTAL
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text):
+    """Нормализует текст для ключа кэша: убирает лишние пробелы по краям и внутри."""
+    return " ".join(text.split())
+
+
+class TranslationCache:
+    """Двухуровневый кэш переводов: LRU в памяти и необязательная таблица SQLite.
+
+    Ключ — (направление, нормализованный текст). Попадание в любой уровень
+    избавляет от сетевого запроса; найденное в SQLite поднимается в память.
+    """
+
+    CREATE_TABLE_SQL = '''
+        CREATE TABLE IF NOT EXISTS translation_cache (
+            direction TEXT NOT NULL,
+            source TEXT NOT NULL,
+            translated TEXT NOT NULL,
+            created INTEGER NOT NULL,
+            PRIMARY KEY (direction, source)
+        )
+    '''
+
+    def __init__(self, max_size=2000, persistent=False, db_file="context.db", max_text_length=2000):
+        self.memory = LRUCache(max_size=max_size)
+        self.persistent = persistent
+        self.db_file = db_file
+        self.max_text_length = max_text_length
+        self.persistent_hits = 0
+        self.misses = 0
+        self._table_ready = False
+
+    def configure(self, config):
+        self.memory.configure(config.get("translation_cache_size", self.memory.max_size))
+        self.persistent = config.get("translation_cache_persistent", self.persistent)
+        self.db_file = config.get("translation_cache_db", self.db_file)
+        self.max_text_length = config.get("translation_cache_max_text", self.max_text_length)
+        self._table_ready = False
+
+    @staticmethod
+    def _direction(to_english):
+        return "ru-en" if to_english else "en-ru"
+
+    async def _storage(self):
+        storage = get_storage(self.db_file)
+        if not self._table_ready:
+            await storage.execute(self.CREATE_TABLE_SQL)
+            self._table_ready = True
+        return storage
+
+    def cacheable(self, text):
+        return 0 < len(text) <= self.max_text_length
+
+    async def get(self, text, to_english):
+        """Возвращает перевод из кэша или None."""
+        key = (self._direction(to_english), normalize_text(text))
+        translated = self.memory.get(key)
+        if translated is not None:
+            return translated
+        if self.persistent:
+            try:
+                storage = await self._storage()
+                row = await storage.fetchone(
+                    'SELECT translated FROM translation_cache WHERE direction = ? AND source = ?', key)
+            except Exception as e:
+                logger.warning("Ошибка чтения кэша переводов: %s", e)
+                row = None
+            if row:
+                self.persistent_hits += 1
+                self.memory.set(key, row[0])
+                return row[0]
+        self.misses += 1
+        return None
+
+    async def put(self, text, to_english, translated):
+        """Сохраняет перевод в память и, если включено, в SQLite."""
+        key = (self._direction(to_english), normalize_text(text))
+        self.memory.set(key, translated)
+        if self.persistent:
+            try:
+                storage = await self._storage()
+                await storage.execute(
+                    'INSERT OR REPLACE INTO translation_cache (direction, source, translated, created) VALUES (?, ?, ?, ?)',
+                    (key[0], key[1], translated, int(time.time())))
+            except Exception as e:
+                logger.warning("Ошибка записи в кэш переводов: %s", e)
+
+    def stats(self):
+        """Счётчики попаданий и промахов кэша."""
+        return {
+            "memory_hits": self.memory.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "size": len(self.memory),
+        }
+
+
+class TimeoutSession(requests.Session):
+    """Сессия requests с тайм-аутом по умолчанию для каждого запроса.
+
+    asyncio.wait_for не может прервать поток пула, поэтому зависший
+    запрос ограничивается здесь, внутри блокирующего вызова.
+    """
+
+    def __init__(self, timeout=None):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().request(method, url, **kwargs)
+
+
+class GoogleBackend:
+    """Перевод через Google Translate (deep_translator) по сети, через прокси."""
+
+    name = "google"
+    blocking = True
+    cacheable = True
+
+    def __init__(self, proxy=None, timeout=15):
+        self.session = TimeoutSession(timeout)
+        if proxy:
+            self.session.proxies = {"http": proxy, "https": proxy}
+        self.session.verify = certifi.where()
+        requests.packages.urllib3.disable_warnings()
+        # GoogleTranslator хранит параметры запроса в самом объекте, поэтому у каждого потока свой экземпляр
+        self._local = threading.local()
+
+    def _translators(self):
+        translators = getattr(self._local, "translators", None)
+        if translators is None:
+            translators = {
+                True: GoogleTranslator(source='ru', target='en', session=self.session),
+                False: GoogleTranslator(source='en', target='ru', session=self.session),
+            }
+            self._local.translators = translators
+        return translators
+
+    def translate(self, text, to_english):
+        return self._translators()[to_english].translate(text)
+
+    def close(self):
+        self.session.close()
+
+
+class ArgosBackend:
+    """Локальный офлайн-перевод моделью Argos Translate (пакет argostranslate)."""
+
+    name = "argos"
+    blocking = True
+    cacheable = True
+
+    def __init__(self):
+        # Необязательная зависимость: без неё бэкенд просто не подключается
+        import argostranslate.translate
+        self._translate = argostranslate.translate.translate
+
+    def translate(self, text, to_english):
+        source, target = ("ru", "en") if to_english else ("en", "ru")
+        return self._translate(text, source, target)
+
+    def close(self):
+        pass
+
+
+class DictionaryBackend:
+    """Перевод по локальному словарю фраз и слов из JSON-файла.
+
+    Формат файла: {"ru-en": {"привет": "hello", ...}, "en-ru": {...}}.
+    Если фразы нет целиком и не все слова известны, выбрасывает LookupError,
+    чтобы сработал следующий бэкенд.
+    """
+
+    name = "dictionary"
+    blocking = False
+    cacheable = False
+
+    def __init__(self, path="translation_dictionary.json"):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self.dictionaries = {
+            direction: {normalize_text(key).lower(): value for key, value in data.get(direction, {}).items()}
+            for direction in ("ru-en", "en-ru")
+        }
+        logger.info("Загружен словарь перевода %s: %s ru-en, %s en-ru",
+                    path, len(self.dictionaries['ru-en']), len(self.dictionaries['en-ru']))
+
+    def translate(self, text, to_english):
+        dictionary = self.dictionaries["ru-en" if to_english else "en-ru"]
+        phrase = normalize_text(text).lower()
+        if phrase in dictionary:
+            return dictionary[phrase]
+        words = phrase.split()
+        if words and all(word in dictionary for word in words):
+            return " ".join(dictionary[word] for word in words)
+        raise LookupError("фраза отсутствует в словаре")
+
+    def close(self):
+        pass
+
+
+class NoopBackend:
+    """Возвращает текст без перевода — последний рубеж цепочки бэкендов."""
+
+    name = "noop"
+    blocking = False
+    cacheable = False
+
+    def translate(self, text, to_english):
+        return text
+
+    def close(self):
+        pass
+
+
+def _release_threadsafe(loop, semaphore):
+    try:
+        loop.call_soon_threadsafe(semaphore.release)
+    except RuntimeError:
+        # Цикл событий уже закрыт (остановка бота)
+        pass
+
+
+def create_backend(name, config, proxy=None):
+    """Создаёт бэкенд перевода по имени из конфигурации."""
+    if name == "google":
+        return GoogleBackend(proxy=proxy, timeout=config.get("translation_timeout", 15))
+    if name == "argos":
+        return ArgosBackend()
+    if name == "dictionary":
+        return DictionaryBackend(config.get("translation_dictionary", "translation_dictionary.json"))
+    if name == "noop":
+        return NoopBackend()
+    raise ValueError(f"Неизвестный бэкенд перевода: {name}")
+
+
+class TranslationService:
+    """Асинхронный перевод RU <-> EN без блокировки цикла событий.
+
+    Бэкенды перебираются по порядку из translation_backends: при ошибке или
+    тайм-ауте запрос уходит следующему. Блокирующие бэкенды выполняются в
+    ограниченном пуле потоков; число одновременных переводов ограничено
+    семафором, а каждый вызов — тайм-аутом.
+
+    Тайм-аут не останавливает поток: вызов, от которого ушли по тайм-ауту,
+    занимает место в пуле до своего завершения (для google его ограничивает
+    тайм-аут HTTP-запроса). Ожидание свободного места входит в тайм-аут,
+    поэтому зависший бэкенд не задерживает перевод дольше timeout — запрос
+    уходит следующему бэкенду.
+    """
+
+    def __init__(self, proxy=None, concurrency=4, timeout=15):
+        self.proxy = proxy
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="translate")
+        self._semaphore = None
+        self.cache = TranslationCache()
+        self.backend_names = ["google"]
+        self.backends = [GoogleBackend(proxy=proxy, timeout=timeout)]
+
+    def configure(self, config):
+        """Применяет бэкенды, тайм-аут, лимит параллельности и настройки кэша из конфигурации."""
+        self.cache.configure(config)
+        self.timeout = config.get("translation_timeout", self.timeout)
+        concurrency = config.get("translation_concurrency", self.concurrency)
+        if concurrency != self.concurrency:
+            old_executor = self._executor
+            self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="translate")
+            old_executor.shutdown(wait=False)
+            self.concurrency = concurrency
+            self._semaphore = None
+        names = list(config.get("translation_backends", self.backend_names))
+        if names != self.backend_names:
+            self.set_backends(names, config)
+        for backend in self.backends:
+            if isinstance(backend, GoogleBackend):
+                backend.session.timeout = self.timeout
+        logger.info("Перевод: бэкенды %s, тайм-аут %s сек, параллельность %s",
+                    self.backend_names, self.timeout, self.concurrency)
+
+    def set_backends(self, names, config):
+        """Пересоздаёт цепочку бэкендов; недоступные пропускаются с предупреждением."""
+        backends = []
+        for name in names:
+            try:
+                backends.append(create_backend(name, config, proxy=self.proxy))
+            except Exception as e:
+                logger.warning("Бэкенд перевода '%s' недоступен: %s", name, e)
+        if not backends:
+            logger.error("Ни один бэкенд перевода не доступен, перевод отключён")
+            backends = [NoopBackend()]
+        for backend in self.backends:
+            backend.close()
+        self.backends = backends
+        self.backend_names = names
+
+    async def _call(self, backend, text, to_english):
+        if not backend.blocking:
+            return backend.translate(text, to_english)
+        return await asyncio.wait_for(self._run_blocking(backend, text, to_english), self.timeout)
+
+    async def _run_blocking(self, backend, text, to_english):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        semaphore = self._semaphore
+        loop = asyncio.get_running_loop()
+        await semaphore.acquire()
+        try:
+            future = self._executor.submit(backend.translate, text, to_english)
+        except BaseException:
+            semaphore.release()
+            raise
+        # Место освобождается, когда поток действительно закончил, а не когда ушёл ожидающий:
+        # иначе новые вызовы встают в очередь пула за зависшим
+        future.add_done_callback(lambda _: _release_threadsafe(loop, semaphore))
+        return await asyncio.wrap_future(future)
+
+    async def translate(self, text, to_english=True):
+        """Переводит текст первым сработавшим бэкендом.
+
+        Повторяющиеся фразы берутся из кэша без обращения к бэкендам. Если
+        ни один бэкенд не справился, выбрасывается последняя ошибка
+        (asyncio.TimeoutError при превышении тайм-аута).
+        """
+        cacheable = self.cache.cacheable(text)
+        if cacheable:
+            cached = await self.cache.get(text, to_english)
+            if cached is not None:
+                TRANSLATION_CACHE_TOTAL.inc(result="hit")
+                return cached
+            TRANSLATION_CACHE_TOTAL.inc(result="miss")
+        last_error = None
+        for backend in self.backends:
+            started = time.perf_counter()
+            try:
+                translated = await self._call(backend, text, to_english)
+            except Exception as e:
+                TRANSLATION_SECONDS.observe(time.perf_counter() - started, backend=backend.name, outcome="error")
+                last_error = e
+                logger.warning("Бэкенд перевода '%s' не справился: %s: %s", backend.name, type(e).__name__, e)
+                continue
+            TRANSLATION_SECONDS.observe(time.perf_counter() - started, backend=backend.name, outcome="ok")
+            if not translated:
+                continue
+            if cacheable and backend.cacheable:
+                await self.cache.put(text, to_english, translated)
+            return translated
+        if last_error is not None:
+            raise last_error
+        return text
+
+    async def benchmark(self, texts, to_english=True):
+        """Замеряет задержку каждого бэкенда на наборе текстов без использования кэша."""
+        results = {}
+        for backend in self.backends:
+            timings = []
+            errors = 0
+            for text in texts:
+                started = time.perf_counter()
+                try:
+                    await self._call(backend, text, to_english)
+                except Exception:
+                    errors += 1
+                    continue
+                timings.append(time.perf_counter() - started)
+            results[backend.name] = {
+                "ok": len(timings),
+                "errors": errors,
+                "mean": statistics.mean(timings) if timings else None,
+                "median": statistics.median(timings) if timings else None,
+                "max": max(timings) if timings else None,
+            }
+        return results
+
+    def close(self):
+        """Останавливает пул потоков перевода и закрывает бэкенды."""
+        self._executor.shutdown(wait=False)
+        for backend in self.backends:
+            backend.close()
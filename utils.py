@@ -6,75 +6,46 @@ import os
 import re
 import sqlite3
 import aiohttp
-import requests
-import certifi
 import ssl
-from deep_translator import GoogleTranslator
 from telebot import apihelper
 import time
 import asyncio
 import tempfile
 import os
+from storage import get_storage, LRUCache
+from kobold import get_balancer, read_token_stream
+from scheduler import get_scheduler, PRIORITY_NORMAL
+from translation import TranslationService
+from transcription import TranscriptionService
+from payload import JSON_HEADERS, configure_payload, get_template, dumps, loads
+from log_setup import configure_log_levels
+from metrics import KOBOLD_REQUEST_SECONDS, GENERATION_SECONDS, ERRORS_TOTAL
+from tracing import CREATE_TRACES_TABLE_SQL, CREATE_TRACES_INDEX_SQL, trace_stage
+from response_stats import ResponseStats
+# Реплики контекста и бюджет токенов
+from context import (DEFAULT_CHARS_PER_TOKEN, DEFAULT_TRIM_RATIO, CREATE_TURNS_TABLE_SQL, context_budget,
+                     load_turns, load_turns_stable, append_turns, has_turns, clear_turns, render_turns)
 
-# Разделители для системного промпта
-SYSTEM_PROMPT_START = "###SYSTEM_PROMPT_START###"
-SYSTEM_PROMPT_END = "###SYSTEM_PROMPT_END###"
-
-# Основной логгер
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("bot.log", encoding="utf-8"),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
-# Новый логгер для детального логирования AI-ответов и контекста
+# Логгер для детального логирования AI-ответов и контекста (обработчик настраивает log_setup)
 ai_detail_logger = logging.getLogger('ai_details')
-ai_detail_logger.setLevel(logging.INFO)
-ai_detail_handler = logging.FileHandler("ai_details.log", encoding="utf-8")
-ai_detail_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - \n%(message)s\n' + '-'*50))
-ai_detail_logger.addHandler(ai_detail_handler)
-ai_detail_logger.propagate = False
 
 # Настройка SOCKS5-прокси
 PROXY = "socks5://localhost:3128"
 apihelper.proxy = {'https': PROXY}
 
-translation_session = requests.Session()
-translation_session.proxies = {"http": PROXY, "https": PROXY}
-translation_session.verify = certifi.where()
-requests.packages.urllib3.disable_warnings()
-
-translator = GoogleTranslator(source='ru', target='en', session=translation_session)
-translator_reverse = GoogleTranslator(source='en', target='ru', session=translation_session)
-
-def clean_system_prompt_markers(text):
-    """Удаляет маркеры системного промпта из текста."""
-    original_text = text
-    cleaned_text = text.replace(SYSTEM_PROMPT_START, "").replace(SYSTEM_PROMPT_END, "")
-    if original_text != cleaned_text:
-        logger.info(f"Удалены маркеры системного промпта: {original_text[:50]}... -> {cleaned_text[:50]}...")
-    return cleaned_text
-
-def add_system_prompt(prompt):
-    """Добавляет системный промпт, окружённый разделителями."""
-    return f"{SYSTEM_PROMPT_START}{prompt}{SYSTEM_PROMPT_END}"
-
-def remove_system_prompt(context):
-    """Удаляет системный промпт, окружённый разделителями, из контекста."""
-    start_marker = SYSTEM_PROMPT_START
-    end_marker = SYSTEM_PROMPT_END
-    start_idx = context.find(start_marker)
-    if start_idx != -1:
-        end_idx = context.find(end_marker, start_idx + len(start_marker))
-        if end_idx != -1:
-            cleaned_context = context[:start_idx] + context[end_idx + len(end_marker):]
-            logger.info(f"Удалён системный промпт из контекста: {context[start_idx:end_idx + len(end_marker)][:50]}...")
-            return cleaned_context.strip()
-    return context.strip()
+# Перевод выполняется в отдельном пуле потоков и не блокирует цикл событий
+translation_service = TranslationService(proxy=PROXY)
+
+# Распознавание голосовых сообщений: утилита или резидентная модель в пуле процессов
+transcription_service = TranscriptionService()
+
+# Статистика времени ответа в памяти; в response_times пишется пакетами
+response_stats = ResponseStats()
+
+# Суффикс длины ответа в конце сообщения: "мд300", "ml300" или "md300"
+MAX_LENGTH_PATTERN = re.compile(r'(мд|ml|md)(\d{3})$')
 
 def temp_message_livetime(config=None):
     """Возвращает время жизни временных сообщений из конфига или значение по умолчанию."""
@@ -85,13 +56,13 @@ def temp_message_livetime(config=None):
 def is_english(text):
     """Проверяет, является ли текст преимущественно английским."""
     if not text:  # Проверка на пустой текст
-        logger.info("Текст пустой, считаем его английским по умолчанию")
+        logger.debug("Текст пустой, считаем его английским по умолчанию")
         return True
 
     # Удаляем пробельные символы и проверяем только значимые символы
     cleaned_text = ''.join(char for char in text if not char.isspace())
     if not cleaned_text:  # Если после очистки ничего не осталось
-        logger.info("Текст состоит только из пробелов, считаем его английским")
+        logger.debug("Текст состоит только из пробелов, считаем его английским")
         return True
 
     # Проверяем, что большинство символов — латинские буквы, цифры или допустимая пунктуация
@@ -103,24 +74,24 @@ def is_english(text):
     threshold = 0.9
     is_english_text = (latin_count / total_chars) >= threshold
 
-    logger.info(f"Проверка текста на английский: {text[:50]}... Это английский - {is_english_text} "
-                f"(латинских символов: {latin_count}/{total_chars}, доля: {latin_count/total_chars:.2f})")
+    logger.debug("Проверка текста на английский: %s... Это английский - %s (латинских символов: %s/%s, доля: %.2f)",
+                 text[:50], is_english_text, latin_count, total_chars, latin_count / total_chars)
     return is_english_text
     
 def clean_text(text):
     """Очищает текст от лишних повторений и нежелательных суффиксов."""
-    logger.info(f"Очистка текста: {text[:50]}...")
+    logger.debug("Очистка текста: %s...", text[:50])
     text = re.sub(r'(.)\1{3,}', r'\1\1', text)
     text = re.sub(r'(\w+)(un|yu|anon)\b', r'\1', text)
     cleaned = text.strip()
-    logger.info(f"Текст после очистки: {cleaned[:50]}...")
+    logger.debug("Текст после очистки: %s...", cleaned[:50])
     return cleaned
 
 def split_message(text, max_length=4096):
     """Разбивает длинный текст на части для отправки в Telegram."""
-    logger.info(f"Разбиение текста, длина: {len(text)}")
+    logger.debug("Разбиение текста, длина: %s", len(text))
     if len(text) <= max_length:
-        logger.info("Текст короче лимита, возвращаем как есть")
+        logger.debug("Текст короче лимита, возвращаем как есть")
         return [text]
     parts = []
     current_part = ""
@@ -132,7 +103,7 @@ def split_message(text, max_length=4096):
             current_part = line + "\n"
     if current_part:
         parts.append(current_part.strip())
-    logger.info(f"Текст разбит на {len(parts)} частей")
+    logger.debug("Текст разбит на %s частей", len(parts))
     return parts
 
 def get_default_character_name():
@@ -141,7 +112,7 @@ def get_default_character_name():
 
 def init_db(db_file="context.db"):
     """Инициализирует базу данных, проверяя структуру таблиц. Завершает выполнение при несоответствии."""
-    logger.info(f"Инициализация базы данных: {db_file}")
+    logger.info("Инициализация базы данных: %s", db_file)
     
     # Проверяем, существует ли файл базы данных
     if not os.path.exists(db_file):
@@ -179,20 +150,52 @@ def init_db(db_file="context.db"):
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 chat_id INTEGER NOT NULL,
                 response_time REAL NOT NULL,
-                timestamp INTEGER NOT NULL
+                timestamp INTEGER NOT NULL,
+                prompt_time REAL,
+                cache_reuse_estimated INTEGER,
+                max_length INTEGER
             )
         ''')
         logger.info("Создана таблица response_times для статистики времени генерации")
 
+        # Создаём таблицу context_turns с репликами разговора
+        cursor.execute(CREATE_TURNS_TABLE_SQL)
+        logger.info("Создана таблица context_turns")
+
+        # Создаём таблицу reply_traces с временем этапов подготовки ответов
+        cursor.execute(CREATE_TRACES_TABLE_SQL)
+        cursor.execute(CREATE_TRACES_INDEX_SQL)
+        logger.info("Создана таблица reply_traces")
+
         conn.commit()
         conn.close()
-        logger.info(f"База данных создана и готова: {db_file}")
+        logger.info("База данных создана и готова: %s", db_file)
         return
 
     # Если база существует, проверяем структуру
     conn = sqlite3.connect(db_file)
     cursor = conn.cursor()
 
+    # Таблица реплик появилась позже остальных: в существующей базе создаём её при необходимости,
+    # старый контекст из user_context переносится в неё при первом обращении к чату
+    cursor.execute(CREATE_TURNS_TABLE_SQL)
+    cursor.execute(CREATE_TRACES_TABLE_SQL)
+    cursor.execute(CREATE_TRACES_INDEX_SQL)
+    # Столбцы времени обработки промпта, повторного использования кэша бэкенда и длины ответа добавлены позже
+    cursor.execute("PRAGMA table_info(response_times)")
+    response_time_columns = {col[1] for col in cursor.fetchall()}
+    if "cache_reused" in response_time_columns:
+        # Повторное использование кэша оценивается клиентом, столбец назван по смыслу
+        cursor.execute("ALTER TABLE response_times RENAME COLUMN cache_reused TO cache_reuse_estimated")
+        response_time_columns = (response_time_columns - {"cache_reused"}) | {"cache_reuse_estimated"}
+        logger.info("Столбец response_times.cache_reused переименован в cache_reuse_estimated")
+    if response_time_columns:
+        for column, column_type in (("prompt_time", "REAL"), ("cache_reuse_estimated", "INTEGER"), ("max_length", "INTEGER")):
+            if column not in response_time_columns:
+                cursor.execute(f"ALTER TABLE response_times ADD COLUMN {column} {column_type}")
+                logger.info("В таблицу response_times добавлен столбец %s", column)
+    conn.commit()
+
     # Ожидаемая структура таблиц
     expected_tables = {
         "user_context": [
@@ -213,7 +216,25 @@ def init_db(db_file="context.db"):
             ("id", "INTEGER", 1),
             ("chat_id", "INTEGER", 0),
             ("response_time", "REAL", 0),
-            ("timestamp", "INTEGER", 0)
+            ("timestamp", "INTEGER", 0),
+            ("prompt_time", "REAL", 0),
+            ("cache_reuse_estimated", "INTEGER", 0),
+            ("max_length", "INTEGER", 0)
+        ],
+        "context_turns": [
+            ("chat_id", "INTEGER", 1),
+            ("seq", "INTEGER", 1),
+            ("role", "TEXT", 0),
+            ("text", "TEXT", 0),
+            ("token_count", "INTEGER", 0)
+        ],
+        "reply_traces": [
+            ("id", "INTEGER", 1),
+            ("chat_id", "INTEGER", 0),
+            ("kind", "TEXT", 0),
+            ("timestamp", "INTEGER", 0),
+            ("total", "REAL", 0),
+            ("stages", "TEXT", 0)
         ]
     }
 
@@ -223,14 +244,15 @@ def init_db(db_file="context.db"):
         columns = cursor.fetchall()
         
         if not columns:
-            logger.error(f"Таблица {table_name} отсутствует в базе данных!")
+            logger.error("Таблица %s отсутствует в базе данных!", table_name)
             conn.close()
             raise SystemExit(f"Ошибка: таблица {table_name} отсутствует в базе данных. Проверьте структуру базы.")
 
         # Проверяем количество и имена столбцов
         actual_columns = [(col[1], col[2], 1 if col[5] else 0) for col in columns]
         if len(actual_columns) != len(expected_columns):
-            logger.error(f"Несоответствие структуры таблицы {table_name}: ожидалось {len(expected_columns)} столбцов, найдено {len(actual_columns)}")
+            logger.error("Несоответствие структуры таблицы %s: ожидалось %s столбцов, найдено %s",
+                         table_name, len(expected_columns), len(actual_columns))
             conn.close()
             raise SystemExit(f"Ошибка: несоответствие структуры таблицы {table_name}. Проверьте базу данных.")
 
@@ -239,46 +261,142 @@ def init_db(db_file="context.db"):
             exp_name, exp_type, exp_pk = expected
             act_name, act_type, act_pk = actual
             if exp_name != act_name or exp_type != act_type or exp_pk != act_pk:
-                logger.error(f"Несоответствие в таблице {table_name}: ожидался столбец {exp_name} ({exp_type}, PK={exp_pk}), найден {act_name} ({act_type}, PK={act_pk})")
+                logger.error("Несоответствие в таблице %s: ожидался столбец %s (%s, PK=%s), найден %s (%s, PK=%s)",
+                             table_name, exp_name, exp_type, exp_pk, act_name, act_type, act_pk)
                 conn.close()
                 raise SystemExit(f"Ошибка: неверная структура таблицы {table_name}. Проверьте базу данных.")
 
-        logger.info(f"Структура таблицы {table_name} соответствует ожидаемой")
+        logger.info("Структура таблицы %s соответствует ожидаемой", table_name)
 
     conn.close()
-    logger.info(f"База данных готова: {db_file}")
+    logger.info("База данных готова: %s", db_file)
     
-def set_selected_extension(chat_id, extension_name, db_file="context.db"):
-    """Устанавливает выбранное расширение для указанного chat_id."""
-    logger.info(f"Установка selected_extension для chat_id: {chat_id} на '{extension_name}'")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR REPLACE INTO chat_settings (
-            chat_id, user_translate_enabled, ai_translate_enabled, memory, character_name, user_character_name, selected_extension
-        ) VALUES (
-            ?, COALESCE((SELECT user_translate_enabled FROM chat_settings WHERE chat_id = ?), 1),
-            COALESCE((SELECT ai_translate_enabled FROM chat_settings WHERE chat_id = ?), 1),
-            COALESCE((SELECT memory FROM chat_settings WHERE chat_id = ?), ''),
-            COALESCE((SELECT character_name FROM chat_settings WHERE chat_id = ?), ?),
-            COALESCE((SELECT user_character_name FROM chat_settings WHERE chat_id = ?), 'User'),
-            ?
+class ChatSettings:
+    """Настройки чата, загружаемые из chat_settings одной строкой."""
+
+    __slots__ = ("chat_id", "user_translate_enabled", "ai_translate_enabled", "memory",
+                 "character_name", "user_character_name", "selected_extension", "show_english")
+
+    # Порядок столбцов в таблице chat_settings
+    COLUMNS = __slots__
+
+    def __init__(self, chat_id, user_translate_enabled=1, ai_translate_enabled=1, memory="",
+                 character_name=None, user_character_name="User", selected_extension="", show_english=None):
+        self.chat_id = chat_id
+        self.user_translate_enabled = user_translate_enabled
+        self.ai_translate_enabled = ai_translate_enabled
+        self.memory = memory
+        self.character_name = character_name or get_default_character_name()
+        self.user_character_name = user_character_name
+        self.selected_extension = selected_extension
+        # None означает, что строки в базе ещё нет и действует значение из конфига
+        self.show_english = show_english
+
+    @classmethod
+    def from_row(cls, row):
+        chat_id, user_translate, ai_translate, memory, character_name, user_character_name, extension, show_english = row
+        return cls(
+            chat_id,
+            user_translate if user_translate is not None else 1,
+            ai_translate if ai_translate is not None else 1,
+            memory or "",
+            character_name,
+            user_character_name or "User",
+            extension or "",
+            show_english,
         )
-    ''', (chat_id, chat_id, chat_id, chat_id, chat_id, get_default_character_name(), chat_id, extension_name))
-    conn.commit()
-    conn.close()
-    logger.info(f"Selected_extension установлено: {extension_name}")
 
-def get_extended_memory(chat_id, config, db_file="context.db"):
+    def copy(self):
+        return ChatSettings(*(getattr(self, column) for column in self.COLUMNS))
+
+    def to_row(self):
+        return (
+            self.chat_id,
+            1 if self.user_translate_enabled else 0,
+            1 if self.ai_translate_enabled else 0,
+            self.memory,
+            self.character_name,
+            self.user_character_name,
+            self.selected_extension,
+            1 if self.show_english else 0,
+        )
+
+
+# Кэш настроек чатов: ключ (db_file, chat_id)
+settings_cache = LRUCache(max_size=1024, ttl=600)
+
+SELECT_CHAT_SETTINGS_SQL = f"SELECT {', '.join(ChatSettings.COLUMNS)} FROM chat_settings WHERE chat_id = ?"
+INSERT_CHAT_SETTINGS_SQL = (
+    f"INSERT INTO chat_settings ({', '.join(ChatSettings.COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in ChatSettings.COLUMNS)}) "
+)
+
+
+def upsert_chat_settings_sql(columns):
+    """UPSERT строки настроек, который у существующей строки меняет только columns."""
+    return INSERT_CHAT_SETTINGS_SQL + "ON CONFLICT(chat_id) DO UPDATE SET " + ", ".join(
+        f"{column} = excluded.{column}" for column in columns)
+
+
+async def get_chat_settings(chat_id, db_file="context.db"):
+    """Возвращает настройки чата из кэша или загружает их одним запросом."""
+    key = (db_file, chat_id)
+    settings = settings_cache.get(key)
+    if settings is not None:
+        return settings
+    logger.debug("Загрузка настроек для chat_id: %s", chat_id)
+    row = await get_storage(db_file).fetchone(SELECT_CHAT_SETTINGS_SQL, (chat_id,))
+    # Пока шёл запрос, настройки мог загрузить другой обработчик
+    cached = settings_cache.get(key)
+    if cached is not None:
+        return cached
+    settings = ChatSettings.from_row(row) if row else ChatSettings(chat_id)
+    settings_cache.set(key, settings)
+    return settings
+
+async def update_chat_settings(chat_id, db_file="context.db", **changes):
+    """Изменяет настройки чата одним UPSERT.
+
+    Существующая строка меняется только в столбцах changes, поэтому
+    параллельные изменения разных настроек не затирают друг друга. Кэш
+    обновляется после успешной записи: изменения применяются к его
+    текущему значению, в котором уже учтены завершившиеся записи.
+    """
+    key = (db_file, chat_id)
+    settings = (await get_chat_settings(chat_id, db_file)).copy()
+    for field, value in changes.items():
+        setattr(settings, field, value)
+    await get_storage(db_file).execute(upsert_chat_settings_sql(changes), settings.to_row())
+    current = settings_cache.get(key)
+    if current is None:
+        # Запись вытеснена, пока шла запись: следующее чтение загрузит строку из базы
+        return settings
+    settings = current.copy()
+    for field, value in changes.items():
+        setattr(settings, field, value)
+    if settings.show_english is None:
+        # После записи строка существует, и в базе хранится значение по умолчанию
+        settings.show_english = 0
+    settings_cache.set(key, settings)
+    return settings
+
+async def set_selected_extension(chat_id, extension_name, db_file="context.db"):
+    """Устанавливает выбранное расширение для указанного chat_id."""
+    logger.info("Установка selected_extension для chat_id: %s на '%s'", chat_id, extension_name)
+    await update_chat_settings(chat_id, db_file, selected_extension=extension_name)
+    logger.info("Selected_extension установлено: %s", extension_name)
+
+async def get_extended_memory(chat_id, config, db_file="context.db"):
     """Получает память для chat_id с учётом выбранного расширения из конфигурации."""
-    # Получаем память и выбранное расширение
-    memory = get_memory(chat_id, db_file)
-    selected_extension = get_selected_extension(chat_id, db_file)
+    # Получаем память и выбранное расширение одним чтением настроек
+    settings = await get_chat_settings(chat_id, db_file)
+    memory = settings.memory
+    selected_extension = settings.selected_extension
     if not memory:
         memory = get_default_memory()
-        logger.info(f"Memory по умолчанию: {memory[:50]}...")
+        logger.debug("Memory по умолчанию: %s...", memory[:50])
     else:
-        logger.info(f"Пользовательский memory: {memory[:50]}...")
+        logger.debug("Пользовательский memory: %s...", memory[:50])
 
     # Если выбрано расширение, добавляем его текст в память
     if selected_extension:
@@ -286,234 +404,104 @@ def get_extended_memory(chat_id, config, db_file="context.db"):
         extension_data = next((ext for ext in extensions if ext["name"].lower() == selected_extension.lower()), None)
         if extension_data:
             memory = f"{memory}\n{extension_data['text']}".strip() if memory else extension_data["text"]
-            logger.info(f"Добавлен текст расширения '{selected_extension}' в память: {memory[:50]}...")
+            logger.debug("Добавлен текст расширения '%s' в память: %s...", selected_extension, memory[:50])
 
     return memory
 
-def get_selected_extension(chat_id, db_file="context.db"):
+async def get_selected_extension(chat_id, db_file="context.db"):
     """Получает выбранное расширение для указанного chat_id."""
-    logger.info(f"Получение selected_extension для chat_id: {chat_id}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('SELECT selected_extension FROM chat_settings WHERE chat_id = ?', (chat_id,))
-    result = cursor.fetchone()
-    conn.close()
-    extension = result[0] if result else ""
-    logger.info(f"Selected_extension: {extension}")
+    extension = (await get_chat_settings(chat_id, db_file)).selected_extension
+    logger.debug("Selected_extension для chat_id %s: %s", chat_id, extension)
     return extension
 
-def save_context(chat_id, context, db_file="context.db"):
-    """Сохраняет контекст разговора для указанного chat_id."""
-    logger.info(f"Сохранение контекста для chat_id: {chat_id}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO user_context (chat_id, context) VALUES (?, ?)', (chat_id, context))
-    conn.commit()
-    conn.close()
-    logger.info(f"Контекст сохранён: {context[:50]}...")
+async def ensure_context(chat_id, config, db_file="context.db"):
+    """Начинает контекст чата с системного промпта, если контекста ещё нет."""
+    if not await has_turns(chat_id, db_file):
+        await append_turns(chat_id, [("system", config["system_prompt"])],
+                           config.get("chars_per_token", DEFAULT_CHARS_PER_TOKEN), db_file)
+        logger.info("Контекст для chat_id: %s начат с системного промпта", chat_id)
 
-def load_context(chat_id, db_file="context.db"):
-    """Загружает контекст разговора для указанного chat_id."""
-    logger.info(f"Загрузка контекста для chat_id: {chat_id}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('SELECT context FROM user_context WHERE chat_id = ?', (chat_id,))
-    result = cursor.fetchone()
-    conn.close()
-    context = result[0] if result else ""
-    logger.info(f"Загружен контекст: {context[:50]}...")
-    return context
-
-def clear_context(chat_id, db_file="context.db"):
+async def clear_context(chat_id, db_file="context.db"):
     """Очищает контекст разговора для указанного chat_id."""
-    logger.info(f"Очистка контекста для chat_id: {chat_id}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM user_context WHERE chat_id = ?', (chat_id,))
-    conn.commit()
-    conn.close()
+    logger.info("Очистка контекста для chat_id: %s", chat_id)
+    await clear_turns(chat_id, db_file)
     logger.info("Контекст очищен")
 
-# Функции для работы с настройками (без изменений)
-def set_user_translate_enabled(chat_id, enabled, db_file="context.db"):
+# Функции для работы с настройками
+async def set_user_translate_enabled(chat_id, enabled, db_file="context.db"):
     """Устанавливает настройку перевода сообщений пользователя."""
-    logger.info(f"Установка user_translate_enabled для chat_id: {chat_id} на {enabled}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO chat_settings (chat_id, user_translate_enabled, ai_translate_enabled, memory, character_name, user_character_name) VALUES (?, ?, COALESCE((SELECT ai_translate_enabled FROM chat_settings WHERE chat_id = ?), 1), COALESCE((SELECT memory FROM chat_settings WHERE chat_id = ?), ""), COALESCE((SELECT character_name FROM chat_settings WHERE chat_id = ?), "Person"), COALESCE((SELECT user_character_name FROM chat_settings WHERE chat_id = ?), "User"))', (chat_id, 1 if enabled else 0, chat_id, chat_id, chat_id, chat_id))
-    conn.commit()
-    conn.close()
+    logger.info("Установка user_translate_enabled для chat_id: %s на %s", chat_id, enabled)
+    await update_chat_settings(chat_id, db_file, user_translate_enabled=1 if enabled else 0)
     logger.info("Настройка сохранена")
 
-def set_ai_translate_enabled(chat_id, enabled, db_file="context.db"):
+async def set_ai_translate_enabled(chat_id, enabled, db_file="context.db"):
     """Устанавливает настройку перевода ответов ИИ."""
-    logger.info(f"Установка ai_translate_enabled для chat_id: {chat_id} на {enabled}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO chat_settings (chat_id, user_translate_enabled, ai_translate_enabled, memory, character_name, user_character_name) VALUES (?, COALESCE((SELECT user_translate_enabled FROM chat_settings WHERE chat_id = ?), 1), ?, COALESCE((SELECT memory FROM chat_settings WHERE chat_id = ?), ""), COALESCE((SELECT character_name FROM chat_settings WHERE chat_id = ?), "Person"), COALESCE((SELECT user_character_name FROM chat_settings WHERE chat_id = ?), "User"))', (chat_id, chat_id, 1 if enabled else 0, chat_id, chat_id, chat_id))
-    conn.commit()
-    conn.close()
+    logger.info("Установка ai_translate_enabled для chat_id: %s на %s", chat_id, enabled)
+    await update_chat_settings(chat_id, db_file, ai_translate_enabled=1 if enabled else 0)
     logger.info("Настройка сохранена")
 
-def set_memory(chat_id, memory, db_file="context.db"):
+async def set_memory(chat_id, memory, db_file="context.db"):
     """Устанавливает memory для ИИ."""
-    logger.info(f"Установка memory для chat_id: {chat_id}: {memory[:50]}...")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO chat_settings (chat_id, user_translate_enabled, ai_translate_enabled, memory, character_name, user_character_name) VALUES (?, COALESCE((SELECT user_translate_enabled FROM chat_settings WHERE chat_id = ?), 1), COALESCE((SELECT ai_translate_enabled FROM chat_settings WHERE chat_id = ?), 1), ?, COALESCE((SELECT character_name FROM chat_settings WHERE chat_id = ?), "Person"), COALESCE((SELECT user_character_name FROM chat_settings WHERE chat_id = ?), "User"))', (chat_id, chat_id, chat_id, memory, chat_id, chat_id))
-    conn.commit()
-    conn.close()
+    logger.info("Установка memory для chat_id: %s: %s...", chat_id, memory[:50])
+    await update_chat_settings(chat_id, db_file, memory=memory)
     logger.info("Memory установлено")
 
-def set_character_name(chat_id, character_name, db_file="context.db"):
+async def set_character_name(chat_id, character_name, db_file="context.db"):
     """Устанавливает имя персонажа."""
-    logger.info(f"Установка character_name для chat_id: {chat_id}: {character_name}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO chat_settings (chat_id, user_translate_enabled, ai_translate_enabled, memory, character_name, user_character_name) VALUES (?, COALESCE((SELECT user_translate_enabled FROM chat_settings WHERE chat_id = ?), 1), COALESCE((SELECT ai_translate_enabled FROM chat_settings WHERE chat_id = ?), 1), COALESCE((SELECT memory FROM chat_settings WHERE chat_id = ?), ""), ?, COALESCE((SELECT user_character_name FROM chat_settings WHERE chat_id = ?), "User"))', (chat_id, chat_id, chat_id, chat_id, character_name, chat_id))
-    conn.commit()
-    conn.close()
+    logger.info("Установка character_name для chat_id: %s: %s", chat_id, character_name)
+    await update_chat_settings(chat_id, db_file, character_name=character_name)
     logger.info("Имя персонажа установлено")
 
-def set_user_character_name(chat_id, user_character_name, db_file="context.db"):
+async def set_user_character_name(chat_id, user_character_name, db_file="context.db"):
     """Устанавливает имя пользователя."""
-    logger.info(f"Установка user_character_name для chat_id: {chat_id}: {user_character_name}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO chat_settings (chat_id, user_translate_enabled, ai_translate_enabled, memory, character_name, user_character_name) VALUES (?, COALESCE((SELECT user_translate_enabled FROM chat_settings WHERE chat_id = ?), 1), COALESCE((SELECT ai_translate_enabled FROM chat_settings WHERE chat_id = ?), 1), COALESCE((SELECT memory FROM chat_settings WHERE chat_id = ?), ""), COALESCE((SELECT character_name FROM chat_settings WHERE chat_id = ?), "Person"), ?)', (chat_id, chat_id, chat_id, chat_id, chat_id, user_character_name))
-    conn.commit()
-    conn.close()
+    logger.info("Установка user_character_name для chat_id: %s: %s", chat_id, user_character_name)
+    await update_chat_settings(chat_id, db_file, user_character_name=user_character_name)
     logger.info("Имя пользователя установлено")
 
-def get_memory(chat_id, db_file="context.db"):
+async def get_memory(chat_id, db_file="context.db"):
     """Получает memory для ИИ."""
-    logger.info(f"Получение memory для chat_id: {chat_id}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('SELECT memory FROM chat_settings WHERE chat_id = ?', (chat_id,))
-    result = cursor.fetchone()
-    conn.close()
-    memory = result[0] if result else ""
-    logger.info(f"Memory: {memory[:50]}...")
+    memory = (await get_chat_settings(chat_id, db_file)).memory
+    logger.debug("Memory для chat_id %s: %s...", chat_id, memory[:50])
     return memory
 
-def get_user_translate_enabled(chat_id, db_file="context.db"):
+async def get_user_translate_enabled(chat_id, db_file="context.db"):
     """Получает настройку перевода сообщений пользователя."""
-    logger.info(f"Получение user_translate_enabled для chat_id: {chat_id}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_translate_enabled FROM chat_settings WHERE chat_id = ?', (chat_id,))
-    result = cursor.fetchone()
-    conn.close()
-    enabled = result[0] if result is not None else 1
-    logger.info(f"User translate enabled: {enabled}")
+    enabled = (await get_chat_settings(chat_id, db_file)).user_translate_enabled
+    logger.debug("User translate enabled для chat_id %s: %s", chat_id, enabled)
     return enabled
 
-def get_ai_translate_enabled(chat_id, db_file="context.db"):
+async def get_ai_translate_enabled(chat_id, db_file="context.db"):
     """Получает настройку перевода ответов ИИ."""
-    logger.info(f"Получение ai_translate_enabled для chat_id: {chat_id}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('SELECT ai_translate_enabled FROM chat_settings WHERE chat_id = ?', (chat_id,))
-    result = cursor.fetchone()
-    conn.close()
-    enabled = result[0] if result is not None else 1
-    logger.info(f"AI translate enabled: {enabled}")
+    enabled = (await get_chat_settings(chat_id, db_file)).ai_translate_enabled
+    logger.debug("AI translate enabled для chat_id %s: %s", chat_id, enabled)
     return enabled
 
-def get_character_name(chat_id, db_file="context.db"):
+async def get_character_name(chat_id, db_file="context.db"):
     """Получает имя персонажа."""
-    logger.info(f"Получение character_name для chat_id: {chat_id}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('SELECT character_name FROM chat_settings WHERE chat_id = ?', (chat_id,))
-    result = cursor.fetchone()
-    conn.close()
-    name = result[0] if result else get_default_character_name()  # Используем функцию
-    logger.info(f"Character name: {name}")
+    name = (await get_chat_settings(chat_id, db_file)).character_name
+    logger.debug("Character name для chat_id %s: %s", chat_id, name)
     return name
 
-def get_user_character_name(chat_id, db_file="context.db"):
+async def get_user_character_name(chat_id, db_file="context.db"):
     """Получает имя пользователя."""
-    logger.info(f"Получение user_character_name для chat_id: {chat_id}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_character_name FROM chat_settings WHERE chat_id = ?', (chat_id,))
-    result = cursor.fetchone()
-    conn.close()
-    name = result[0] if result else "User"
-    logger.info(f"User character name: {name}")
+    name = (await get_chat_settings(chat_id, db_file)).user_character_name
+    logger.debug("User character name для chat_id %s: %s", chat_id, name)
     return name
 
-def get_show_english(chat_id, config, db_file="context.db"):
+async def get_show_english(chat_id, config, db_file="context.db"):
     """Получает настройку отображения английского текста для пользователя."""
-    logger.info(f"Получение show_english для chat_id: {chat_id}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('SELECT show_english FROM chat_settings WHERE chat_id = ?', (chat_id,))
-    result = cursor.fetchone()
-    conn.close()
-    enabled = result[0] if result is not None else config.get("show_english_default", False)
-    logger.info(f"Show english: {enabled}")
+    enabled = (await get_chat_settings(chat_id, db_file)).show_english
+    if enabled is None:
+        enabled = config.get("show_english_default", False)
+    logger.debug("Show english для chat_id %s: %s", chat_id, enabled)
     return enabled
 
-def set_show_english(chat_id, enabled, db_file="context.db"):
+async def set_show_english(chat_id, enabled, db_file="context.db"):
     """Устанавливает настройку отображения английского текста для пользователя."""
-    logger.info(f"Установка show_english для chat_id: {chat_id} на {enabled}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR REPLACE INTO chat_settings (
-            chat_id, user_translate_enabled, ai_translate_enabled, memory, 
-            character_name, user_character_name, selected_extension, show_english
-        ) VALUES (
-            ?, COALESCE((SELECT user_translate_enabled FROM chat_settings WHERE chat_id = ?), 1),
-            COALESCE((SELECT ai_translate_enabled FROM chat_settings WHERE chat_id = ?), 1),
-            COALESCE((SELECT memory FROM chat_settings WHERE chat_id = ?), ""),
-            COALESCE((SELECT character_name FROM chat_settings WHERE chat_id = ?), ?),
-            COALESCE((SELECT user_character_name FROM chat_settings WHERE chat_id = ?), "User"),
-            COALESCE((SELECT selected_extension FROM chat_settings WHERE chat_id = ?), ""),
-            ?
-        )
-    ''', (chat_id, chat_id, chat_id, chat_id, chat_id, get_default_character_name(), chat_id, chat_id, 1 if enabled else 0))
-    conn.commit()
-    conn.close()
+    logger.info("Установка show_english для chat_id: %s на %s", chat_id, enabled)
+    await update_chat_settings(chat_id, db_file, show_english=1 if enabled else 0)
     logger.info("Настройка show_english сохранена")
 
-# Новые функции для работы со статистикой времени генерации
-def save_response_time(chat_id, response_time, db_file="context.db"):
-    """Сохраняет время генерации ответа, ограничивая до 5 записей на чат."""
-    logger.info(f"Сохранение времени генерации {response_time:.2f} сек для chat_id: {chat_id}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    timestamp = int(time.time())
-    cursor.execute('INSERT INTO response_times (chat_id, response_time, timestamp) VALUES (?, ?, ?)', 
-                   (chat_id, response_time, timestamp))
-    
-    # Удаляем старые записи, оставляя только последние 5
-    cursor.execute('DELETE FROM response_times WHERE chat_id = ? AND id NOT IN '
-                   '(SELECT id FROM response_times WHERE chat_id = ? ORDER BY timestamp DESC LIMIT 5)', 
-                   (chat_id, chat_id))
-    conn.commit()
-    conn.close()
-    logger.info(f"Время генерации сохранено для chat_id: {chat_id}")
-
-def get_avg_response_time(chat_id, db_file="context.db"):
-    """Возвращает среднее время генерации на основе последних 5 ответов."""
-    logger.info(f"Получение среднего времени генерации для chat_id: {chat_id}")
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('SELECT response_time FROM response_times WHERE chat_id = ? ORDER BY timestamp DESC LIMIT 5', 
-                   (chat_id,))
-    times = cursor.fetchall()
-    conn.close()
-    if len(times) > 1:  # Нужно больше одного ответа для статистики
-        avg_time = sum(t[0] for t in times) / len(times)
-        logger.info(f"Среднее время генерации: {avg_time:.2f} сек, на основе {len(times)} записей")
-        return avg_time, len(times)
-    logger.info("Недостаточно данных для расчёта среднего времени")
-    return None, len(times)
-
 def manage_config(config_file="config.json"):
     """Управляет конфигурацией бота, загружает или создаёт файл config.json."""
     default_config = {
@@ -542,18 +530,18 @@ def manage_config(config_file="config.json"):
         if updated:
             with open(config_file, "w", encoding="utf-8") as f:
                 json.dump(config, f, indent=4)
-            logger.info(f"Обновлён файл конфигурации: {config_file}")
-        logger.info(f"Конфигурация загружена из {config_file}")
+            logger.info("Обновлён файл конфигурации: %s", config_file)
+        logger.info("Конфигурация загружена из %s", config_file)
     else:
         with open(config_file, "w", encoding="utf-8") as f:
             json.dump(default_config, f, indent=4, ensure_ascii=False)
         config = default_config
-        logger.warning(f"Конфигурация создана с значениями по умолчанию: {config_file}")
+        logger.warning("Конфигурация создана с значениями по умолчанию: %s", config_file)
 
     required_fields = ["telegram_token", "kobold_api_url"]
     for field in required_fields:
         if field not in config or not config[field]:
-            logger.error(f"Отсутствует обязательное поле {field}")
+            logger.error("Отсутствует обязательное поле %s", field)
             raise KeyError(f"Отсутствует обязательное поле {field}")
         if field == "telegram_token" and config[field] == "YOUR_TELEGRAM_TOKEN_HERE":
             logger.error("Токен Telegram не настроен!")
@@ -568,61 +556,61 @@ def manage_config(config_file="config.json"):
     config.setdefault("system_prompt", "You are Grok, a humorous AI assistant created by xAI. Respond with wit and a touch of sarcasm.")
 
     apihelper.proxy = {'https': config["proxy"]}
-    logger.info(f"Прокси для Telegram: {config['proxy']}")
+    logger.info("Прокси для Telegram: %s", config['proxy'])
+
+    # Тайм-аут и параллельность перевода
+    translation_service.configure(config)
+
+    # Пресет сэмплера проверяется и замораживается один раз
+    configure_payload(config)
+
+    # Общий уровень логирования и уровни отдельных модулей
+    configure_log_levels(config)
+
+    # Размер и время жизни кэша настроек чатов
+    settings_cache.configure(config.get("settings_cache_size", 1024), config.get("settings_cache_ttl", 600))
+
+    # Окно и сглаживание статистики времени ответа
+    response_stats.configure(config)
+
+    # Бэкенд и параллельность распознавания речи
+    transcription_service.configure(config)
     return config
 
-def translate_text(text, to_english=True):
+async def translate_text(text, to_english=True):
     """Переводит текст на английский или русский в зависимости от параметра."""
-    logger.info(f"Перевод текста: {text[:50]}..., на английский: {to_english}")
+    logger.debug("Перевод текста: %s..., на английский: %s", text[:50], to_english)
     try:
+        translated = await translation_service.translate(text, to_english)
         if to_english:
-            translated = translator.translate(text)
-            logger.info(f"Переведено на английский: {translated[:50]}...")
-            return translated
+            logger.debug("Переведено на английский: %s...", translated[:50])
         else:
-            translated = translator_reverse.translate(text)
-            logger.info(f"Переведено на русский: {translated[:50]}...")
-            return translated
+            logger.debug("Переведено на русский: %s...", translated[:50])
+        return translated
+    except asyncio.TimeoutError:
+        logger.error("Превышено время ожидания перевода (%s сек)", translation_service.timeout)
+        ERRORS_TOTAL.inc(source="translation", type="TimeoutError")
+        return text
     except Exception as e:
-        logger.error(f"Ошибка перевода: {e}")
+        logger.error("Ошибка перевода: %s", e)
+        ERRORS_TOTAL.inc(source="translation", type=type(e).__name__)
         return text
 
-async def check_kobold_api(url):
-    """Проверяет доступность Kobold API."""
-    logger.info(f"Проверка Kobold API: {url}")
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    logger.info("Kobold API доступен")
-                    return True
-                else:
-                    logger.error(f"Kobold API вернул статус {response.status}")
-                    return False
-        except Exception as e:
-            logger.error(f"Ошибка подключения к Kobold API: {e}")
-            return False
-
 def get_default_memory():
     """Возвращает значение memory по умолчанию."""
     return "You are a cheerful AI, always responding with a bit of humor."
 
-def save_context_to_file(chat_id, config, db_file="context.db"):
-    logger.info(f"Сохранение контекста в файл для chat_id: {chat_id}")
+async def save_context_to_file(chat_id, config, db_file="context.db"):
+    logger.info("Сохранение контекста в файл для chat_id: %s", chat_id)
     
     # Исправляем вызов get_memory, передаём db_file вместо config
-    memory = get_memory(chat_id, db_file)
-    
-    # Загружаем контекст
-    context = load_context(chat_id, db_file)
-    if not context:
-        logger.info("Контекст пуст, возвращаем None")
-        return None
+    memory = await get_memory(chat_id, db_file)
     
-    # Удаляем системный промпт из начала контекста
-    cleaned_context = remove_system_prompt(context)
+    # Загружаем реплики без системного промпта
+    _, turns = await load_turns(chat_id, db_file=db_file)
+    cleaned_context = render_turns(turns).strip()
     if not cleaned_context:
-        logger.info("Контекст после удаления системного промпта пуст, возвращаем None")
+        logger.info("Контекст пуст или содержит только системный промпт, возвращаем None")
         return None
     
     # Создаём временный файл
@@ -631,7 +619,7 @@ def save_context_to_file(chat_id, config, db_file="context.db"):
         temp_file.write(f"Context:\n{cleaned_context}")
         file_path = temp_file.name
     
-    logger.info(f"Контекст и memory сохранены в файл: {file_path}")
+    logger.info("Контекст и memory сохранены в файл: %s", file_path)
     return file_path
 
 def remove_last_word(text):
@@ -644,7 +632,7 @@ def remove_last_word(text):
     punctuation_marks = ',.!?;:)"*'
     # Проверяем, заканчивается ли текст любым знаком препинания
     if any(text.rstrip().endswith(mark) for mark in punctuation_marks):
-        logger.debug(f"Текст заканчивается знаком препинания: '{text}', последнее слово не удаляется")
+        logger.debug("Текст заканчивается знаком препинания: '%s', последнее слово не удаляется", text)
         return text
     
     # Учитываем текст в кавычках и знаки препинания в конце для незаконченных предложений
@@ -655,334 +643,418 @@ def remove_last_word(text):
         # Группа 2: последнее слово (удаляется)
         # Группа 3: знаки препинания и кавычки после слова
         result = text[:match.start()] + match.group(1) + match.group(3)
-        logger.debug(f"Удалено последнее слово из '{text}': '{result}'")
+        logger.debug("Удалено последнее слово из '%s': '%s'", text, result)
         return result
     
-    logger.debug(f"Не найдено последнее слово для удаления в '{text}'")
+    logger.debug("Не найдено последнее слово для удаления в '%s'", text)
     return text
 
-async def generate_response_async(text, config, chat_id, context="", user_translate_enabled=True, ai_translate_enabled=True, continue_only=False):
-    """Генерирует ответ от Kobold API асинхронно."""
-    logger.info(f"Генерация ответа для chat_id: {chat_id}, текст: {text[:50]}..., continue_only: {continue_only}")
+async def request_generation(backend, body, config, chat_id, on_partial=None):
+    """Отправляет закодированный payload бэкенду Kobold и возвращает пару (result, error).
+
+    result — разобранный JSON-ответ, error — текст ошибки для пользователя
+    (одно из двух равно None). Ошибки соединения и тайм-ауты выбрасываются.
+    """
+    result = None
+    use_stream = on_partial is not None and config.get("stream_responses", True) and backend.supports_stream
+    if use_stream:
+        # Потоковая генерация: частичный текст передаётся в on_partial по мере поступления токенов
+        async with backend.session.post(
+            backend.stream_url,
+            data=body,
+            headers=JSON_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=config.get("timeout", 300))
+        ) as response:
+            if response.status == 404:
+                backend.supports_stream = False
+                logger.warning("Бэкенд %s не поддерживает потоковую генерацию, используется обычный запрос",
+                               backend.base_url)
+            elif response.status != 200:
+                logger.error("Kobold API вернул статус %s", response.status)
+                ERRORS_TOTAL.inc(source="kobold", type=f"http_{response.status}")
+                return None, f"Ошибка: Kobold API вернул статус {response.status}"
+            else:
+                streamed_text = await read_token_stream(response, on_partial)
+                backend.report_success()
+                logger.debug("Потоковый ответ Kobold API получен, длина: %s", len(streamed_text))
+                return {"results": [{"text": streamed_text}]}, None
+
+    async with backend.session.post(
+        backend.api_url,
+        data=body,
+        headers=JSON_HEADERS,
+        timeout=aiohttp.ClientTimeout(total=config.get("timeout", 300))
+    ) as response:
+
+        # Проверяем статус ответа
+        if response.status != 200:
+            logger.error("Kobold API вернул статус %s", response.status)
+            ERRORS_TOTAL.inc(source="kobold", type=f"http_{response.status}")
+            return None, f"Ошибка: Kobold API вернул статус {response.status}"
+
+        # Получаем текстовый ответ от API
+        # Читаем ответ как байты, чтобы избежать ContentLengthError
+        response_bytes = await response.read()
+        if not response_bytes:
+            raise ValueError("Пустой ответ от Kobold API")
+
+        # Декодируем вручную с обработкой ошибок
+        try:
+            response_text = response_bytes.decode('utf-8')
+        except UnicodeDecodeError:
+            logger.error("Не удалось декодировать ответ от Kobold API")
+            ai_detail_logger.error("Ошибка декодирования ответа от Kobold API для chat_id %s: %s...",
+                                   chat_id, response_bytes[:100])
+            return None, "Ошибка: не удалось декодировать ответ от Kobold API"
+
+        backend.report_success()
+        logger.debug("Ответ Kobold API: %s...", response_text[:50])
+
+        # Проверка, является ли ответ валидным JSON
+        if not response_text.strip().startswith('{'):
+            logger.error("Получен невалидный JSON от Kobold API: %s...", response_text[:100])
+            ai_detail_logger.error("Невалидный JSON от Kobold API для chat_id %s, полный текст ответа: %s",
+                                   chat_id, response_text)
+            return None, f"Ошибка: Kobold API вернул невалидный JSON: {response_text[:100]}..."
+
+        # Парсим JSON-ответ
+        try:
+            result = loads(response_text)
+        except json.JSONDecodeError as e:
+            logger.error("Ошибка парсинга JSON от Kobold API: %s, текст ответа: %s...", e, response_text[:100])
+            ai_detail_logger.error("Ошибка парсинга JSON от Kobold API для chat_id %s, полный текст ответа: %s",
+                                   chat_id, response_text)
+            return None, f"Ошибка: не удалось распарсить ответ от Kobold API ({str(e)})"
+    return result, None
+
+def requested_max_length(text, config):
+    """Возвращает (max_length, текст без суффикса "мдXXX"/"mlXXX"/"mdXXX")."""
+    max_length = config["max_length"]  # Значение по умолчанию из конфига
+    match = MAX_LENGTH_PATTERN.search(text.strip())
+    if not match:
+        return max_length, text
+    length_value = int(match.group(2))  # Извлекаем число (например, 300)
+    if length_value > 512:
+        max_length = 512  # Ограничиваем до 512
+        logger.debug("Заданное значение max_length (%s) превышает 512, установлено 512", length_value)
+    else:
+        max_length = length_value  # Используем заданное пользователем значение
+        logger.debug("Установлено max_length из запроса: %s", max_length)
+    # Удаляем специальные символы из текста
+    text = MAX_LENGTH_PATTERN.sub('', text).strip()
+    logger.debug("Текст после удаления специальных символов: %s...", text[:50])
+    return max_length, text
+
+async def generate_response_async(text, config, chat_id, user_translate_enabled=True, ai_translate_enabled=True, continue_only=False, on_partial=None, priority=PRIORITY_NORMAL, trace=None):
+    """Генерирует ответ от Kobold API асинхронно.
+
+    Если передан on_partial, ответ запрашивается потоково и функция вызывается
+    с накопленным (ещё не переведённым) текстом по мере поступления токенов.
+    priority задаёт очерёдность в глобальном планировщике (меньше — раньше).
+    В trace (ReplyTrace), если передан, записывается время этапов.
+    """
+    logger.info("Генерация ответа для chat_id: %s, текст: %s..., continue_only: %s", chat_id, text[:50], continue_only)
     start_time = time.time()  # Запускаем замер времени выполнения
 
-    # Проверяем доступность Kobold API
-    if not await check_kobold_api(config["kobold_api_url"].replace("/api/v1/generate", "")):
-        logger.error(f"Kobold API недоступен: {config['kobold_api_url']}")
-        return f"Ошибка: Kobold API недоступен по адресу {config['kobold_api_url']}", text, "", get_default_character_name(), f"Roleplay character {get_default_character_name()}'s answer: ", 0.0
+    # Проверяем доступность Kobold API по состоянию фонового монитора
+    balancer = await get_balancer(config)
+    if not balancer.available() and not await balancer.wait_until_healthy(config.get("kobold_recovery_wait", 0)):
+        logger.error("Kobold API недоступен: %s", balancer.describe())
+        ERRORS_TOTAL.inc(source="kobold", type="unavailable")
+        return f"Ошибка: Kobold API недоступен по адресу {balancer.describe()}", text, "", get_default_character_name(), f"Roleplay character {get_default_character_name()}'s answer: ", 0.0
 
-    # Проверяем наличие специальных символов "мдXXX", "mlXXX" или "mdXXX" в конце текста
-    max_length = config["max_length"]  # Значение по умолчанию из конфига
-    pattern = r'(мд|ml|md)(\d{3})$'  # Регулярное выражение для "мд300", "ml300" или "md300"
-    match = re.search(pattern, text.strip())
-    if match:
-        length_value = int(match.group(2))  # Извлекаем число (например, 300)
-        if length_value > 512:
-            max_length = 512  # Ограничиваем до 512
-            logger.info(f"Заданное значение max_length ({length_value}) превышает 512, установлено 512")
-        else:
-            max_length = length_value  # Используем заданное пользователем значение
-            logger.info(f"Установлено max_length из запроса: {max_length}")
-        # Удаляем специальные символы из текста
-        text = re.sub(pattern, '', text).strip()
-        logger.info(f"Текст после удаления специальных символов: {text[:50]}...")
+    # Длина ответа может быть задана в конце текста ("мд300", "ml300" или "md300")
+    max_length, text = requested_max_length(text, config)
 
     if user_translate_enabled and not is_english(text) and text != "...":
-        text_en = translate_text(text, to_english=True)
-        logger.info(f"Текст переведён на английский: {text_en[:50]}...")
+        with trace_stage(trace, "input_translation"):
+            text_en = await translate_text(text, to_english=True)
+        logger.debug("Текст переведён на английский: %s...", text_en[:50])
     else:
         text_en = text
-        logger.info(f"Текст используется как есть: {text_en[:50]}...")
-
-    context_en = context if context else add_system_prompt(config["system_prompt"])
-    logger.info(f"Контекст: {context_en[:50]}...")
-    character_name = get_character_name(chat_id)
-    user_character_name = get_user_character_name(chat_id)
+        logger.debug("Текст используется как есть: %s...", text_en[:50])
+
+    # Настройки чата читаются один раз (обычно из кэша)
+    with trace_stage(trace, "settings"):
+        settings = await get_chat_settings(chat_id)
+        # Получаем память с учётом расширения
+        memory = await get_extended_memory(chat_id, config)
+    character_name = settings.character_name
+    user_character_name = settings.user_character_name
     formatted_user_character_name = f"{user_character_name}: "
     character_prompt = f"Roleplay character {character_name}'s answer: "
     if continue_only or text_en == "...":
-        prompt = context_en
-        logger.info(f"Продолжение с контекстом: {prompt[:50]}...")
+        text_en_context = ""
     else:
-        prompt = f"{context_en}\n{formatted_user_character_name}{text_en}\n{character_prompt}"
         text_en_context = f"\n{formatted_user_character_name}{text_en}\n{character_prompt}"
-        logger.info(f"Полный промпт: {prompt[:50]}...")
 
-    # Получаем память с учётом расширения
-    memory = get_extended_memory(chat_id, config)
-    
-    # Очищаем ответ от маркеров системного промпта
-    prompt = clean_system_prompt_markers(prompt)
-    # Формируем payload с динамическим max_length
-    payload = {
-        "prompt": prompt,
-        "memory": memory,
-        "max_length": max_length,  # Используем либо значение из запроса, либо из конфига
-        "max_new_tokens": config["max_new_tokens"],
-        "max_tokens": 512,
-        "temperature": config["temperature"],
-        "top_p": config["top_p"],
-        "typical_p": 1,
-        "typical": 1,
-        "sampler_seed": -1,
-        "min_p": 0,
-        "repetition_penalty": 1.22,
-        "frequency_penalty": 0,
-        "presence_penalty": 0,
-        "top_k": 0,
-        "skew": 0,
-        "min_tokens": 0,
-        "add_bos_token": True,
-        "smoothing_factor": 0,
-        "smoothing_curve": 1,
-        "dry_allowed_length": 2,
-        "dry_multiplier": 0,
-        "dry_base": 1.75,
-        "dry_sequence_breakers": ["\\n", ":", "\\\"", "*"],
-        "dry_penalty_last_n": 0,
-        "max_tokens_second": 0,
-        "stopping_strings": [f"\n{user_character_name}:", "\n***"],
-        "stop": [f"\n{user_character_name}:", "\n***"],
-        "truncation_length": 8192,
-        "ban_eos_token": False,
-        "skip_special_tokens": True,
-        "top_a": 0,
-        "tfs": 1,
-        "mirostat_mode": 0,
-        "mirostat_tau": 5,
-        "mirostat_eta": 0.1,
-        "custom_token_bans": "",
-        "banned_strings": [],
-        "sampler_order": [6, 0, 1, 3, 4, 2, 5],
-        "xtc_threshold": 0.1,
-        "xtc_probability": 0,
-        "nsigma": 0,
-        "grammar": "",
-        "trim_stop": True,
-        "rep_pen": 1.22,
-        "rep_pen_range": 0,
-        "repetition_penalty_range": 0,
-        "seed": -1,
-        "guidance_scale": 1,
-        "negative_prompt": "",
-        "grammar_string": "",
-        "repeat_penalty": 1.22,
-        "tfs_z": 1,
-        "repeat_last_n": 0,
-        "n_predict": 512,
-        "num_predict": 512,
-        "num_ctx": 8192,
-        "mirostat": 0,
-        "ignore_eos": False,
-        "rep_pen_slope": 1
-    }
-    
-    # Логируем payload в ai_details.log
-    ai_detail_logger.info(f"Запрос к Kobold API для chat_id {chat_id}: {json.dumps(payload, ensure_ascii=False, indent=2)}")
-    logger.info(f"Отправка запроса к Kobold API с промптом: {prompt[:50]}...")
 
-    # Отправляем запрос к Kobold API через HTTP без шифрования
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(
-                config["kobold_api_url"],
-                json=payload,
-                timeout=aiohttp.ClientTimeout(total=config.get("timeout", 300))
-            ) as response:
-
-                # Проверяем статус ответа
-                if response.status != 200:
-                    logger.error(f"Kobold API вернул статус {response.status}")
-                    return f"Ошибка: Kobold API вернул статус {response.status}", text, "", character_name, character_prompt, 0.0
-
-                # Получаем текстовый ответ от API
-                # Читаем ответ как байты, чтобы избежать ContentLengthError
-                response_bytes = await response.read()
-                if not response_bytes:
-                    raise ValueError("Пустой ответ от Kobold API")
-
-                # Декодируем вручную с обработкой ошибок
-                try:
-                    response_text = response_bytes.decode('utf-8')
-                except UnicodeDecodeError:
-                    logger.error("Не удалось декодировать ответ от Kobold API")
-                    ai_detail_logger.error(f"Ошибка декодирования ответа от Kobold API для chat_id {chat_id}: {response_bytes[:100]}...")
-                    return "Ошибка: не удалось декодировать ответ от Kobold API", text, "", character_name, character_prompt, 0.0
-
-                logger.info(f"Ответ Kobold API: {response_text[:50]}...")
-
-                # Проверка, является ли ответ валидным JSON
-                if not response_text.strip().startswith('{'):
-                    logger.error(f"Получен невалидный JSON от Kobold API: {response_text[:100]}...")
-                    ai_detail_logger.error(f"Невалидный JSON от Kobold API для chat_id {chat_id}, полный текст ответа: {response_text}")
-                    return (
-                        f"Ошибка: Kobold API вернул невалидный JSON: {response_text[:100]}...",
-                        text, "", character_name, character_prompt, 0.0
-                    )
+    # Читаем только свежие реплики, которые укладываются в бюджет токенов бэкенда
+    chars_per_token = config.get("chars_per_token", DEFAULT_CHARS_PER_TOKEN)
+    budget = context_budget(config, max_length, memory, text_en_context)
+    stable_prefix = config.get("stable_prompt_prefix", False)
+    with trace_stage(trace, "context"):
+        if stable_prefix:
+            # Начало истории сдвигается только при переполнении, чтобы бэкенд переиспользовал кэш промпта
+            system_turn, turns = await load_turns_stable(chat_id, budget, config.get("prompt_trim_ratio", DEFAULT_TRIM_RATIO))
+        else:
+            system_turn, turns = await load_turns(chat_id, budget)
+    prompt_started = time.perf_counter()
+    system_text = system_turn.text if system_turn else config["system_prompt"]
+    prompt_context = system_text + render_turns(turns)
+    logger.debug("Контекст: %s реплик, %s...", len(turns), prompt_context[:50])
+    if continue_only or text_en == "...":
+        prompt = prompt_context
+        logger.debug("Продолжение с контекстом: %s...", prompt[:50])
+    else:
+        prompt = f"{prompt_context}{text_en_context}"
+        logger.debug("Полный промпт: %s...", prompt[:50])
+    
+    # Параметры сэмплера берутся из готового шаблона, к ним добавляются только поля запроса
+    stop = [f"\n{user_character_name}:", "\n***"]
+    payload = get_template(config).build(prompt, memory, max_length, stop)
+
+    # Логируем payload в ai_details.log, если включено
+    if config.get("log_ai_details", False):
+        ai_detail_logger.info("Запрос к Kobold API для chat_id %s: %s",
+                              chat_id, json.dumps(payload, ensure_ascii=False, indent=2))
+    # Тело запроса кодируется один раз и переиспользуется при переключении на другой бэкенд
+    body = dumps(payload)
+    if trace is not None:
+        trace.add("prompt_build", time.perf_counter() - prompt_started)
+    logger.debug("Отправка запроса к Kobold API с промптом: %s...", prompt[:50])
 
-                # Парсим JSON-ответ
-                try:
-                    result = json.loads(response_text)
-                except json.JSONDecodeError as e:
-                    logger.error(f"Ошибка парсинга JSON от Kobold API: {str(e)}, текст ответа: {response_text[:100]}...")
-                    ai_detail_logger.error(f"Ошибка парсинга JSON от Kobold API для chat_id {chat_id}, полный текст ответа: {response_text}")
-                    return (
-                        f"Ошибка: не удалось распарсить ответ от Kobold API ({str(e)})",
-                        text, "", character_name, character_prompt, 0.0
+    try:
+        # Балансировщик выбирает бэкенд; при ошибке соединения запрос уходит на следующий доступный
+        tried = []
+        last_error = aiohttp.ClientConnectionError("нет доступных бэкендов Kobold")
+        prefix_share = 0.0
+        perf = None
+        scheduler_wait = 0.0  # ожидание места на бэкендах по всем попыткам
+        while True:
+            backend = balancer.choose(chat_id, exclude=tried)
+            if backend is None:
+                raise last_error
+            tried.append(backend)
+            request_started = None
+            try:
+                # Запрос ждёт свободного места на бэкенде в глобальном планировщике
+                with backend.reserve():
+                    async with get_scheduler(backend, config).slot(chat_id, priority) as waited:
+                        scheduler_wait += waited
+                        # KoboldCpp ставит memory перед промптом; совпадающее начало берётся из кэша сервера
+                        prefix_share = backend.prefix_reuse(memory + prompt)
+                        request_started = time.perf_counter()
+                        partial_callback = on_partial
+                        if trace is not None:
+                            trace.add("scheduler_wait", waited)
+                            if on_partial is not None:
+                                partial_callback = trace.first_token_hook(on_partial, request_started)
+                        result, error = await request_generation(backend, body, config, chat_id, partial_callback)
+                        if not error:
+                            # После ошибки состояние кэша сервера неизвестно: последним остаётся прежний промпт
+                            backend.remember_prompt(memory + prompt)
+                        request_time = time.perf_counter() - request_started
+                        KOBOLD_REQUEST_SECONDS.observe(request_time, backend=backend.base_url, outcome="error" if error else "ok")
+                        if trace is not None:
+                            trace.add("kobold_total", request_time)
+                        if stable_prefix and not error:
+                            # Статистику читаем, пока место на бэкенде ещё за нами, чтобы она относилась к этому запросу
+                            perf = await backend.fetch_perf()
+                break
+            except asyncio.TimeoutError:
+                # В Python 3.11 TimeoutError — подкласс OSError: тайм-аут генерации не считается
+                # отказом бэкенда и не повторяется на другом, иначе ожидание растёт в N раз
+                if request_started is not None:
+                    KOBOLD_REQUEST_SECONDS.observe(time.perf_counter() - request_started,
+                                                   backend=backend.base_url, outcome="timeout")
+                raise
+            except (aiohttp.ClientConnectionError, ConnectionResetError, OSError) as e:
+                logger.warning("Ошибка соединения с %s: %s, пробуем другой бэкенд", backend.base_url, e)
+                ERRORS_TOTAL.inc(source="kobold", type=type(e).__name__)
+                if request_started is not None:
+                    KOBOLD_REQUEST_SECONDS.observe(time.perf_counter() - request_started,
+                                                   backend=backend.base_url, outcome="connection_error")
+                backend.report_failure(e)
+                last_error = e
+        if error:
+            return error, text, "", character_name, character_prompt, 0.0
+        # /api/extra/perf не сообщает число токенов из кэша, поэтому сохраняется клиентская оценка
+        cache_reuse_estimated = prefix_share >= 0.5
+        prompt_time = perf.get("last_process") if perf else None
+        logger.debug("Промпт продолжает предыдущий на %s примерно на %.0f%%, обработка промпта: %s сек",
+                     backend.base_url, prefix_share * 100, prompt_time if prompt_time is not None else "н/д")
+
+        # Логируем полный JSON-ответ в ai_details.log, если включено
+        if config.get("log_ai_details", False):
+            ai_detail_logger.info("JSON-ответ от Kobold API для chat_id %s: %s", chat_id, json.dumps(result, indent=2))
+            
+        # Проверяем корректность формата ответа
+        if "results" not in result or not result["results"]:
+            raise ValueError("Некорректный формат ответа")
+        response_en = result["results"][0]["text"]
+        if not response_en:
+            raise ValueError("Пустой текст в ответе")
+
+        # Удаляем последнее слово из ответа для плавного продолжения
+        response_en_cleaned = remove_last_word(response_en)
+        if not response_en_cleaned.strip():
+            response_en_cleaned = response_en  # Если результат пустой, возвращаем оригинал
+        logger.debug("Ответ после удаления последнего слова: %s...", response_en_cleaned[:50])
+
+        # Извлекаем последнее предложение из контекста, если оно оборвано (нет точки)
+        last_sentence = ""
+        last_turn_text = turns[-1].text if turns else system_text
+        if continue_only and last_turn_text:
+            if not last_turn_text.strip().endswith('.'):
+                lines = last_turn_text.split('\n')
+                last_line = ""
+                for line in reversed(lines):
+                    if line.strip():
+                        last_line = line.strip()
+                        break
+                if last_line:
+                    sentences = last_line.split('.')
+                    for sentence in reversed(sentences):
+                        if sentence.strip():
+                            last_sentence = sentence.strip()
+                            break
+                logger.debug("Последнее предложение из контекста (без точки в конце): %s...", last_sentence[:50])
+            else:
+                logger.debug("Контекст заканчивается точкой, последнее предложение не извлекается")
+
+        # Объединяем последнее предложение с новым ответом, если оно было извлечено
+        combined_response_en = f"{last_sentence} {response_en_cleaned}".strip() if last_sentence else response_en_cleaned
+        logger.debug("Объединённый ответ: %s...", combined_response_en[:50])
+
+        # Обновляем контекст для следующего вызова
+        new_turns = []
+        if system_turn is None:
+            new_turns.append(("system", system_text))
+        if text_en_context:
+            new_turns.append(("user", text_en_context))
+        new_turns.append(("assistant", response_en_cleaned))
+        with trace_stage(trace, "context_save"):
+            await append_turns(chat_id, new_turns, chars_per_token)
+        updated_context = "".join(turn_text for _, turn_text in new_turns)
+        # Логируем обновлённый контекст в ai_details.log, если включено
+        if config.get("log_ai_details", False):
+            ai_detail_logger.info("Добавлено в контекст для chat_id %s: %s", chat_id, updated_context)
+        logger.debug("Реплики добавлены в контекст: %s...", updated_context[:50])
+
+        # Убираем character_prompt из текста для вывода пользователю
+        display_response_en = combined_response_en.replace(character_prompt, "")
+        logger.debug("Ответ для вывода пользователю: %s...", display_response_en[:50])
+            
+        # Формируем окончательный ответ с учётом настроек перевода
+        show_english = settings.show_english
+        if show_english is None:
+            show_english = config.get("show_english_default", False)
+        is_english_response = is_english(display_response_en)
+        if ai_translate_enabled and is_english_response:
+            logger.debug("Перевод ответа ИИ включен:%s Это английский ответ:%s", ai_translate_enabled, is_english_response)
+            with trace_stage(trace, "output_translation"):
+                response_ru = await translate_text(display_response_en, to_english=False)
+            if continue_only or text_en == "..." or text_en == "***":
+                logger.debug("Это продолжение текста")
+                if show_english:
+                    full_response = (
+                        f"Перевод: {response_ru}"
+                        f"---\n"
+                        f"Ответ ИИ (на английском): {display_response_en}\n"
                     )
-
-                # Логируем полный JSON-ответ в ai_details.log, если включено
-                if config.get("log_ai_details", False):
-                    ai_detail_logger.info(f"JSON-ответ от Kobold API для chat_id {chat_id}: {json.dumps(result, indent=2)}")
-                logger.info(f"JSON ответ: {json.dumps(result)[:50]}...")
-                
-                # Проверяем корректность формата ответа
-                if "results" not in result or not result["results"]:
-                    raise ValueError("Некорректный формат ответа")
-                response_en = result["results"][0]["text"]
-                if not response_en:
-                    raise ValueError("Пустой текст в ответе")
-
-                # Удаляем последнее слово из ответа для плавного продолжения
-                response_en_cleaned = remove_last_word(response_en)
-                if not response_en_cleaned.strip():
-                    response_en_cleaned = response_en  # Если результат пустой, возвращаем оригинал
-                logger.info(f"Ответ после удаления последнего слова: {response_en_cleaned[:50]}...")
-
-                # Извлекаем последнее предложение из контекста, если оно оборвано (нет точки)
-                last_sentence = ""
-                if continue_only and context_en:
-                    if not context_en.strip().endswith('.'):
-                        lines = context_en.split('\n')
-                        last_line = ""
-                        for line in reversed(lines):
-                            if line.strip():
-                                last_line = line.strip()
-                                break
-                        if last_line:
-                            sentences = last_line.split('.')
-                            for sentence in reversed(sentences):
-                                if sentence.strip():
-                                    last_sentence = sentence.strip()
-                                    break
-                        logger.info(f"Последнее предложение из контекста (без точки в конце): {last_sentence[:50]}...")
+                else:
+                    full_response = response_ru
+            else:
+                if user_translate_enabled:
+                    logger.debug("Перевод запроса включен")
+                    if show_english:
+                        full_response = (
+                            f"Перевод текста для ИИ на английский: {text_en}\n"
+                            f"Перевод: {response_ru}"
+                            f"---\n"
+                            f"Ответ ИИ (на английском): {display_response_en}\n"
+                        )
+                    else:
+                        full_response = response_ru
+                else:
+                    logger.debug("Перевод запроса выключен")
+                    if show_english:
+                        full_response = (
+                            f"Текст для ИИ: {text_en}\n"
+                            f"Перевод: {response_ru}"
+                            f"---\n"
+                            f"Ответ ИИ (на английском): {display_response_en}\n"
+                        )
                     else:
-                        logger.info("Контекст заканчивается точкой, последнее предложение не извлекается")
-
-                # Объединяем последнее предложение с новым ответом, если оно было извлечено
-                combined_response_en = f"{last_sentence} {response_en_cleaned}".strip() if last_sentence else response_en_cleaned
-                logger.info(f"Объединённый ответ: {combined_response_en[:50]}...")
-
-                # Обновляем контекст для следующего вызова
-                updated_context = f"{context}{text_en_context if not continue_only else ''}{response_en_cleaned}"
-                save_context(chat_id, updated_context)
-                # Логируем обновлённый контекст в ai_details.log, если включено
-                if config.get("log_ai_details", False):
-                    ai_detail_logger.info(f"Обновлённый контекст для chat_id {chat_id}: {updated_context}")
-                logger.info(f"Обновлённый контекст сохранён: {updated_context[:50]}...")
-
-                # Убираем character_prompt из текста для вывода пользователю
-                display_response_en = combined_response_en.replace(character_prompt, "")
-                logger.info(f"Ответ для вывода пользователю: {display_response_en[:50]}...")
+                        full_response = response_ru
+        else:
+            logger.debug("Перевод ответа ИИ включен:%s Это английский ответ:%s", ai_translate_enabled, is_english_response)
+            # Определяем префикс в зависимости от языка ответа
+            response_prefix = "Ответ ИИ (на английском):" if is_english_response else "Ответ ИИ:"
                 
-                # Формируем окончательный ответ с учётом настроек перевода
-                show_english = get_show_english(chat_id, config)
-                is_english_response = is_english(display_response_en)
-                if ai_translate_enabled and is_english_response:
-                    logger.info(f"Перевод ответа ИИ включен:{ai_translate_enabled} Это английский ответ:{is_english_response}")
-                    response_ru = translate_text(display_response_en, to_english=False)
-                    if continue_only or text_en == "..." or text_en == "***":
-                        logger.info("Это продолжение текста")
-                        if show_english:
-                            full_response = (
-                                f"Перевод: {response_ru}"
-                                f"---\n"
-                                f"Ответ ИИ (на английском): {display_response_en}\n"
-                            )
-                        else:
-                            full_response = response_ru
+            if continue_only or text_en == "..." or text_en == "***":
+                full_response = f"{response_prefix} {display_response_en}"
+            else:
+                if user_translate_enabled:
+                    if show_english:
+                        full_response = (
+                            f"Перевод текста для ИИ на английский: {text_en}\n"
+                            f"{response_prefix} {display_response_en}"
+                        )
                     else:
-                        if user_translate_enabled:
-                            logger.info("Перевод запроса включен")
-                            if show_english:
-                                full_response = (
-                                    f"Перевод текста для ИИ на английский: {text_en}\n"
-                                    f"Перевод: {response_ru}"
-                                    f"---\n"
-                                    f"Ответ ИИ (на английском): {display_response_en}\n"
-                                )
-                            else:
-                                full_response = response_ru
-                        else:
-                            logger.info("Перевод запроса выключен")
-                            if show_english:
-                                full_response = (
-                                    f"Текст для ИИ: {text_en}\n"
-                                    f"Перевод: {response_ru}"
-                                    f"---\n"
-                                    f"Ответ ИИ (на английском): {display_response_en}\n"
-                                )
-                            else:
-                                full_response = response_ru
-                else:
-                    logger.info(f"Перевод ответа ИИ включен:{ai_translate_enabled} Это английский ответ:{is_english_response}")
-                    # Определяем префикс в зависимости от языка ответа
-                    response_prefix = "Ответ ИИ (на английском):" if is_english_response else "Ответ ИИ:"
-                    
-                    if continue_only or text_en == "..." or text_en == "***":
                         full_response = f"{response_prefix} {display_response_en}"
-                    else:
-                        if user_translate_enabled:
-                            if show_english:
-                                full_response = (
-                                    f"Перевод текста для ИИ на английский: {text_en}\n"
-                                    f"{response_prefix} {display_response_en}"
-                                )
-                            else:
-                                full_response = f"{response_prefix} {display_response_en}"
-                        else:
-                            full_response = (
-                                f"Текст для ИИ: {text_en}\n"
-                                f"{response_prefix} {display_response_en}"
-                            )
-                            
-                logger.info(f"Итоговый ответ: {full_response[:50]}...")
-
-
-                # Завершаем замер времени и сохраняем его
-                end_time = time.time()
-                response_time = end_time - start_time
-                save_response_time(chat_id, response_time)
-                logger.info(f"Генерация завершена за {response_time:.2f} сек")
-
-                # Возвращаем кортеж с ответом и метаданными
-                return full_response, text_en, response_en_cleaned, character_name, character_prompt, response_time
-
-        # Обрабатываем возможные ошибки
-        except aiohttp.ClientPayloadError as e:
-            logger.error(f"Ошибка полезной нагрузки от Kobold API: {e}", exc_info=True)
-            return (
-                "Ошибка: ответ от Kobold API был получен не полностью. "
-                "Попробуйте снова или обратитесь к администратору."
-            ), text, "", character_name, character_prompt, 0.0
-        except (aiohttp.ClientConnectionError, ConnectionResetError, OSError) as e:
-            logger.error(f"Ошибка при запросе к Kobold API: {str(e)}")
-            return (
-                f"Ошибка: не удалось подключиться к Kobold API ({str(e)}). Попробуйте позже.",
-                text, "", character_name, character_prompt, 0.0
-            )
-        except asyncio.TimeoutError:
-            logger.error("Превышено время ожидания ответа от Kobold API")
-            default_character_name = get_default_character_name()  # Используем функцию
-            return (
-                f"Ошибка: превышено время ожидания ({config.get('timeout', 300)} сек). "
-                "Попробуйте снова или упростите запрос."
-            ), text, "", default_character_name, f"Roleplay character {default_character_name}'s answer: ", 0.0
-        except (aiohttp.ClientError, json.JSONDecodeError, ValueError) as e:
-            logger.error(f"Ошибка при запросе к Kobold API: {e}", exc_info=True)
-            default_character_name = get_default_character_name()  # Используем функцию
-            return f"Ошибка: не удалось получить ответ от модели ({str(e)})", text, "", default_character_name, f"Roleplay character {default_character_name}'s answer: ", 0.0
-        except Exception as e:
-            logger.error(f"Неизвестная ошибка при запросе к Kobold API: {e}", exc_info=True)
-            default_character_name = get_default_character_name()  # Используем функцию
-            return f"Ошибка: неизвестная проблема ({str(e)})", text, "", default_character_name, f"Roleplay character {default_character_name}'s answer: ", 0.0
\ No newline at end of file
+                else:
+                    full_response = (
+                        f"Текст для ИИ: {text_en}\n"
+                        f"{response_prefix} {display_response_en}"
+                    )
+                        
+        logger.debug("Итоговый ответ: %s...", full_response[:50])
+
+
+        # Завершаем замер времени и сохраняем его
+        end_time = time.time()
+        response_time = end_time - start_time
+        GENERATION_SECONDS.observe(response_time)
+        # В статистику для оценки идёт время без ожидания места на бэкенде:
+        # очередь планировщика оценка учитывает отдельно (backlog)
+        response_stats.record(chat_id, response_time - scheduler_wait, prompt_time, cache_reuse_estimated, max_length)
+        logger.info("Генерация завершена за %.2f сек", response_time)
+
+        # Возвращаем кортеж с ответом и метаданными
+        return full_response, text_en, response_en_cleaned, character_name, character_prompt, response_time
+
+    # Обрабатываем возможные ошибки
+    except aiohttp.ClientPayloadError as e:
+        logger.error("Ошибка полезной нагрузки от Kobold API: %s", e, exc_info=True)
+        ERRORS_TOTAL.inc(source="kobold", type=type(e).__name__)
+        return (
+            "Ошибка: ответ от Kobold API был получен не полностью. "
+            "Попробуйте снова или обратитесь к администратору."
+        ), text, "", character_name, character_prompt, 0.0
+    except asyncio.TimeoutError:
+        logger.error("Превышено время ожидания ответа от Kobold API")
+        ERRORS_TOTAL.inc(source="kobold", type="TimeoutError")
+        default_character_name = get_default_character_name()  # Используем функцию
+        return (
+            f"Ошибка: превышено время ожидания ({config.get('timeout', 300)} сек). "
+            "Попробуйте снова или упростите запрос."
+        ), text, "", default_character_name, f"Roleplay character {default_character_name}'s answer: ", 0.0
+    except (aiohttp.ClientConnectionError, ConnectionResetError, OSError) as e:
+        logger.error("Ошибка при запросе к Kobold API: %s", e)
+        ERRORS_TOTAL.inc(source="kobold", type=type(e).__name__)
+        return (
+            f"Ошибка: не удалось подключиться к Kobold API ({str(e)}). Попробуйте позже.",
+            text, "", character_name, character_prompt, 0.0
+        )
+    except (aiohttp.ClientError, json.JSONDecodeError, ValueError) as e:
+        logger.error("Ошибка при запросе к Kobold API: %s", e, exc_info=True)
+        ERRORS_TOTAL.inc(source="kobold", type=type(e).__name__)
+        default_character_name = get_default_character_name()  # Используем функцию
+        return f"Ошибка: не удалось получить ответ от модели ({str(e)})", text, "", default_character_name, f"Roleplay character {default_character_name}'s answer: ", 0.0
+    except Exception as e:
+        logger.error("Неизвестная ошибка при запросе к Kobold API: %s", e, exc_info=True)
+        ERRORS_TOTAL.inc(source="kobold", type=type(e).__name__)
+        default_character_name = get_default_character_name()  # Используем функцию
+        return f"Ошибка: неизвестная проблема ({str(e)})", text, "", default_character_name, f"Roleplay character {default_character_name}'s answer: ", 0.0
\ No newline at end of file
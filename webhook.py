@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# webhook.py
+import asyncio
+import hmac
+import logging
+from aiohttp import web
+from telebot import types
+from metrics import Counter, Gauge
+from payload import loads
+
+logger = logging.getLogger(__name__)
+
+# Заголовок, в котором Telegram передаёт secret_token из setWebhook
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+WEBHOOK_UPDATES_TOTAL = Counter("webhook_updates_total", "Обновления, полученные через webhook", ("result",))
+WEBHOOK_QUEUE_DEPTH = Gauge("webhook_queue_depth", "Обновления webhook, ожидающие обработки")
+
+
+class WebhookServer:
+    """Приём обновлений Telegram через webhook на встроенном сервере aiohttp.
+
+    Обработчик запроса только проверяет секрет, кладёт обновление в
+    ограниченную очередь и сразу отвечает 200, поэтому Telegram не ждёт
+    обработки. Обновления обрабатывают max_concurrency задач; если очередь
+    заполнена, отвечаем 503 и Telegram повторит доставку позже.
+    """
+
+    def __init__(self, bot, host="127.0.0.1", port=8443, path="/telegram", url=None, secret=None,
+                 max_concurrency=16, queue_size=1000, max_connections=40):
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self.path = path
+        self.url = url
+        self.secret = secret
+        self.max_concurrency = max_concurrency
+        self.max_connections = max_connections
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._workers = []
+        self._runner = None
+        WEBHOOK_QUEUE_DEPTH.set_function(self._queue.qsize)
+
+    @classmethod
+    def from_config(cls, bot, config):
+        return cls(
+            bot,
+            host=config.get("webhook_listen_host", "127.0.0.1"),
+            port=config.get("webhook_listen_port", 8443),
+            path=config.get("webhook_path", "/telegram"),
+            url=config.get("webhook_url"),
+            secret=config.get("webhook_secret") or None,
+            max_concurrency=config.get("webhook_max_concurrency", 16),
+            queue_size=config.get("webhook_queue_size", 1000),
+            max_connections=config.get("webhook_max_connections", 40),
+        )
+
+    async def _handle_update(self, request):
+        if self.secret is not None:
+            token = request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(token.encode(), self.secret.encode()):
+                WEBHOOK_UPDATES_TOTAL.inc(result="forbidden")
+                return web.Response(status=403)
+        try:
+            update = types.Update.de_json(loads(await request.read()))
+        except Exception as e:
+            logger.warning("Некорректное обновление webhook: %s", e)
+            WEBHOOK_UPDATES_TOTAL.inc(result="invalid")
+            return web.Response(status=400)
+        try:
+            self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            logger.warning("Очередь обновлений webhook заполнена (%s), Telegram повторит доставку", self._queue.maxsize)
+            WEBHOOK_UPDATES_TOTAL.inc(result="rejected")
+            return web.Response(status=503)
+        WEBHOOK_UPDATES_TOTAL.inc(result="accepted")
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            update = await self._queue.get()
+            try:
+                await self.bot.process_new_updates([update])
+            except Exception as e:
+                logger.error("Ошибка при обработке обновления %s: %s", update.update_id, e, exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    async def start(self):
+        """Запускает сервер и обработчики, затем регистрирует webhook в Telegram (если задан url)."""
+        app = web.Application()
+        app.router.add_post(self.path, self._handle_update)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)]
+        logger.info("Webhook-сервер слушает %s:%s%s, параллельность обработки: %s",
+                    self.host, self.port, self.path, self.max_concurrency)
+        if self.url:
+            await self.bot.set_webhook(url=self.url, secret_token=self.secret, max_connections=self.max_connections)
+            logger.info("Webhook зарегистрирован в Telegram: %s", self.url)
+        else:
+            logger.warning("webhook_url не задан: webhook нужно зарегистрировать вручную")
+
+    async def serve_forever(self):
+        """Запускает сервер и работает до отмены задачи."""
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        """Останавливает приём обновлений и дожидается отмены обработчиков.
+
+        Webhook в Telegram не удаляется: обновления накопятся на стороне
+        Telegram до следующего запуска.
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        for worker in self._workers:
+            worker.cancel()
+        for worker in self._workers:
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+        self._workers = []